@@ -0,0 +1,429 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmarks for the hot paths of the messaging server.
+
+Run "./benchmark.py <name>" to run a single benchmark or "./benchmark.py all"
+to run all of them.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+import timeit
+import tracemalloc
+import xml.etree.ElementTree as ET
+import snom_messaging
+from frames import Frame
+from injection import InjectionServer
+from journal import Journal
+from messagesystem import Message, Broadcast
+from outbox import Outbox
+from replay import ReplayTransport
+from templates import JOB_REQUEST
+
+# Frames as they are sent by a M700 BaseStation.
+JOB_FRAME = b"""<?xml version="1.0" encoding="UTF-8"?>
+<request version="19.11.12.1403" type="job">
+<externalid>3485367639</externalid>
+<systemdata>
+<name>M700</name>
+<datetime>2019-12-29 22:05:44</datetime>
+<timestamp>5e091528</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+<jobdata>
+<priority>0</priority>
+<messages>
+<message1></message1>
+<message2></message2>
+<messageuui>Lunch is ready &amp; waiting in the kitchen</messageuui>
+</messages>
+<status>0</status>
+<statusinfo></statusinfo>
+</jobdata>
+<senderdata>
+<address>23</address>
+<name>no23</name>
+<location>M700</location>
+</senderdata>
+<persondata>
+<address>42</address>
+</persondata>
+</request>
+\0"""
+
+SYSTEMINFO_FRAME = b"""<?xml version="1.0" encoding="UTF-8"?>
+<request version="19.11.12.1403" type="systeminfo">
+<externalid>3485367639</externalid>
+<systemdata>
+<name>M700</name>
+<datetime>2019-12-29 22:05:44</datetime>
+<timestamp>5e091528</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+<senderdata>
+""" + b"".join(b"<address>%d</address>\n<name>no%d</name>\n" % (i, i) for i in range(20, 40)) + b"""</senderdata>
+</request>
+\0"""
+
+LOGIN_FRAME = b"""<?xml version="1.0" encoding="UTF-8"?>
+<request version="19.11.12.1403" type="login">
+<externalid>3725663668</externalid>
+<systemdata>
+<name>M700</name>
+<datetime>2019-12-29 22:04:48</datetime>
+<timestamp>5e0914f0</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+<logindata>
+<status>1</status>
+</logindata>
+<senderdata>
+<address>42</address>
+<name>no42</name>
+<location>M700</location>
+</senderdata>
+</request>
+\0"""
+
+ALARM_FRAME = b"""<?xml version="1.0" encoding="UTF-8"?>
+<request version="19.11.12.1403" type="alarm">
+<externalid>0595015157</externalid>
+<systemdata>
+<name>M700</name>
+<datetime>2019-12-29 23:40:32</datetime>
+<timestamp>5e092b60</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+<alarmdata>
+<type>16</type>
+</alarmdata>
+<rssidata>
+<rfpi>1333a39f00</rfpi>
+<rssi>204</rssi>
+</rssidata>
+<senderdata>
+<address>99</address>
+<name>no99</name>
+<location>M700</location>
+</senderdata>
+</request>
+\0"""
+
+
+def _report(name, seconds, number, unit="op"):
+    print("{:40} {:10.2f} us/{}  {:12.0f} {}/s".format(
+        name, seconds / number * 1e6, unit, number / seconds, unit))
+
+
+# The job request template as plain text with {{field}} placeholders.
+# The priority was always 0 back then.
+_LEGACY_TEXT = JOB_REQUEST.text.replace("{{priority}}", "0")
+
+
+def _legacy_render(message):
+    # The str.replace()-chain used before templates.Template existed.
+    text = _LEGACY_TEXT.replace("{{eid}}", "{:010}".format(message.internal_ext_id))
+    text = text.replace("{{from_ext}}", message.from_ext)
+    text = text.replace("{{from_name}}", message.from_name)
+    text = text.replace("{{from_loc}}", message.from_loc)
+    text = text.replace("{{to_ext}}", message.to_ext)
+    text = text.replace("{{dt}}", message.sysdata_datetime)
+    text = text.replace("{{ts}}", message.sysdata_ts)
+    text = text.replace("{{msg}}", message.message)
+    return text.encode("UTF-8")
+
+
+def bench_render(number):
+    """
+    Per-datagram cost of rendering a job request.
+    """
+
+    message = Message.from_frame(Frame.parse(JOB_FRAME))
+
+    def uncached():
+        message._datagram = None
+        return message.get_message()
+
+    _report("render: str.replace + encode", timeit.timeit(lambda: _legacy_render(message), number=number), number)
+    _report("render: compiled template", timeit.timeit(uncached, number=number), number)
+    _report("render: cached datagram", timeit.timeit(message.get_message, number=number), number)
+    _report("render: confirmation", timeit.timeit(message.get_messageresponse, number=number), number)
+
+
+def _legacy_parse(data):
+    # Decoding and parsing into an ElementTree as done before frames.Frame
+    # existed, followed by the lookups the drivers did on the tree.
+    for message in data.decode("UTF-8").split("\0"):
+        if not message:
+            continue
+        xml_message = ET.fromstring(message)
+        kind = xml_message.attrib["type"]
+        if kind == "job":
+            return [xml_message.find(path).text for path in (
+                "./externalid", "./jobdata/messages/messageuui", "./senderdata/name",
+                "./senderdata/address", "./senderdata/location", "./persondata/address",
+                "./systemdata/datetime", "./systemdata/timestamp")]
+        if kind == "systeminfo":
+            return [e.text for e in xml_message.find("senderdata").findall("address")]
+        if kind == "login":
+            return [xml_message.find("logindata").find("status").text,
+                    xml_message.find("senderdata").find("address").text]
+        return None
+
+
+def _frame_parse(data):
+    for message in data.split(b"\0"):
+        if not message:
+            continue
+        frame = Frame.parse(message)
+        if frame.type == "job":
+            return [frame.findtext(path) for path in (
+                "externalid", "jobdata/messages/messageuui", "senderdata/name",
+                "senderdata/address", "senderdata/location", "persondata/address",
+                "systemdata/datetime", "systemdata/timestamp")]
+        if frame.type == "systeminfo":
+            return frame.findall("senderdata/address")
+        if frame.type == "login":
+            return [frame.findtext("logindata/status"), frame.findtext("senderdata/address")]
+        return None
+
+
+def bench_parse(number):
+    """
+    Frames per second for parsing a datagram and extracting the fields of interest.
+    """
+
+    for name, data in (
+            ("job", JOB_FRAME),
+            ("systeminfo", SYSTEMINFO_FRAME),
+            ("login", LOGIN_FRAME),
+            ("alarm", ALARM_FRAME)):
+        assert _legacy_parse(data) == _frame_parse(data)
+        _report("parse {}: ElementTree".format(name), timeit.timeit(lambda: _legacy_parse(data), number=number), number, "frame")
+        _report("parse {}: frames.Frame".format(name), timeit.timeit(lambda: _frame_parse(data), number=number), number, "frame")
+
+
+def bench_journal(number):
+    """
+    Recovery time of the outbox from a journal with number queued messages.
+    """
+
+    template = Message.from_frame(Frame.parse(JOB_FRAME))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "outbox.journal")
+        journal = Journal(path)
+        journal.recover()
+
+        records = []
+        for i in range(number):
+            message = Message(
+                template.ext_id, template.message, template.from_name, template.from_ext,
+                template.from_loc, str(i), template.sysdata_datetime, template.sysdata_ts,
+                internal_ext_id=i)
+            message.last_send_try = message.created
+            records.append(Journal._enqueue_record(message))
+            records.append(Journal._record(Journal.ATTEMPT, Journal._attempt.pack(message.internal_ext_id, message.created)))
+        start = time.perf_counter()
+        journal._write(records)
+        _report("journal: write + fsync", time.perf_counter() - start, number, "msg")
+        journal.close()
+
+        start = time.perf_counter()
+        recovered = Journal(path).recover()
+        _report("journal: recover", time.perf_counter() - start, number, "msg")
+        assert len(recovered) == number
+
+
+class _LegacyMessage():
+
+    # Message as it was before it got __slots__ and interned strings: With a
+    # __dict__, its own copies of all strings and the datagram kept forever.
+
+    lane = "normal"
+
+    def __init__(self, ext_id, message, from_name, from_ext, from_loc, to_ext, sysdata_datetime, sysdata_ts):
+        self.created = time.time()
+        self.last_send_try = 0
+        self.ext_id = ext_id
+        self.message = message
+        self.from_name = from_name
+        self.from_ext = from_ext
+        self.from_loc = from_loc
+        self.to_ext = to_ext
+        self.sysdata_datetime = sysdata_datetime
+        self.sysdata_ts = sysdata_ts
+        self.internal_ext_id = random.randrange(9999999999+1)
+        self._datagram = None
+
+
+def _job_frames(number):
+    # Job frames from 200 handsets to each other, parsed one by one like the
+    # server does, so every frame has its own copies of the strings.
+    for i in range(number):
+        data = JOB_FRAME.replace(b"<address>23</address>", b"<address>%d</address>" % (100 + i % 200))
+        data = data.replace(b"<name>no23</name>", b"<name>no%d</name>" % (100 + i % 200))
+        data = data.replace(b"<address>42</address>", b"<address>%d</address>" % (100 + i * 7 % 200))
+        yield Frame.parse(data)
+
+
+def _queued_bytes(number, create, parked):
+    outbox = Outbox()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for frame in _job_frames(number):
+        message = create(frame)
+        if parked:
+            # The datagram was rendered for the first send try.
+            message.get_message()
+            message.compact()
+        else:
+            message._datagram = JOB_REQUEST.render(
+                eid="{:010}".format(message.internal_ext_id), dt=message.sysdata_datetime, ts=message.sysdata_ts, priority=0,
+                msg=message.message, from_ext=message.from_ext, from_name=message.from_name,
+                from_loc=message.from_loc, to_ext=message.to_ext)
+        outbox.add(message, message.created)
+    # Frames are parsed one at a time, only the queue is left over.
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return size / number
+
+
+def bench_memory(number):
+    """
+    Bytes per queued message, including the outbox indexes.
+    """
+
+    def legacy(frame):
+        return _LegacyMessage(*(frame.findtext(path) for path in (
+            "externalid", "jobdata/messages/messageuui", "senderdata/name",
+            "senderdata/address", "senderdata/location", "persondata/address",
+            "systemdata/datetime", "systemdata/timestamp")))
+
+    for name, create, parked in (
+            ("dict, no interning, datagram kept", legacy, False),
+            ("slots, interned, datagram kept", Message.from_frame, False),
+            ("slots, interned, parked", Message.from_frame, True)):
+        print("{:40} {:10.0f} bytes/msg".format("memory: " + name, _queued_bytes(number, create, parked)))
+
+
+def bench_broadcast(number):
+    """
+    Bytes per recipient and render time of a text sent to number handsets,
+    as separate Messages and as a single Broadcast.
+    """
+
+    text = "Fire alarm in building 3. Please leave the building using the nearest exit and meet at the assembly point."
+    recipients = [str(100 + i) for i in range(number)]
+    fields = ("alarm", "Alarm", "alarm", "2024-01-01 12:00:00", "00000000")
+
+    def messages():
+        return [Message(None, text, *fields[:3], number, *fields[3:], priority=1) for number in recipients]
+
+    def broadcast():
+        broadcast = Broadcast(None, text, *fields, priority=1, group="all")
+        return [broadcast.add(number, i) for i, number in enumerate(recipients)]
+
+    for name, create in (("messages", messages), ("broadcast", broadcast)):
+        outbox = Outbox()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        queued = create()
+        for i, message in enumerate(queued):
+            message.internal_ext_id = i
+            outbox.add(message, 0)
+        size = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        print("{:40} {:10.0f} bytes/recipient".format("broadcast: " + name + ", parked", size / number))
+
+        start = time.perf_counter()
+        for message in queued:
+            message.get_message()
+        _report("broadcast: " + name + ", render", time.perf_counter() - start, number, "recipient")
+
+
+def _inject_batch(number):
+    # A batch of number messages, one per recipient, like a ticketing system
+    # notifying its users.
+    return json.dumps({"messages": [
+        {"to": str(100 + i % 200), "text": "Ticket #{} was assigned to you".format(i), "priority": i % 2}
+        for i in range(number)]}).encode("UTF-8")
+
+
+async def _post(port, data):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"POST /messages HTTP/1.0\r\nContent-Length: %d\r\n\r\n" % len(data) + data)
+    response = await reader.read()
+    writer.close()
+    return response
+
+
+async def _bench_inject(number, directory):
+    data = _inject_batch(number)
+    for name, journal in (("without journal", None), ("with journal", os.path.join(directory, "outbox.journal"))):
+        protocol = snom_messaging.UdpServer()
+        protocol.connection_made(ReplayTransport())
+        if journal is not None:
+            journal = Journal(journal)
+            journal.recover()
+        message_system = snom_messaging.attach_drivers(protocol, journal)
+        server = InjectionServer(message_system)
+
+        start = time.perf_counter()
+        messages, broadcasts = server.build(server.parse_batch(data))
+        assert await server.inject(messages, broadcasts)
+        _report("inject {}: direct".format(name), time.perf_counter() - start, number, "msg")
+
+        await server.start(port=0)
+        start = time.perf_counter()
+        response = await _post(server._server.sockets[0].getsockname()[1], data)
+        _report("inject {}: HTTP".format(name), time.perf_counter() - start, number, "msg")
+        assert response.startswith(b"HTTP/1.0 202"), response
+        assert len(message_system._queue) == 2 * number
+
+        server.close()
+        protocol.close_drivers()
+
+
+def bench_inject(number):
+    """
+    Time to validate and queue a batch of number injected messages.
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+        asyncio.run(_bench_inject(number, directory))
+
+
+BENCHMARKS = {
+    "broadcast": bench_broadcast,
+    "inject": bench_inject,
+    "journal": bench_journal,
+    "memory": bench_memory,
+    "parse": bench_parse,
+    "render": bench_render,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS) + ["all"])
+    parser.add_argument("-n", "--number", type=int, default=100000, help="iterations per measurement")
+    args = parser.parse_args()
+
+    if args.benchmark == "all":
+        for name in sorted(BENCHMARKS):
+            BENCHMARKS[name](args.number)
+    else:
+        BENCHMARKS[args.benchmark](args.number)
+
+if __name__ == "__main__":
+    main()
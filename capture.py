@@ -0,0 +1,97 @@
+import logging
+import mmap
+import os
+import socket
+import struct
+logger = logging.getLogger(__name__)
+
+class Capture():
+
+    """
+    This class writes all datagrams received and sent by a UdpServer to a
+    capture file, so real traffic can be replayed later on.
+
+    The file starts with a magic string. Every datagram is written as a
+    record: A header (time, direction, IPv4 address and port of the peer,
+    length) followed by the datagram itself.
+
+    Once the file grows beyond max_bytes it is rotated: path is renamed to
+    path.1, path.1 to path.2 and so on. At most backups old files are kept.
+    """
+
+    IN = 0
+    OUT = 1
+
+    _magic = b"SNOMCAP1"
+    _header = struct.Struct("<dB4sHI")
+
+    def __init__(self, path, max_bytes=64*1024*1024, backups=5):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backups = backups
+        self._file = None
+        self._size = 0
+        self._open()
+
+    def _open(self):
+        self._file = open(self._path, "ab")
+        self._size = self._file.tell()
+        if self._size == 0:
+            self._file.write(Capture._magic)
+            self._size = len(Capture._magic)
+
+    def _rotate(self):
+        self._file.close()
+        for i in range(self._backups - 1, 0, -1):
+            source = "{}.{}".format(self._path, i)
+            if os.path.exists(source):
+                os.replace(source, "{}.{}".format(self._path, i + 1))
+        if self._backups > 0:
+            os.replace(self._path, self._path + ".1")
+        else:
+            os.remove(self._path)
+        self._open()
+
+    def write(self, timestamp, direction, data, addr):
+        if self._file is None:
+            return
+        self._file.write(Capture._header.pack(timestamp, direction, socket.inet_aton(addr[0]), addr[1], len(data)))
+        self._file.write(data)
+        self._size += Capture._header.size + len(data)
+        if self._size >= self._max_bytes:
+            self._rotate()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_capture(path):
+    """
+    Yields the records of a capture file as tuples
+    (time, direction, data, (host, port)).
+
+    The file is memory-mapped. A torn record at the end of the file is
+    ignored.
+    """
+
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size <= len(Capture._magic):
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[:len(Capture._magic)] != Capture._magic:
+                raise ValueError("{} is not a capture".format(path))
+
+            unpack_header = Capture._header.unpack_from
+            header_size = Capture._header.size
+            end = len(data)
+            pos = len(Capture._magic)
+            while pos + header_size <= end:
+                timestamp, direction, host, port, length = unpack_header(data, pos)
+                start = pos + header_size
+                pos = start + length
+                if pos > end:
+                    logger.warning("Ignoring incomplete record at the end of %s", path)
+                    break
+                yield timestamp, direction, data[start:pos], (socket.inet_ntoa(host), port)
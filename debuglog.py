@@ -0,0 +1,223 @@
+import logging
+import collections
+import json
+import re
+import sys
+import time
+from capture import Capture
+logger = logging.getLogger(__name__)
+
+class Event():
+
+    """
+    A structured log message: The name of an event and its fields. It is
+    formatted as "name key=value ..." only once a handler emits the record.
+    """
+
+    __slots__ = ("name", "fields")
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def __str__(self):
+        return " ".join([self.name] + ["{}={}".format(key, value) for key, value in self.fields.items()])
+
+
+def log_event(log, level, name, **fields):
+    """
+    Logs the event name with fields to the logger log. Nothing is built
+    unless log is enabled for level.
+
+    The record carries name and fields as its attributes event and fields,
+    see JsonFormatter.
+    """
+
+    if log.isEnabledFor(level):
+        log.log(level, "%s", Event(name, fields), extra={"event": name, "fields": fields})
+
+
+class Lines():
+
+    """
+    A frame to be logged. It is decoded and split into numbered lines only
+    once a handler emits the record.
+    """
+
+    __slots__ = ("_data",)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __str__(self):
+        text = self._data.decode("UTF-8", "replace") if isinstance(self._data, bytes) else self._data
+        # Frames are \0-terminated, a datagram may hold several.
+        text = text.rstrip("\0").replace("\0", "\n")
+        return "\n".join("{:02} {}".format(i, line) for i, line in enumerate(text.split("\n"), 1))
+
+
+class JsonFormatter(logging.Formatter):
+
+    """
+    Formats every record as a single line of JSON. The fields of events (see
+    log_event()) are separate keys.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+        }
+        event = getattr(record, "event", None)
+        if event is not None:
+            entry["event"] = event
+            entry.update((key, value if isinstance(value, (int, float, str)) else str(value))
+                         for key, value in record.fields.items())
+        else:
+            entry["message"] = record.getMessage()
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class FrameRing():
+
+    """
+    This class keeps the last size datagrams received and sent by a
+    UdpServer in memory (see UdpServer.add_tap()).
+
+    Nothing is logged or written while the server runs. Once something went
+    wrong, dump() writes the traffic leading up to it to the log or a
+    capture file, which replay.py can replay.
+    """
+
+    def __init__(self, size=1000):
+        if size < 1:
+            raise ValueError("The ring needs to hold at least one datagram")
+        # (time, direction, data, addr), oldest first
+        self._datagrams = collections.deque(maxlen=size)
+
+    def __len__(self):
+        return len(self._datagrams)
+
+    def write(self, timestamp, direction, data, addr):
+        self._datagrams.append((timestamp, direction, data, addr))
+
+    def dump(self, path=None):
+        """
+        Writes the datagrams to the log or, if path is given, appends them
+        to the capture file path. path may contain time.strftime() codes.
+
+        Returns the number of datagrams written.
+        """
+
+        datagrams = list(self._datagrams)
+        if path is None:
+            for timestamp, direction, data, addr in datagrams:
+                logger.info("%s %s %s:\n%s", time.strftime("%H:%M:%S", time.localtime(timestamp)),
+                            "from" if direction == Capture.IN else "to", addr, Lines(data))
+        else:
+            path = time.strftime(path)
+            try:
+                capture = Capture(path, max_bytes=sys.maxsize)
+                for record in datagrams:
+                    capture.write(*record)
+                capture.close()
+            except OSError as exp:
+                logger.error("Failed to dump datagrams to %s: %s", path, exp)
+                return 0
+        logger.info("Dumped %s datagrams%s", len(datagrams), "" if path is None else " to " + path)
+        return len(datagrams)
+
+
+class Tracer():
+
+    """
+    This class logs the frames to and from some extensions at INFO level, so
+    a single handset can be debugged while the server runs at INFO and
+    everything else is not slowed down by DEBUG logging.
+
+    Frames belong to an extension if they contain it as an address, e.g.
+    as sender or recipient of a message or as listed handset of a
+    systeminfo frame. Status frames belong to the extension their message
+    was sent to.
+
+    Of the frames of an extension only every sample-th one is logged (along
+    with the status frames of logged messages).
+    """
+
+    _address = re.compile(rb"<address>\s*([^<\s]+)\s*</address>")
+    _externalid = re.compile(rb"<externalid>\s*(\d+)\s*</externalid>")
+
+    # The ids of this many logged messages are remembered, to log their
+    # status frames.
+    _max_ids = 1000
+
+    def __init__(self, extensions=(), sample=1):
+        if sample < 1:
+            raise ValueError("sample needs to be at least 1")
+        self._sample = sample
+        # extension (bytes) => frames seen
+        self._extensions = {}
+        # external id (bytes) of a logged message => extension
+        self._ids = collections.OrderedDict()
+        for extension in extensions:
+            self.add(extension)
+        self.counters = {
+            "matched": 0,
+            "logged": 0,
+        }
+
+    def add(self, extension):
+        self._extensions.setdefault(extension.encode("UTF-8"), 0)
+
+    def discard(self, extension):
+        self._extensions.pop(extension.encode("UTF-8"), None)
+
+    def __len__(self):
+        return len(self._extensions)
+
+    def write(self, timestamp, direction, data, addr):
+        if not self._extensions:
+            return
+        for frame in data.split(b"\0"):
+            extension = self._match(frame)
+            if extension is not None:
+                self._log(extension, direction, frame, addr)
+
+    def _match(self, frame):
+        # Returns the traced extension frame belongs to, if it is to be
+        # logged.
+        extensions = self._extensions
+        for address in Tracer._address.findall(frame):
+            seen = extensions.get(address)
+            if seen is not None:
+                extensions[address] = seen + 1
+                self.counters["matched"] += 1
+                if seen % self._sample:
+                    return None
+                externalid = Tracer._externalid.search(frame)
+                if externalid is not None:
+                    self._ids[externalid.group(1)] = address
+                    if len(self._ids) > Tracer._max_ids:
+                        self._ids.popitem(last=False)
+                return address
+        if self._ids:
+            externalid = Tracer._externalid.search(frame)
+            if externalid is not None:
+                return self._ids.get(externalid.group(1))
+        return None
+
+    def _log(self, extension, direction, frame, addr):
+        self.counters["logged"] += 1
+        if not logger.isEnabledFor(logging.INFO):
+            return
+        logger.info("Frame of %s %s %s:\n%s", extension.decode("UTF-8", "replace"),
+                    "from" if direction == Capture.IN else "to", addr, Lines(frame),
+                    extra={"event": "traced", "fields": {
+                        "extension": extension.decode("UTF-8", "replace"),
+                        "direction": "in" if direction == Capture.IN else "out",
+                        "addr": addr,
+                        "frame": frame.decode("UTF-8", "replace"),
+                    }})
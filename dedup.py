@@ -0,0 +1,77 @@
+import logging
+from collections import OrderedDict
+logger = logging.getLogger(__name__)
+
+class DedupCache():
+
+    """
+    This class remembers recently received frames, so retransmissions can be
+    recognized.
+
+    The BaseStations retransmit a frame if our confirmation is slow or lost.
+    Every entry maps the key of a frame to a value (e.g. the confirmation we
+    sent for it). Entries are evicted when they are older than ttl seconds or
+    when the cache holds more than maxsize entries, least recently used first.
+
+    Hits and misses are counted in counters.
+    """
+
+    def __init__(self, maxsize=4096, ttl=600):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        # key => [expiry, value]
+        self._entries = OrderedDict()
+
+        self.counters = {
+            "hit": 0,
+            "miss": 0,
+        }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key, now):
+        """
+        Looks up a key.
+
+        Returns a tuple (found, value). found is False if the key is not
+        known (anymore).
+        """
+
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= now:
+            if entry is not None:
+                del self._entries[key]
+            self.counters["miss"] += 1
+            return False, None
+
+        self._entries.move_to_end(key)
+        self.counters["hit"] += 1
+        return True, entry[1]
+
+    def add(self, key, value, now):
+        """
+        Remembers a key with a value for ttl seconds.
+        """
+
+        self._entries[key] = [now + self._ttl, value]
+        self._entries.move_to_end(key)
+
+        entries = self._entries
+        while len(entries) > self._maxsize:
+            entries.popitem(last=False)
+        # Drop expired entries that became the least recently used ones.
+        while entries:
+            oldest, entry = next(iter(entries.items()))
+            if entry[0] > now:
+                break
+            del entries[oldest]
+
+    def update(self, key, value):
+        """
+        Changes the value of a known key, without touching its expiry.
+        """
+
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[1] = value
@@ -0,0 +1,108 @@
+import logging
+import asyncio
+import collections
+import time
+logger = logging.getLogger(__name__)
+
+class DriverQueue():
+
+    """
+    This class decouples a driver from the receive path of the UdpServer.
+
+    Frames for the driver are put into a bounded queue and handed to the
+    driver one at a time by a worker task, which yields to the event loop
+    after every frame. So a driver waiting for I/O does not delay the other
+    drivers, e.g. the confirmations sent by the MessageSystem. Its handlers
+    still run on the event loop, so they must not block either.
+
+    Once the queue holds size frames, either the oldest one is dropped to
+    make room for a new one (DROP_OLDEST) or the new one is shed (SHED).
+    Both count as dropped.
+    """
+
+    DROP_OLDEST = "drop-oldest"
+    SHED = "shed"
+
+    def __init__(self, call, size=1000, overflow=DROP_OLDEST):
+        """
+        Creates a new DriverQueue and starts its worker.
+
+        call is a coroutine function that is awaited with (handler, frame,
+        addr) for every frame.
+        """
+
+        if overflow not in (DriverQueue.DROP_OLDEST, DriverQueue.SHED):
+            raise ValueError("Unknown overflow policy {}".format(overflow))
+        if size < 1:
+            raise ValueError("The queue needs to hold at least one frame")
+
+        self._call = call
+        self._size = size
+        self._overflow = overflow
+        # (time queued, handler, frame, addr)
+        self._frames = collections.deque()
+        self._ready = asyncio.Event()
+
+        self.counters = {
+            "queued": 0,
+            "handled": 0,
+            "dropped": 0,
+        }
+
+        self._worker = asyncio.get_event_loop().create_task(self._work())
+
+    def __len__(self):
+        return len(self._frames)
+
+    def lag(self):
+        """
+        Returns the seconds the oldest queued frame is waiting for.
+        """
+
+        if not self._frames:
+            return 0
+        return time.monotonic() - self._frames[0][0]
+
+    def put(self, handler, frame, addr):
+        """
+        Queues a frame for handler. Returns False if it was shed.
+        """
+
+        if self._worker is None:
+            return False
+        if len(self._frames) >= self._size:
+            self.counters["dropped"] += 1
+            if self._overflow == DriverQueue.SHED:
+                return False
+            self._frames.popleft()
+        self._frames.append((time.monotonic(), handler, frame, addr))
+        self.counters["queued"] += 1
+        self._ready.set()
+        return True
+
+    async def _work(self):
+        frames = self._frames
+        while True:
+            while not frames:
+                self._ready.clear()
+                await self._ready.wait()
+            _, handler, frame, addr = frames.popleft()
+            await self._call(handler, frame, addr)
+            self.counters["handled"] += 1
+            # A handler that did not wait for anything would otherwise keep
+            # the loop until the queue is empty.
+            await asyncio.sleep(0)
+
+    def close(self):
+        """
+        Stops the worker. Frames still queued are dropped.
+        """
+
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        self._worker = None
+        if self._frames:
+            logger.warning("Dropping {} queued frames".format(len(self._frames)))
+            self.counters["dropped"] += len(self._frames)
+            self._frames.clear()
@@ -0,0 +1,244 @@
+import re
+import xml.etree.ElementTree as ET
+from html import unescape
+
+# This dictionary contains the fields we are interested in for every known frame.
+#
+# It contains the following information:
+# (<root tag>, <type attribute>): (<path of a field relative to the root>, ...)
+#
+# Frames of other types have all of their fields extracted.
+FIELDS = {
+    ("request", "job"): (
+        "externalid",
+        "systemdata/datetime",
+        "systemdata/timestamp",
+        "jobdata/priority",
+        "jobdata/messages/messageuui",
+        "senderdata/address",
+        "senderdata/name",
+        "senderdata/location",
+        "persondata/address",
+    ),
+    ("response", "job"): (
+        "externalid",
+        "jobdata/status",
+    ),
+    ("request", "systeminfo"): (
+        "senderdata/address",
+    ),
+    ("request", "login"): (
+        "logindata/status",
+        "senderdata/address",
+    ),
+    ("request", "alarm"): (
+        "alarmdata/type",
+        "rssidata/rfpi",
+        "rssidata/rssi",
+        "senderdata/address",
+    ),
+}
+
+
+# The root element of a frame. Everything behind its opening tag is its body.
+# The XML declaration does not match.
+_root = re.compile(rb"<([\w.-]+)([^>]*)>")
+_attribute = re.compile(rb'([\w.-]+)\s*=\s*"([^"]*)"')
+
+# Every match of the generic tokenizer used for unknown frames is one of:
+# * a leaf without attributes:  <name>text</name>
+# * an opening tag:             <name attributes>text  (or <name attributes/>)
+# * a closing tag:              </name>
+_token = re.compile(rb"<([\w.-]+)>([^<]*)</\1>|<([\w.-]+)([^>]*?)(/?)>([^<]*)|</([\w.-]+)>")
+
+
+def _text(value):
+    if b"&" in value:
+        return unescape(value.decode("UTF-8"))
+    return value.decode("UTF-8")
+
+
+def _alternatives(names):
+    return b"|".join(re.escape(name.encode("UTF-8")) for name in sorted(names))
+
+
+class _Plan():
+
+    """
+    Precompiled extraction of a set of paths from a frame.
+
+    A single regular expression matches the leaves we are interested in and the
+    opening and closing tags of the containers on their paths. Everything
+    else is skipped by the regular expression engine. A leaf inside a
+    container that is not on any path is seen at the level of its closest
+    known container, and is therefore not mixed up with a wanted field.
+
+    The regular expression only understands plain leaves. Frames with CDATA
+    sections, or with a wanted leaf it could not match although its tag is
+    there (e.g. "</address >"), are parsed with ElementTree instead.
+    """
+
+    def __init__(self, paths):
+        leaves = set()
+        containers = set()
+        for path in paths:
+            parts = path.split("/")
+            leaves.add(parts[-1])
+            containers.update(parts[:-1])
+
+        self._paths = {path.encode("UTF-8"): path for path in paths}
+        # (path, opening tag of its leaf) to check for leaves not matched.
+        self._leaves = [(path, b"<" + path.rsplit("/", 1)[-1].encode("UTF-8")) for path in paths]
+        self._token = None
+        if leaves:
+            pattern = rb"<(" + _alternatives(leaves) + rb")(?:\s[^>]*?)?(?:/>|>([^<]*)</\1>)"
+            if containers:
+                pattern += (
+                    rb"|<(" + _alternatives(containers) + rb")(?:\s[^>]*?)?(/?)>"
+                    rb"|</(" + _alternatives(containers) + rb")>")
+            else:
+                pattern += rb"()()()"
+            self._token = re.compile(pattern)
+
+    def extract(self, data, start, fields):
+        if self._token is None:
+            return
+
+        paths = self._paths
+        # Path prefixes of the currently open containers, e.g. b"jobdata/".
+        prefixes = [b""]
+        for leaf, text, opened, empty, closed in self._token.findall(data, start):
+            if leaf:
+                path = paths.get(prefixes[-1] + leaf)
+                if path is not None:
+                    fields.setdefault(path, []).append(_text(text))
+            elif opened:
+                if not empty:
+                    prefixes.append(prefixes[-1] + opened + b"/")
+            elif len(prefixes) > 1:
+                prefixes.pop()
+
+    def needs_tree(self, data, fields):
+        """
+        Returns True if extract() may have missed some fields of data.
+        """
+
+        if b"<![CDATA[" in data:
+            return True
+        return any(path not in fields and leaf in data for path, leaf in self._leaves)
+
+    def extract_tree(self, data, fields):
+        """
+        Extracts the fields of data with ElementTree. Returns False if data
+        is not well-formed, fields are left untouched then.
+        """
+
+        try:
+            root = ET.fromstring(data.rstrip(b"\0"))
+        except ET.ParseError:
+            return False
+        fields.clear()
+        for path, _ in self._leaves:
+            values = [element.text or "" for element in root.findall(path)]
+            if values:
+                fields[path] = values
+        return True
+
+
+_plans = {key: _Plan(paths) for key, paths in FIELDS.items()}
+
+
+class Frame():
+
+    """
+    This class represents a single frame received from a BaseStation.
+
+    Frames are parsed directly from the raw bytes of a datagram. For known
+    frames only the fields listed in FIELDS are extracted, in a single pass
+    over the frame with a regular expression precompiled for these paths.
+    Fields are addressed by their path relative to the root element, e.g.
+    "jobdata/status".
+    """
+
+    __slots__ = ("tag", "type", "attrib", "_fields")
+
+    def __init__(self, tag, attrib, fields):
+        self.tag = tag
+        self.attrib = attrib
+        self.type = attrib.get("type")
+        self._fields = fields
+
+    def findtext(self, path, default=None):
+        """
+        Returns the text of the first field at path.
+        Empty fields return an empty String, missing fields return default.
+        """
+
+        values = self._fields.get(path)
+        if values:
+            return values[0]
+        return default
+
+    def findall(self, path):
+        """
+        Returns the texts of all fields at path.
+        """
+
+        return self._fields.get(path, [])
+
+    @classmethod
+    def parse(cls, data):
+        """
+        Parses the raw bytes of a single frame.
+
+        Raises ValueError if data does not contain an XML element.
+        """
+
+        root = _root.search(data)
+        if root is None:
+            raise ValueError("Frame does not contain an XML element")
+
+        tag = root.group(1).decode("UTF-8")
+        attrib = {k.decode("UTF-8"): _text(v) for k, v in _attribute.findall(root.group(2))}
+
+        fields = {}
+        plan = _plans.get((tag, attrib.get("type")))
+        if plan is not None:
+            plan.extract(data, root.end(), fields)
+            if plan.needs_tree(data, fields):
+                plan.extract_tree(data, fields)
+        else:
+            cls._extract_all(data[root.end():], fields)
+        return cls(tag, attrib, fields)
+
+    @staticmethod
+    def _extract_all(body, fields):
+        """
+        Extracts all fields of a frame of unknown type.
+        """
+
+        # Path prefixes of the currently open elements, e.g. "jobdata/".
+        prefixes = [""]
+        # Path and text of the last opened element. If it is closed right away
+        # it is a leaf with attributes.
+        pending = None
+
+        for leaf, text, opened, attrs, empty, opened_text, closed in _token.findall(body):
+            if not prefixes:
+                break
+            if leaf:
+                fields.setdefault(prefixes[-1] + leaf.decode("UTF-8"), []).append(_text(text))
+                pending = None
+            elif opened:
+                path = prefixes[-1] + opened.decode("UTF-8")
+                if empty:
+                    fields.setdefault(path, []).append("")
+                    pending = None
+                else:
+                    prefixes.append(path + "/")
+                    pending = (path, opened_text)
+            else:
+                if pending is not None:
+                    fields.setdefault(pending[0], []).append(_text(pending[1]))
+                    pending = None
+                prefixes.pop()
@@ -0,0 +1,62 @@
+import logging
+import json
+logger = logging.getLogger(__name__)
+
+class Groups():
+
+    """
+    This class resolves the names of groups to the extensions of their
+    members.
+
+    Groups are read from a JSON file, mapping the name of every group to the
+    extensions of its members:
+    | {"900": ["101", "102", "105"], "security": ["101", "102"], "910": "*"}
+    A group with the members "*" is sent to every handset that is located
+    right now. The group ALL ("all") is always defined this way.
+
+    Handsets send to a group by addressing its name, so groups meant for
+    handsets need numbers as names.
+    """
+
+    ALL = "all"
+    EVERYONE = "*"
+
+    def __init__(self, path=None):
+        # name => list of extensions or EVERYONE
+        self._groups = {Groups.ALL: Groups.EVERYONE}
+        if path is not None:
+            self.load(path)
+
+    def load(self, path):
+        """
+        Reads the groups from the JSON file at path.
+        Raises ValueError if the file is not valid.
+        """
+
+        with open(path) as f:
+            groups = json.load(f)
+        if not isinstance(groups, dict):
+            raise ValueError("{} does not contain an object".format(path))
+        for name, members in groups.items():
+            if members == Groups.EVERYONE:
+                continue
+            if not isinstance(members, list) or not all(isinstance(m, str) for m in members):
+                raise ValueError('Members of group {} in {} are neither a list of extensions nor "*"'.format(name, path))
+        self._groups.update(groups)
+        logger.info("Loaded {} groups from {}".format(len(groups), path))
+
+    def __contains__(self, name):
+        return name in self._groups
+
+    def resolve(self, name, roaming_monitor):
+        """
+        Returns the extensions of the members of the group name or None if
+        there is no such group.
+        """
+
+        members = self._groups.get(name)
+        if members == Groups.EVERYONE:
+            return roaming_monitor.numbers()
+        if members is None:
+            return None
+        return list(members)
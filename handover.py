@@ -0,0 +1,95 @@
+import logging
+import asyncio
+import os
+import socket
+logger = logging.getLogger(__name__)
+
+_REQUEST = b"handover"
+
+class HandoverServer():
+
+    """
+    This class hands the UDP socket of a running server over to its
+    successor, so the port stays bound during a restart.
+
+    The successor connects to a Unix socket at path (see take_over()). The
+    running server then stops reading from its UDP socket and drains: drain
+    is called to close the drivers (writing the journal and the locations)
+    and the listeners the successor is going to bind, e.g. of the metrics.
+    Afterwards the UDP socket is passed to the successor (SCM_RIGHTS) and
+    done is called. Datagrams arriving meanwhile wait in the socket for the
+    successor.
+    """
+
+    def __init__(self, path, transport, drain, done):
+        self._path = path
+        self._transport = transport
+        self._drain = drain
+        self._done = done
+        self._server = None
+        self._handed_over = False
+
+    async def start(self):
+        # A left-over socket of a crashed or handed over server.
+        if os.path.exists(self._path):
+            os.remove(self._path)
+        self._server = await asyncio.start_unix_server(self._handle, self._path)
+        logger.info("Waiting for a successor on {}".format(self._path))
+
+    def close(self):
+        if self._server is None:
+            return
+        self._server.close()
+        self._server = None
+        # After a handover, the path belongs to the successor.
+        if not self._handed_over:
+            try:
+                os.remove(self._path)
+            except FileNotFoundError:
+                pass
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readexactly(len(_REQUEST)), 5)
+            if request != _REQUEST or self._handed_over:
+                raise OSError("unexpected request")
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, OSError) as exp:
+            logger.warning("Ignoring handover request: {}".format(exp))
+            writer.close()
+            return
+
+        logger.info("Handing the UDP socket over to a successor")
+        self._handed_over = True
+        self._transport.pause_reading()
+        self._drain()
+        try:
+            # The transports only expose a restricted view of their sockets.
+            with socket.fromfd(writer.get_extra_info("socket").fileno(), socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                socket.send_fds(sock, [_REQUEST], [self._transport.get_extra_info("socket").fileno()])
+        except OSError as exp:
+            # The drivers are closed already, there is no way back.
+            logger.error("Failed to hand over the UDP socket: {}".format(exp))
+        finally:
+            writer.close()
+        self._done()
+
+
+def take_over(path, timeout=30):
+    """
+    Asks the server listening at path for its UDP socket. Returns the socket.
+
+    The predecessor has closed its drivers once this returns, so its journal
+    and locations can be loaded.
+    """
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(_REQUEST)
+        message, fds, _, _ = socket.recv_fds(sock, len(_REQUEST), 1)
+        if message != _REQUEST or not fds:
+            raise OSError("{} did not hand over a socket".format(path))
+    udp_socket = socket.socket(fileno=fds[0])
+    udp_socket.setblocking(False)
+    logger.info("Took over UDP socket bound to {}".format(udp_socket.getsockname()))
+    return udp_socket
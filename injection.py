@@ -0,0 +1,254 @@
+import logging
+import asyncio
+import json
+import os
+import re
+import time
+from messagesystem import Message, Broadcast
+logger = logging.getLogger(__name__)
+
+class InjectionServer():
+
+    """
+    This class lets local applications (e.g. alarm or ticketing systems)
+    send text messages to handsets, over HTTP on the event loop of the server.
+
+    Messages are posted in batches to /messages as JSON:
+    | {"messages": [
+    |     {"to": ["42", "23"], "text": "Fire alarm in building 3", "priority": 1},
+    |     {"to": "42", "text": "Ticket #1234 assigned to you"},
+    |     {"group": "security", "text": "Fire alarm in building 3"}
+    | ]}
+    Every entry is sent to each of its recipients, or to all members of a
+    group (see groups.Groups) as a single Broadcast. The priority is optional
+    (default 0). A batch is validated as a whole and either queued
+    completely or not at all.
+
+    Answers:
+    * 202: All messages are queued (and written to the journal, if any).
+      The body holds the number of messages queued.
+    * 400: The batch is invalid. Nothing has been queued.
+    * 500: The batch is queued, but was not written to the journal within
+      commit_timeout seconds (e.g. while the disk is full). It is still
+      written once possible, so sending it again may duplicate it.
+    * 503: The outbox does not have room for the batch, even after waiting
+      for wait seconds. Nothing has been queued. Retry later.
+    """
+
+    # Characters XML 1.0 does not allow. \0 would also end the frame.
+    _invalid = re.compile("[^\t\n\r\x20-\ud7ff\ue000-\ufffd\U00010000-\U0010ffff]")
+
+    def __init__(self, message_system, sender="server", max_batch=100000, max_body=16*1024*1024, wait=5,
+                 commit_timeout=30):
+        """
+        Creates a new InjectionServer queuing messages in message_system.
+
+        Injected messages are sent with the sender address and name sender.
+        Batches may contain at most max_batch messages (counting every
+        recipient) and max_body bytes.
+        """
+
+        self._message_system = message_system
+        self._sender = sender
+        self._max_batch = max_batch
+        self._max_body = max_body
+        self._wait = wait
+        self._commit_timeout = commit_timeout
+        self._server = None
+        self._path = None
+
+    async def start(self, host="127.0.0.1", port=9131):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info("Accepting messages on {}".format(self._server.sockets[0].getsockname()))
+
+    async def start_unix(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        self._server = await asyncio.start_unix_server(self._handle, path)
+        self._path = path
+        logger.info("Accepting messages on {}".format(path))
+
+    def close(self):
+        if self._server is None:
+            return
+        self._server.close()
+        self._server = None
+        if self._path is not None:
+            try:
+                os.remove(self._path)
+            except FileNotFoundError:
+                pass
+
+    def parse_batch(self, data):
+        """
+        Validates a batch in JSON.
+        Returns a list of (recipients, group, text, priority) or raises
+        ValueError. group is None for entries sent to a list of recipients.
+        """
+
+        try:
+            batch = json.loads(data)
+        except ValueError as exp:
+            raise ValueError("Invalid JSON: {}".format(exp))
+        if not isinstance(batch, dict) or not isinstance(batch.get("messages"), list):
+            raise ValueError('Expected an object with a list "messages"')
+
+        entries = []
+        count = 0
+        for i, entry in enumerate(batch["messages"]):
+            if not isinstance(entry, dict):
+                raise ValueError("Message {} is not an object".format(i))
+            group = entry.get("group")
+            if group is not None:
+                if "to" in entry:
+                    raise ValueError('Message {}: "to" and "group" are mutually exclusive'.format(i))
+                recipients = self._message_system.resolve(group) if isinstance(group, str) else None
+                if recipients is None:
+                    raise ValueError("Message {}: Unknown group {}".format(i, group))
+            else:
+                recipients = entry.get("to")
+                if isinstance(recipients, str):
+                    recipients = [recipients]
+                if (not isinstance(recipients, list) or not recipients
+                        or not all(isinstance(r, str) and r.isascii() and r.isdigit() for r in recipients)):
+                    raise ValueError('Message {}: "to" must be an extension or a non-empty list of extensions'.format(i))
+            text = entry.get("text")
+            if not isinstance(text, str) or not text:
+                raise ValueError('Message {}: "text" must be a non-empty string'.format(i))
+            if InjectionServer._invalid.search(text):
+                raise ValueError('Message {}: "text" contains characters not allowed in XML'.format(i))
+            priority = entry.get("priority", 0)
+            if not isinstance(priority, int) or isinstance(priority, bool) or priority < 0:
+                raise ValueError('Message {}: "priority" must be a non-negative integer'.format(i))
+            count += len(recipients)
+            if count > self._max_batch:
+                raise ValueError("Batches are limited to {} messages".format(self._max_batch))
+            entries.append((recipients, group, text, priority))
+        return entries
+
+    def build(self, entries, now=None):
+        """
+        Creates the Messages for validated entries.
+        Returns a tuple of the Messages and a list of (Broadcast, recipients).
+        """
+
+        now = time.time() if now is None else now
+        # These are the same for the whole batch.
+        datetime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now))
+        timestamp = "{:08x}".format(int(now))
+        sender = self._sender
+        messages = [
+            Message(None, text, sender, sender, sender, recipient, datetime, timestamp, priority, created=now)
+            for recipients, group, text, priority in entries if group is None
+            for recipient in recipients
+        ]
+        broadcasts = [
+            (Broadcast(None, text, sender, sender, sender, datetime, timestamp, priority, group, created=now), recipients)
+            for recipients, group, text, priority in entries if group is not None
+        ]
+        return messages, broadcasts
+
+    async def inject(self, messages, broadcasts=()):
+        """
+        Queues messages and broadcasts (see build()), waiting up to wait
+        seconds for room in the outbox. Returns False if there is no room, or
+        True once they are queued and written to the journal.
+
+        Raises asyncio.TimeoutError if they are queued, but not written to
+        the journal within commit_timeout seconds.
+        """
+
+        count = len(messages) + sum(len(recipients) for _, recipients in broadcasts)
+        deadline = time.monotonic() + self._wait
+        while True:
+            room = self._message_system.room()
+            if room is None or room >= count:
+                break
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.1)
+
+        committed = asyncio.get_event_loop().create_future()
+
+        def callback():
+            if not committed.done():
+                committed.set_result(True)
+
+        # Records are committed in order, so the last callback is enough.
+        self._message_system.enqueue(messages, None if broadcasts else callback)
+        for i, (broadcast, recipients) in enumerate(broadcasts):
+            self._message_system.broadcast(broadcast, recipients, callback if i == len(broadcasts) - 1 else None)
+        await asyncio.wait_for(committed, self._commit_timeout)
+        return True
+
+    async def _handle(self, reader, writer):
+        try:
+            status, body = await self._request(reader)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError) as exp:
+            status, body = 400, {"error": "Malformed request: {}".format(exp)}
+
+        data = json.dumps(body).encode("UTF-8")
+        headers = "HTTP/1.0 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n".format(
+            status, _REASONS[status], len(data))
+        if status == 503:
+            headers += "Retry-After: 1\r\n"
+        try:
+            writer.write(headers.encode("ASCII") + b"\r\n" + data)
+            await writer.drain()
+        except ConnectionError as exp:
+            logger.debug("Injection request failed: {}".format(exp))
+        finally:
+            writer.close()
+
+    async def _request(self, reader):
+        # Returns (status, body) for a request.
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        method, path = request_line.decode("ASCII").split()[:2]
+        length = None
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("ASCII").partition(":")
+            if name.strip().lower() == "content-length":
+                length = int(value)
+
+        if path != "/messages":
+            return 404, {"error": "Not found"}
+        if method != "POST":
+            return 405, {"error": "Only POST is supported"}
+        if length is None:
+            return 411, {"error": "Content-Length is required"}
+        if length > self._max_body:
+            return 413, {"error": "Batches are limited to {} bytes".format(self._max_body)}
+
+        data = await asyncio.wait_for(reader.readexactly(length), 30)
+        try:
+            entries = self.parse_batch(data)
+        except ValueError as exp:
+            return 400, {"error": str(exp)}
+
+        messages, broadcasts = self.build(entries)
+        queued = len(messages) + sum(len(recipients) for _, recipients in broadcasts)
+        try:
+            injected = await self.inject(messages, broadcasts)
+        except asyncio.TimeoutError:
+            logger.error("A batch of %s injected messages was not written to the journal within %s s",
+                         queued, self._commit_timeout)
+            return 500, {"error": "Queued, but not written to the journal yet"}
+        if not injected:
+            logger.warning("Outbox is full. Rejecting a batch of %s injected messages", queued)
+            return 503, {"error": "The outbox is full"}
+        return 202, {"queued": queued}
+
+
+_REASONS = {
+    202: "Accepted",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
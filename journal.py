@@ -0,0 +1,393 @@
+import logging
+import asyncio
+import os
+import struct
+import threading
+import zlib
+from messagesystem import Message, Broadcast
+logger = logging.getLogger(__name__)
+
+class Journal():
+
+    """
+    This class implements an append-only on-disk journal of the outbox.
+
+    Every change of the outbox is written as a record:
+    * ENQUEUE: A message has been accepted (with all of its fields)
+    * ATTEMPT: A message has been sent to its recipient
+    * DELIVERED: A message has been removed after a reception confirmation
+    * EXPIRED: A message has been removed because it was too old
+    * BROADCAST: A broadcast has been accepted (with its shared fields once
+      and the id, last send try and extension of every recipient)
+
+    Records are collected and written in batches, followed by a single fsync
+    (group commit). Callbacks passed along with a record are called once the
+    record is on disk. The journal is compacted by rewriting it with the
+    messages still queued once it contains mostly obsolete records.
+
+    A record on disk consists of a header (kind, length of payload, CRC32
+    of payload) followed by its payload. A torn record at the end of the file
+    (e.g. after a crash) is discarded during recovery.
+
+    A batch that can not be written (e.g. while the disk is full) is cut off
+    the file again and retried, with the records queued meanwhile, until it
+    is on disk. Its callbacks are called only then.
+    """
+
+    ENQUEUE = 1
+    ATTEMPT = 2
+    DELIVERED = 3
+    EXPIRED = 4
+    BROADCAST = 5
+
+    _magic = b"SNOMJRN1"
+    _header = struct.Struct("<BII")
+    # internal id, created, last send try. Followed by the \0-separated fields.
+    _enqueue = struct.Struct("<Qdd")
+    _attempt = struct.Struct("<Qd")
+    _remove = struct.Struct("<Q")
+    # created, number of recipients. Followed by id and last send try of every
+    # recipient, the \0-separated fields and the extensions of the recipients.
+    _broadcast = struct.Struct("<dI")
+    _recipient = struct.Struct("<Qd")
+
+    # Records written before messages had a priority lack the last field.
+    _fields = ("ext_id", "message", "from_name", "from_ext", "from_loc", "to_ext", "sysdata_datetime", "sysdata_ts", "priority")
+    _broadcast_fields = ("ext_id", "message", "from_name", "from_ext", "from_loc", "sysdata_datetime", "sysdata_ts",
+                         "priority", "group")
+
+    # Seconds to wait before writing a failed batch again, doubled up to
+    # _max_retry_delay while the writes keep failing.
+    _retry_delay = 0.5
+    _max_retry_delay = 30
+
+    def __init__(self, path, commit_delay=0.005, compact_min=10000):
+        """
+        Creates a new Journal stored in the file at path.
+
+        Records are collected for commit_delay seconds before being written.
+        The journal is compacted once it contains more than compact_min
+        records and less than half of them belong to queued messages.
+        """
+
+        self._path = path
+        self._commit_delay = commit_delay
+        self._compact_min = compact_min
+
+        self._file = None
+        # End of the last record known to be complete. Anything behind it
+        # is left of a failed write and cut off before the next one.
+        self._end = 0
+        self._torn = False
+        # Serializes all access to the file between the event loop and the
+        # executor running the writes.
+        self._lock = threading.Lock()
+        self._records = 0
+
+        self._pending = []
+        self._callbacks = []
+        # The batch currently written by the executor, and its callbacks.
+        self._inflight = []
+        self._inflight_callbacks = []
+        self._commit_task = None
+        self._outbox = None
+
+    def recover(self):
+        """
+        Reads the journal and returns all messages that are still to be
+        delivered, with their last send try restored.
+
+        The journal is opened for appending afterwards.
+        """
+
+        messages = {}
+        records = 0
+
+        try:
+            with open(self._path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+
+        if data and not data.startswith(Journal._magic):
+            raise ValueError("{} is not a journal".format(self._path))
+
+        # Local names keep this loop fast enough for large outboxes.
+        unpack_header = Journal._header.unpack_from
+        header_size = Journal._header.size
+        unpack_enqueue = Journal._enqueue.unpack_from
+        enqueue_size = Journal._enqueue.size
+        unpack_attempt = Journal._attempt.unpack_from
+        unpack_remove = Journal._remove.unpack_from
+        unpack_broadcast = Journal._broadcast.unpack_from
+        broadcast_size = Journal._broadcast.size
+        unpack_recipient = Journal._recipient.unpack_from
+        recipient_size = Journal._recipient.size
+        enqueue_fields = len(Journal._fields)
+        broadcast_fields = len(Journal._broadcast_fields)
+        crc32 = zlib.crc32
+        view = memoryview(data)
+        end = len(data)
+
+        pos = valid = len(Journal._magic)
+        while pos + header_size <= end:
+            kind, length, crc = unpack_header(data, pos)
+            start = pos + header_size
+            pos = start + length
+            if pos > end or crc32(view[start:pos]) != crc:
+                break
+            valid = pos
+            records += 1
+
+            if kind == Journal.ENQUEUE:
+                internal_ext_id, created, last_send_try = unpack_enqueue(data, start)
+                fields = data[start + enqueue_size:pos].decode("UTF-8").split("\0")
+                if not enqueue_fields - 1 <= len(fields) <= enqueue_fields:
+                    logger.warning("Skipping message %s with %s fields in %s", internal_ext_id, len(fields), self._path)
+                    continue
+                message = Message(*fields, internal_ext_id=internal_ext_id, created=created)
+                message.last_send_try = last_send_try
+                messages[internal_ext_id] = message
+            elif kind == Journal.ATTEMPT:
+                internal_ext_id, last_send_try = unpack_attempt(data, start)
+                message = messages.get(internal_ext_id)
+                if message is not None:
+                    message.last_send_try = last_send_try
+            elif kind == Journal.BROADCAST:
+                created, count = unpack_broadcast(data, start)
+                offset = start + broadcast_size
+                fields = data[offset + count * recipient_size:pos].decode("UTF-8").split("\0")
+                if len(fields) != broadcast_fields + count:
+                    logger.warning("Skipping broadcast with %s fields for %s recipients in %s", len(fields), count,
+                                   self._path)
+                    continue
+                broadcast = Broadcast(*fields[:broadcast_fields], created=created)
+                for i, to_ext in enumerate(fields[broadcast_fields:]):
+                    internal_ext_id, last_send_try = unpack_recipient(data, offset + i * recipient_size)
+                    message = broadcast.add(to_ext, internal_ext_id)
+                    message.last_send_try = last_send_try
+                    messages[internal_ext_id] = message
+            else:
+                message = messages.pop(unpack_remove(data, start)[0], None)
+                if message is not None and message.broadcast is not None:
+                    message.broadcast.finish(kind == Journal.DELIVERED)
+
+        view.release()
+
+        if valid < len(data):
+            logger.warning("Discarding %s bytes of incomplete records at the end of %s", len(data) - valid, self._path)
+
+        # Unbuffered, so a failed write can be cut off reliably.
+        self._file = open(self._path, "r+b" if data else "wb", buffering=0)
+        if data:
+            self._file.truncate(valid)
+            self._end = valid
+        else:
+            self._file.write(Journal._magic)
+            os.fsync(self._file.fileno())
+            self._end = len(Journal._magic)
+        self._records = records
+
+        logger.info("Recovered %s queued messages from %s records in %s", len(messages), records, self._path)
+        return list(messages.values())
+
+    def attach(self, outbox):
+        """
+        Attaches the outbox.Outbox this journal belongs to. Its messages are
+        used to compact the journal.
+        """
+
+        self._outbox = outbox
+
+    def close(self):
+        """
+        Writes all pending records and closes the journal.
+
+        The callbacks of all records that were not committed yet are called
+        once they are written.
+        """
+
+        if self._commit_task is not None:
+            self._commit_task.cancel()
+            self._commit_task = None
+        records, self._pending = self._pending, []
+        callbacks = self._inflight_callbacks + self._callbacks
+        self._inflight_callbacks, self._callbacks = [], []
+        with self._lock:
+            if self._file is None:
+                return
+            try:
+                # The batch in flight is older than the pending records.
+                self._write_locked(self._inflight)
+                self._write_locked(records)
+            except OSError as exp:
+                # The senders of these messages are not confirmed, so they
+                # send them again.
+                logger.error("Failed to write %s records to journal: %s", len(self._inflight) + len(records), exp)
+                callbacks = []
+            self._file.close()
+            self._file = None
+        self._run_callbacks(callbacks)
+
+    @staticmethod
+    def _run_callbacks(callbacks):
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as exp:
+                logger.warning("Journal commit callback {} failed with exception {}.".format(callback, exp))
+
+    @staticmethod
+    def _record(kind, payload):
+        return Journal._header.pack(kind, len(payload), zlib.crc32(payload)) + payload
+
+    @staticmethod
+    def _join(fields):
+        # \0 separates the fields, so it is dropped from them. Otherwise a
+        # single field containing it would shift all following ones.
+        return "\0".join("" if f is None else str(f).replace("\0", "") for f in fields)
+
+    @staticmethod
+    def _enqueue_record(message):
+        fields = Journal._join(getattr(message, f) for f in Journal._fields)
+        return Journal._record(
+            Journal.ENQUEUE,
+            Journal._enqueue.pack(message.internal_ext_id, message.created, message.last_send_try) + fields.encode("UTF-8"),
+        )
+
+    @staticmethod
+    def _broadcast_record(broadcast, recipients):
+        fields = [getattr(broadcast, f) for f in Journal._broadcast_fields]
+        fields = Journal._join(fields + [r.to_ext for r in recipients])
+        pack_recipient = Journal._recipient.pack
+        return Journal._record(
+            Journal.BROADCAST,
+            Journal._broadcast.pack(broadcast.created, len(recipients))
+            + b"".join(pack_recipient(r.internal_ext_id, r.last_send_try) for r in recipients)
+            + fields.encode("UTF-8"),
+        )
+
+    def enqueue(self, message, callback=None):
+        self._append(Journal._enqueue_record(message), callback)
+
+    def broadcast(self, broadcast, recipients, callback=None):
+        self._append(Journal._broadcast_record(broadcast, recipients), callback)
+
+    def attempt(self, message):
+        self._append(Journal._record(Journal.ATTEMPT, Journal._attempt.pack(message.internal_ext_id, message.last_send_try)))
+
+    def delivered(self, internal_ext_id):
+        self._append(Journal._record(Journal.DELIVERED, Journal._remove.pack(internal_ext_id)))
+
+    def expired(self, internal_ext_id):
+        self._append(Journal._record(Journal.EXPIRED, Journal._remove.pack(internal_ext_id)))
+
+    def _append(self, record, callback=None):
+        self._pending.append(record)
+        if callback is not None:
+            self._callbacks.append(callback)
+        if self._commit_task is None:
+            self._commit_task = asyncio.get_event_loop().create_task(self._commit())
+
+    async def _commit(self):
+        loop = asyncio.get_event_loop()
+        retry_delay = Journal._retry_delay
+        try:
+            while self._pending:
+                # Give a burst of records the chance to end up in the same batch.
+                await asyncio.sleep(self._commit_delay)
+
+                self._inflight, self._pending = self._pending, []
+                self._inflight_callbacks, self._callbacks = self._callbacks, []
+                try:
+                    await loop.run_in_executor(None, self._write, self._inflight)
+                except OSError as exp:
+                    logger.error("Failed to write %s records to journal: %s. Retrying in %s s",
+                                 len(self._inflight), exp, retry_delay)
+                    # The failed batch is older than the records queued meanwhile.
+                    self._pending = self._inflight + self._pending
+                    self._callbacks = self._inflight_callbacks + self._callbacks
+                    self._inflight, self._inflight_callbacks = [], []
+                    await asyncio.sleep(retry_delay)
+                    retry_delay = min(Journal._max_retry_delay, 2 * retry_delay)
+                    continue
+                retry_delay = Journal._retry_delay
+
+                callbacks, self._inflight_callbacks = self._inflight_callbacks, []
+                self._run_callbacks(callbacks)
+
+                if self._outbox is not None and self._records > max(self._compact_min, 2 * len(self._outbox)):
+                    # Records still pending describe changes that are already
+                    # part of the snapshot. Replaying them is harmless.
+                    snapshot = self._snapshot()
+                    try:
+                        await loop.run_in_executor(None, self._rewrite, snapshot)
+                    except OSError as exp:
+                        logger.error("Failed to compact journal: %s", exp)
+        finally:
+            self._commit_task = None
+
+    def _snapshot(self):
+        records = []
+        # Broadcast => its recipients still queued
+        broadcasts = {}
+        for message in self._outbox:
+            if message.broadcast is None:
+                records.append(Journal._enqueue_record(message))
+            else:
+                broadcasts.setdefault(message.broadcast, []).append(message)
+        for broadcast, recipients in broadcasts.items():
+            records.append(Journal._broadcast_record(broadcast, recipients))
+        return records
+
+    def _write(self, records):
+        with self._lock:
+            self._write_locked(records)
+
+    def _write_locked(self, records):
+        # Batches are emptied once written, so close() does not write them twice.
+        if self._file is None or not records:
+            return
+        data = memoryview(b"".join(records))
+        try:
+            if self._torn:
+                # Recovery would discard all records behind a torn one.
+                self._file.truncate(self._end)
+                self._torn = False
+            self._file.seek(self._end)
+            written = 0
+            while written < len(data):
+                written += self._file.write(data[written:])
+            os.fsync(self._file.fileno())
+        except OSError:
+            self._torn = True
+            raise
+        self._end += len(data)
+        self._records += len(records)
+        del records[:]
+
+    def _rewrite(self, records):
+        tmp_path = self._path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(Journal._magic)
+            f.write(b"".join(records))
+            f.flush()
+            os.fsync(f.fileno())
+
+        with self._lock:
+            if self._file is None:
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, self._path)
+            directory = os.open(os.path.dirname(os.path.abspath(self._path)), os.O_RDONLY)
+            try:
+                os.fsync(directory)
+            finally:
+                os.close(directory)
+            self._file.close()
+            self._file = open(self._path, "r+b", buffering=0)
+            self._end = len(Journal._magic) + sum(len(record) for record in records)
+            self._torn = False
+            self._records = len(records)
+
+        logger.info("Compacted journal to %s records", len(records))
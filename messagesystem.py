@@ -1,138 +1,303 @@
 import logging
 import asyncio
-import xml.etree.ElementTree as ET
 import random
+import sys
 import time
+from outbox import Outbox
+from retry import RetryPolicy
+from dedup import DedupCache
+from pacing import SendScheduler
+from metrics import Counter, Histogram
+from groups import Groups
+from sharding import shard_of
+from templates import JOB_REQUEST, JOB_RESPONSE
 logger = logging.getLogger(__name__)
 
+def _intern(value):
+    return None if value is None else sys.intern(value)
+
+
 class Message():
 
     """
     This class encapsulates a Text-Message with it's metadata.
+
+    Messages may stay queued for days, so they are kept compact: There is no
+    per-instance __dict__ and the extensions, names and locations, which are
+    the same for many messages, are interned.
+
+    Every message belongs to a lane, depending on its priority: Messages with
+    a priority above 0 are URGENT, all others NORMAL.
     """
 
-    def __init__(self, xml_message):
+    NORMAL = "normal"
+    URGENT = "urgent"
+
+    # Messages are sent to a single recipient, see Recipient.
+    broadcast = None
+
+    __slots__ = (
+        "created", "last_send_try", "ext_id", "message", "from_name", "from_ext", "from_loc",
+        "to_ext", "sysdata_datetime", "sysdata_ts", "priority", "internal_ext_id", "_datagram",
+    )
+
+    def __init__(self, ext_id, message, from_name, from_ext, from_loc, to_ext,
+                 sysdata_datetime, sysdata_ts, priority=0, internal_ext_id=None, created=None):
         """
-        Creates a Message from it's XML-Element-Tree representation.
+        Creates a Message from its fields.
+
+        priority may also be given as string, as found in a frame.
+
+        internal_ext_id and created are only passed in when restoring a
+        message that has been queued before.
         """
 
-        self.created = time.time()
+        self.created = time.time() if created is None else created
         self.last_send_try = 0
 
-        self._xml_message = xml_message
-
-        self.ext_id = xml_message.find("./externalid").text
-        self.message = xml_message.find("./jobdata/messages/messageuui").text
-        self.from_name = xml_message.find("./senderdata/name").text
-        self.from_ext = xml_message.find("./senderdata/address").text
-        self.from_loc = xml_message.find("./senderdata/location").text
-        self.to_ext = xml_message.find("./persondata/address").text
-        self.sysdata_datetime = xml_message.find("./systemdata/datetime").text
-        self.sysdata_ts = xml_message.find("./systemdata/timestamp").text
+        self.ext_id = ext_id
+        self.message = message
+        self.from_name = _intern(from_name)
+        self.from_ext = _intern(from_ext)
+        self.from_loc = _intern(from_loc)
+        self.to_ext = _intern(to_ext)
+        self.sysdata_datetime = sysdata_datetime
+        self.sysdata_ts = sysdata_ts
+        try:
+            self.priority = int(priority or 0)
+        except ValueError:
+            self.priority = 0
 
         # This 10-Digit random number will be used as ID, when re-sending
         # the message to it's recipient.
-        self.internal_ext_id = random.randrange(9999999999+1)
+        if internal_ext_id is None:
+            internal_ext_id = random.randrange(9999999999+1)
+        self.internal_ext_id = internal_ext_id
+
+        self._datagram = None
+
+    @classmethod
+    def from_frame(cls, frame):
+        """
+        Creates a Message from a received job frames.Frame.
+        """
+
+        return cls(
+            frame.findtext("externalid"),
+            frame.findtext("jobdata/messages/messageuui"),
+            frame.findtext("senderdata/name"),
+            frame.findtext("senderdata/address"),
+            frame.findtext("senderdata/location"),
+            frame.findtext("persondata/address"),
+            frame.findtext("systemdata/datetime"),
+            frame.findtext("systemdata/timestamp"),
+            frame.findtext("jobdata/priority"),
+        )
+
+    @property
+    def lane(self):
+        return Message.URGENT if self.priority > 0 else Message.NORMAL
 
     def get_messageresponse(self):
         """
         This function creates a 'received confirmation' for a received message.
-        It seems the BaseStations are somewhat picky on the format of the XML.
-        Thus I am using a template here to create the binary-xml I really want.
 
         'Received confirmations' are empty message containing the same externalid
         and an empty message. They are send with senderdata and persondata swapped.
         """
 
-        response = """<?xml version="1.0" encoding="UTF-8"?>
-<response version="19.11.12.1403" type="job">
-<externalid>{{eid}}</externalid>
-<systemdata>
-<name>server</name>
-<datetime>{{dt}}</datetime>
-<timestamp>{{ts}}</timestamp>
-<status>1</status>
-<statusinfo>System running</statusinfo>
-</systemdata>
-<jobdata>
-<priority>0</priority>
-<messages>
-<message1></message1>
-<message2></message2>
-<messageuui></messageuui>
-</messages>
-<status>1</status>
-<statusinfo></statusinfo>
-</jobdata>
-<senderdata>
-<address>{{to_ext}}</address>
-<name>name</name>
-<location>server</location>
-</senderdata>
-<persondata>
-<address>{{from_ext}}</address>
-<name>{{from_name}}</name>
-<location>{{from_loc}}</location>
-</persondata>
-</response>
-\0"""
-        response = response.replace("{{eid}}", self.ext_id)
-        response = response.replace("{{from_ext}}", self.from_ext)
-        response = response.replace("{{from_name}}", self.from_name)
-        response = response.replace("{{from_loc}}", self.from_loc)
-        response = response.replace("{{to_ext}}", self.to_ext)
-        response = response.replace("{{dt}}", self.sysdata_datetime)
-        response = response.replace("{{ts}}", self.sysdata_ts)
-        return response
+        return JOB_RESPONSE.render(
+            eid=self.ext_id,
+            dt=self.sysdata_datetime,
+            ts=self.sysdata_ts,
+            to_ext=self.to_ext,
+            from_ext=self.from_ext,
+            from_name=self.from_name,
+            from_loc=self.from_loc,
+        )
 
     def get_message(self):
         """
         This function creates a new message for a received message.
-        It seems the BaseStations are somewhat picky on the format of the XML.
-        Thus I am using a template here to create the binary-xml I really want.
 
         The new message looks like the one we received. But we can re-create it anytime
-        we want.
-        """
-        message = """<?xml version="1.0" encoding="UTF-8"?>
-<request version="19.11.12.1403" type="job">
-<externalid>{{eid}}</externalid>
-<systemdata>
-<name>server</name>
-<datetime>{{dt}}</datetime>
-<timestamp>{{ts}}</timestamp>
-<status>1</status>
-<statusinfo>System running</statusinfo>
-</systemdata>
-<jobdata>
-<priority>0</priority>
-<messages>
-<message1></message1>
-<message2></message2>
-<messageuui>{{msg}}</messageuui>
-</messages>
-<status>0</status>
-<statusinfo></statusinfo>
-</jobdata>
-<senderdata>
-<address>{{from_ext}}</address>
-<name>{{from_name}}</name>
-<location>{{from_loc}}</location>
-</senderdata>
-<persondata>
-<address>{{to_ext}}</address>
-</persondata>
-</request>
-\0"""
-        message = message.replace("{{eid}}", "{:010}".format(self.internal_ext_id))
-        message = message.replace("{{from_ext}}", self.from_ext)
-        message = message.replace("{{from_name}}", self.from_name)
-        message = message.replace("{{from_loc}}", self.from_loc)
-        message = message.replace("{{to_ext}}", self.to_ext)
-        message = message.replace("{{dt}}", self.sysdata_datetime)
-        message = message.replace("{{ts}}", self.sysdata_ts)
-        message = message.replace("{{msg}}", self.message)
-        return message
+        we want. Since none of its fields change between send tries, the
+        rendered datagram is cached.
+        """
+
+        if self._datagram is None:
+            self._datagram = JOB_REQUEST.render(
+                eid="{:010}".format(self.internal_ext_id),
+                dt=self.sysdata_datetime,
+                ts=self.sysdata_ts,
+                priority=self.priority,
+                msg=self.message,
+                from_ext=self.from_ext,
+                from_name=self.from_name,
+                from_loc=self.from_loc,
+                to_ext=self.to_ext,
+            )
+        return self._datagram
+
+    def compact(self):
+        """
+        Drops the cached datagram, e.g. while the message is parked.
+        """
+
+        self._datagram = None
+
+
+class Broadcast():
+
+    """
+    This class encapsulates a Text-Message sent to many recipients at once,
+    e.g. to a group.
+
+    The text and its metadata are stored once, no matter how many recipients
+    there are. Every recipient is queued as a Recipient, which only holds its
+    own delivery state. Their datagrams are rendered from a template with
+    all shared fields bound in advance.
+
+    A Broadcast keeps count of its recipients, so it is known when it is
+    completed.
+    """
+
+    def __init__(self, ext_id, message, from_name, from_ext, from_loc, sysdata_datetime, sysdata_ts,
+                 priority=0, group=None, created=None):
+        """
+        Creates a Broadcast from its fields. See Message for the arguments.
+
+        group is the name the Broadcast was addressed to.
+        """
+
+        self.created = time.time() if created is None else created
+        self.ext_id = ext_id
+        self.message = message
+        self.from_name = _intern(from_name)
+        self.from_ext = _intern(from_ext)
+        self.from_loc = _intern(from_loc)
+        self.sysdata_datetime = sysdata_datetime
+        self.sysdata_ts = sysdata_ts
+        try:
+            self.priority = int(priority or 0)
+        except ValueError:
+            self.priority = 0
+        self.group = group
+
+        self.pending = 0
+        self.delivered = 0
+        self.expired = 0
+        self._template = None
+
+    @classmethod
+    def from_frame(cls, frame):
+        """
+        Creates a Broadcast from a received job frames.Frame addressed to a
+        group.
+        """
+
+        return cls(
+            frame.findtext("externalid"),
+            frame.findtext("jobdata/messages/messageuui"),
+            frame.findtext("senderdata/name"),
+            frame.findtext("senderdata/address"),
+            frame.findtext("senderdata/location"),
+            frame.findtext("systemdata/datetime"),
+            frame.findtext("systemdata/timestamp"),
+            frame.findtext("jobdata/priority"),
+            frame.findtext("persondata/address"),
+        )
+
+    @property
+    def lane(self):
+        return Message.URGENT if self.priority > 0 else Message.NORMAL
+
+    def add(self, to_ext, internal_ext_id):
+        """
+        Returns a new Recipient of this Broadcast.
+        """
+
+        self.pending += 1
+        return Recipient(self, to_ext, internal_ext_id)
+
+    def finish(self, delivered):
+        """
+        Records that a recipient left the queue. Returns True once the last
+        one did.
+        """
+
+        self.pending -= 1
+        if delivered:
+            self.delivered += 1
+        else:
+            self.expired += 1
+        return self.pending == 0
+
+    def get_messageresponse(self):
+        """
+        Creates the 'received confirmation' for the sender, see Message.
+        """
+
+        return JOB_RESPONSE.render(
+            eid=self.ext_id,
+            dt=self.sysdata_datetime,
+            ts=self.sysdata_ts,
+            to_ext=self.group,
+            from_ext=self.from_ext,
+            from_name=self.from_name,
+            from_loc=self.from_loc,
+        )
+
+    def render(self, internal_ext_id, to_ext):
+        if self._template is None:
+            self._template = JOB_REQUEST.bind(
+                dt=self.sysdata_datetime,
+                ts=self.sysdata_ts,
+                priority=self.priority,
+                msg=self.message,
+                from_ext=self.from_ext,
+                from_name=self.from_name,
+                from_loc=self.from_loc,
+            )
+        return self._template.render(eid="{:010}".format(internal_ext_id), to_ext=to_ext)
+
+
+class Recipient():
+
+    """
+    This class is the delivery state of a Broadcast for a single recipient.
+    It is queued and sent like a Message.
+    """
+
+    __slots__ = ("broadcast", "to_ext", "internal_ext_id", "last_send_try", "_datagram")
+
+    def __init__(self, broadcast, to_ext, internal_ext_id):
+        self.broadcast = broadcast
+        self.to_ext = _intern(to_ext)
+        self.internal_ext_id = internal_ext_id
+        self.last_send_try = 0
+        self._datagram = None
+
+    @property
+    def created(self):
+        return self.broadcast.created
+
+    @property
+    def priority(self):
+        return self.broadcast.priority
+
+    @property
+    def lane(self):
+        return self.broadcast.lane
+
+    def get_message(self):
+        if self._datagram is None:
+            self._datagram = self.broadcast.render(self.internal_ext_id, self.to_ext)
+        return self._datagram
+
+    def compact(self):
+        self._datagram = None
+
 
 class MessageSystem():
 
@@ -148,94 +313,492 @@ class MessageSystem():
         11: ("User absent", False),
     }
 
-    def __init__(self, udp_server, roaming_monitor):
+    # What to do with a new message while the outbox is full.
+    REJECT = "reject"
+    DROP_OLDEST = "drop-oldest"
+
+    def __init__(self, udp_server, roaming_monitor, journal=None, retry_policy=None, dedup_cache=None, scheduler=None,
+                 max_messages=None, overflow=REJECT, urgent_interval=None, groups=None, shard=None):
         """
         Create a new MessageSystem.
 
         This Message-System implements SMS-Communication with storage of
         non-delivered messages for Snom DECT handsets.
+
+        If a journal.Journal is given, the outbox is restored from it and
+        every change of the outbox is recorded there. Reception confirmations
+        are only sent once a message is safely on disk.
+
+        When and how often undelivered messages are sent again is decided
+        by a retry.RetryPolicy.
+
+        Retransmitted messages are recognized using a dedup.DedupCache.
+        They are confirmed again, but not queued twice.
+
+        Sending to the BaseStations is paced by a pacing.SendScheduler. Its
+        retransmission timeout decides when a message without any answer is
+        sent again, but never later than the interval of the RetryPolicy.
+        URGENT messages are sent before NORMAL ones and are sent again after
+        urgent_interval seconds at the latest (default: a quarter of the
+        interval).
+
+        The outbox holds at most max_messages messages, if given. Once it is
+        full, new messages are either not confirmed (REJECT), so the
+        BaseStation retransmits them later, or the oldest queued message is
+        dropped (DROP_OLDEST).
+
+        Messages addressed to one of the groups.Groups are queued as a
+        single Broadcast to all members of the group (except the sender).
+        Every member counts towards max_messages.
+
+        If this MessageSystem is one of several shards (see sharding), shard
+        is a tuple (index, number of shards). The internal ids of its
+        messages are then congruent to index modulo the number of shards, so
+        status frames can be routed to the shard that sent the message. It
+        only queues messages for the extensions it owns (see
+        sharding.shard_of()), and only tracks those being reachable.
         """
-        self._udp_server = udp_server
-        self._queue = []
+        if overflow not in (MessageSystem.REJECT, MessageSystem.DROP_OLDEST):
+            raise ValueError("Unknown overflow policy {}".format(overflow))
+        if max_messages is not None and max_messages < 1:
+            raise ValueError("The outbox needs to hold at least one message")
 
-        self._udp_server.register_driver(self)
+        self._udp_server = udp_server
+        self._queue = Outbox()
+        self._max_messages = max_messages
+        self._overflow = overflow
+        self._groups = Groups() if groups is None else groups
+        self._shard = (0, 1) if shard is None else shard
+        self._retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self._dedup_cache = DedupCache() if dedup_cache is None else dedup_cache
+        self._scheduler = SendScheduler(max_rto=self._retry_policy.interval) if scheduler is None else scheduler
+        # lane => seconds after which an unanswered message is sent again
+        self._intervals = {
+            Message.NORMAL: self._retry_policy.interval,
+            Message.URGENT: self._retry_policy.interval / 4 if urgent_interval is None else urgent_interval,
+        }
+        self._scheduler.attach(self._transmit)
+
+        self._journal = journal
+        if journal is not None:
+            for message in journal.recover():
+                self._queue.add(message, message.last_send_try + self._intervals[message.lane])
+            journal.attach(self._queue)
+
+        self._messages = Counter("snom_messages_total", "Messages by event", ("event",))
+        self._broadcasts = Counter("snom_broadcasts_total", "Broadcasts by event", ("event",))
+        self._delivery_seconds = Histogram("snom_delivery_latency_seconds", "Time from accepting a message to its delivery",
+                                           ("lane",))
+        self._outbox_seconds = Histogram("snom_outbox_seconds", "Time spent per run of the outbox")
+
+        # Set whenever the outbox got a message that may be due earlier than
+        # the deadline process_outbox() is currently sleeping for.
+        self._wakeup = asyncio.Event()
+
+        self._udp_server.register_driver(self, {
+            ("request", "job"): self.process_job,
+            ("response", "job"): self.process_status,
+        })
 
         loop = asyncio.get_event_loop()
-        loop.create_task(self.process_outbox())
+        self._outbox_task = loop.create_task(self.process_outbox())
 
         self._roaming_monitor = roaming_monitor
+        self._roaming_monitor.add_listener(self.recipient_located)
+
+    def attach_metrics(self, registry):
+        registry.register(self._messages)
+        registry.register(self._broadcasts)
+        registry.register(self._delivery_seconds)
+        registry.register(self._outbox_seconds)
+        registry.gauge("snom_outbox_messages", "Messages in the outbox per lane", self._queue.lanes, ("lane",))
+        registry.counter("snom_retry_decisions_total", "Decisions of the retry policy",
+                         lambda: dict(self._retry_policy.counters), ("decision",))
+        registry.gauge("snom_dedup_entries", "Entries of the dedup cache", lambda: len(self._dedup_cache))
+        registry.counter("snom_dedup_lookups_total", "Lookups in the dedup cache",
+                         lambda: dict(self._dedup_cache.counters), ("result",))
+        self._scheduler.attach_metrics(registry)
 
     def close(self):
-        #TODO: Implement proper shutdown of this function.
-        pass
+        """
+        Stops sending messages and closes the journal. Messages that are
+        written to the journal by now are confirmed to their senders.
+        """
 
-    def process(self, xml_message, addr):
+        if self._outbox_task is None:
+            return
+        self._outbox_task.cancel()
+        self._outbox_task = None
+        self._scheduler.close()
+        if self._journal is not None:
+            self._journal.close()
 
-        """
-        Process a message received via UDP.
+    def process_job(self, frame, addr):
 
-        We are interested in two typed of messages from the UDP-Socket:
-        * New Messages from Phones
-        * Status-Updates for messages we have sent
+        """
+        Process a new message from a phone received via UDP.
 
-        All other messages are not consumed.
+        We will queue this message in our outbox and send a reception
+        confirmation to the sending phone.
+        We do not track if the sending phone confirms our status update.
         """
 
-        if xml_message.tag == "request" and xml_message.attrib["type"] == "job":
-            # This is an incoming message. We will queue this message in our outbox and
-            # send a reception confirmation to the sending phone.
-            # We do not track if the sending phone confirms our status update.
-            logger.debug("Found incoming message. Trying to parse and add it to queue")
-            m = Message(xml_message)
-            self._queue.append(m)
+        logger.debug("Found incoming message. Trying to parse and add it to queue")
+        now = time.time()
+        key = (
+            frame.findtext("senderdata/address"),
+            frame.findtext("externalid"),
+            frame.findtext("systemdata/timestamp"),
+        )
+        # With several shards, the shard of the recipient (or of the name of
+        # the group) queues the message and confirms it. The shards of the
+        # members of a group queue it for their members. The shard of the
+        # sender learns that the sender is reachable.
+        to_ext = frame.findtext("persondata/address")
+        group = to_ext in self._groups
+        main = self._owns(to_ext)
+        if not main and not group:
+            self._reachable(key[0])
+            return
+
+        known, response = self._dedup_cache.lookup(key, now)
+        if known:
+            # The confirmation is still missing while the message is not
+            # written to the journal yet. It will be sent once it is.
+            self._messages.inc("retransmitted")
+            if response is not None:
+                logger.info("Got retransmitted message with external ID %s. Confirming it again", key[1])
+                self._udp_server.send_dgram(response, addr)
+            return
+
+        recipients = self.resolve(to_ext) if group else None
+        if recipients is not None:
+            recipients = [number for number in recipients if number != key[0] and self._owns(number)]
+            if not main and not recipients:
+                self._reachable(key[0])
+                return
+        if not self._make_room(1 if recipients is None else len(recipients)):
+            logger.warning("Outbox is full. Not accepting message with external ID %s", key[1])
+            self._messages.inc("rejected")
+            return
+
+        if recipients is None:
+            m = Message.from_frame(frame)
+            m.internal_ext_id = self._free_ids(1)
+            self._queue.add(m, m.created)
+            self._wakeup.set()
+            self._messages.inc("accepted")
             logger.info("Added Message with external ID %s and internal id %s", m.ext_id, m.internal_ext_id)
+        else:
+            m = Broadcast.from_frame(frame)
 
+        self._dedup_cache.add(key, None, now)
+
+        def confirm():
             # send confirmation to sender
-            self._udp_server.send_dgram(m.get_messageresponse(), addr)
+            response = m.get_messageresponse()
+            self._udp_server.send_dgram(response, addr)
+            self._dedup_cache.update(key, response)
             logger.debug("Confirmation for sender sent!")
 
+        if not main:
+            # Retransmissions stay unanswered here, the main shard confirms.
+            self.broadcast(m, recipients)
+        elif recipients is not None:
+            self.broadcast(m, recipients, confirm)
+        elif self._journal is not None:
+            self._journal.enqueue(m, confirm)
+        else:
+            confirm()
+
+        self._reachable(m.from_ext)
+
+    def _owns(self, number):
+        # Returns True if messages for number are queued by this shard.
+        index, shards = self._shard
+        return shards == 1 or (number is not None and shard_of(number, shards) == index)
+
+    def _reachable(self, number):
+        """
+        Sends everything held back for number right away: A phone that
+        sends a message is not absent.
+        """
+
+        if self._owns(number) and self._retry_policy.reset(number):
+            self._flush(number)
+
+    def _make_room(self, count):
+        """
+        Makes room for count new messages in the outbox, if the overflow
+        policy allows to. Returns False if there is not enough room.
+        """
+
+        if self._max_messages is None or len(self._queue) + count <= self._max_messages:
             return True
+        if self._overflow == MessageSystem.REJECT or count > self._max_messages:
+            return False
+        while len(self._queue) + count > self._max_messages:
+            oldest = self._queue.remove(self._queue.oldest().internal_ext_id)
+            logger.warning("Outbox is full. Dropping message %s", oldest.internal_ext_id)
+            self._expire(oldest, "dropped")
+        return True
+
+    def resolve(self, name):
+        """
+        Returns the extensions of the members of the group name or None if
+        name is not a group.
+        """
+
+        return self._groups.resolve(name, self._roaming_monitor)
+
+    def room(self):
+        """
+        Returns how many more messages fit into the outbox, or None if its
+        size is not limited.
+        """
+
+        if self._max_messages is None:
+            return None
+        return max(0, self._max_messages - len(self._queue))
+
+    def enqueue(self, messages, callback=None):
+        """
+        Queues messages that were not sent by a handset (see
+        injection.InjectionServer) in one go. The caller has to make sure
+        they fit into the outbox (see room()).
+
+        callback is called once all messages are written to the journal.
+        """
 
-        if xml_message.tag == "response" and xml_message.attrib["type"] == "job":
-            # This is a reception confirmation.
-            # These come in two tastes:
-            # * With "./response/jobdata": These contain status information for a message
-            #   ./response/jobdata/status == 1: Message received
-            #   ./response/jobdata/status == 11: User absent?
-            # * Without "./response/jobdata":  I am not sure what these do. They seem to be send
-            #   by the BaseStations. I am currently ignoring these.
-
-            if xml_message.find("./jobdata"):
-                ext_id = int(xml_message.find("./externalid").text)
-                logger.debug("Status update for %s", ext_id)
-
-                status = int(xml_message.find(".jobdata/status").text)
-
-                remove_from_queue = False
-                if status in MessageSystem._snom_message_status:
-                    logger.info(
-                        "Status Update for %s: %s => '%s'. Remove from queue? %s",
-                        ext_id,
-                        status,
-                        MessageSystem._snom_message_status[status][0],
-                        MessageSystem._snom_message_status[status][1],
-                    )
-                    remove_from_queue = MessageSystem._snom_message_status[status][1]
+        now = time.time()
+        for m in messages:
+            m.internal_ext_id = self._free_ids(1)
+            self._queue.add(m, now)
+        self._wakeup.set()
+        self._messages.inc("injected", amount=len(messages))
+        logger.info("Added %s injected messages", len(messages))
+
+        if self._journal is not None and messages:
+            # Records are committed in order. Once the last one is on disk,
+            # all of them are.
+            for m in messages[:-1]:
+                self._journal.enqueue(m)
+            self._journal.enqueue(messages[-1], callback)
+        elif callback is not None:
+            callback()
+
+    def broadcast(self, broadcast, recipients, callback=None):
+        """
+        Queues broadcast for recipients. The caller has to make sure they
+        fit into the outbox (see room()).
+
+        The broadcast is written to the journal as a single record, callback
+        is called once it is on disk.
+        """
+
+        # Recipients get ascending ids, ordered by their BaseStation. Due
+        # messages are sent in the order of their ids, so the frames for a
+        # BaseStation leave together (and can be coalesced).
+        get_addr = self._roaming_monitor.get_addr
+        recipients = sorted(set(recipients), key=lambda number: (get_addr(number) or ("", 0), number))
+        first = self._free_ids(len(recipients))
+        step = self._shard[1]
+        recipients = [broadcast.add(number, first + i * step) for i, number in enumerate(recipients)]
+
+        now = time.time()
+        for recipient in recipients:
+            self._queue.add(recipient, now)
+        self._wakeup.set()
+        self._broadcasts.inc("queued")
+        self._messages.inc("broadcast", amount=len(recipients))
+        logger.info("Added Broadcast with external ID %s to %s for %s recipients",
+                    broadcast.ext_id, broadcast.group, len(recipients))
+
+        if self._journal is not None:
+            self._journal.broadcast(broadcast, recipients, callback)
+        elif callback is not None:
+            callback()
+        if not recipients:
+            self._finished(broadcast)
+
+    def _free_ids(self, count):
+        # Returns the first of count internal ids of this shard in a row
+        # that are not in use. Ids of a shard are a number of shards apart.
+        index, shards = self._shard
+        while True:
+            first = random.randrange((9999999999+1) // shards - count + 1) * shards + index
+            if not any(first + i * shards in self._queue for i in range(count)):
+                return first
+
+    def _finish(self, message, delivered):
+        """
+        Tracks the Broadcast of a message that left the queue.
+        """
+
+        broadcast = message.broadcast
+        if broadcast is not None and broadcast.finish(delivered):
+            self._finished(broadcast)
+
+    def _finished(self, broadcast):
+        self._broadcasts.inc("completed")
+        logger.info("Broadcast with external ID %s to %s completed: %s delivered, %s expired",
+                    broadcast.ext_id, broadcast.group, broadcast.delivered, broadcast.expired)
+
+    def process_status(self, frame, addr):
+
+        """
+        Process a status-update for a message we have sent.
+
+        These come in two tastes:
+        * With "./response/jobdata": These contain status information for a message
+          ./response/jobdata/status == 1: Message received
+          ./response/jobdata/status == 11: User absent?
+        * Without "./response/jobdata":  I am not sure what these do. They seem to be send
+          by the BaseStations. I am currently ignoring these.
+        """
+
+        status = frame.findtext("jobdata/status")
+        if status is not None:
+            ext_id = int(frame.findtext("externalid"))
+            logger.debug("Status update for %s", ext_id)
+
+            status = int(status)
+            self._scheduler.acknowledged(ext_id)
+
+            remove_from_queue = False
+            if status in MessageSystem._snom_message_status:
+                logger.info(
+                    "Status Update for %s: %s => '%s'. Remove from queue? %s",
+                    ext_id,
+                    status,
+                    MessageSystem._snom_message_status[status][0],
+                    MessageSystem._snom_message_status[status][1],
+                )
+                remove_from_queue = MessageSystem._snom_message_status[status][1]
+            else:
+                logger.warning("Got unknown status code: %s. Keeping message in queue", status)
+
+            message = self._queue.get(ext_id)
+            if remove_from_queue:
+                if message is not None:
+                    self._queue.remove(ext_id)
+                    logger.debug("Removed %s from queue", ext_id)
+                    self._messages.inc("delivered")
+                    self._delivery_seconds.labels(message.lane).observe(time.time() - message.created)
+                    if self._journal is not None:
+                        self._journal.delivered(ext_id)
+                    self._retry_policy.discard(message.to_ext, ext_id)
+                    self._finish(message, True)
+                    # The recipient is obviously reachable. Send everything
+                    # we held back while it was absent.
+                    if self._retry_policy.reset(message.to_ext):
+                        self._flush(message.to_ext)
                 else:
-                    logger.warning("Got unknown status code: %s. Keeping message in queue", status)
+                    logger.warning("Got reception confirmation for unknown message: %s", ext_id)
+            elif status == 11 and message is not None:
+                self._messages.inc("absent")
+                now = time.time()
+                self._apply(message, *self._retry_policy.absent(message.to_ext, ext_id, now), now)
+            elif message is not None and message.last_send_try:
+                # The BaseStation answered, so there is nothing to retransmit.
+                # The RTO only applies to sends without any answer.
+                self._queue.schedule(message, message.last_send_try + self._intervals[message.lane])
+
+    def recipient_located(self, number, addr):
+        """
+        Sends all queued messages for number right away, now that we know
+        where to send them.
+        """
 
-                if remove_from_queue:
-                    for msg in self._queue:
-                        if msg.internal_ext_id == ext_id:
-                            self._queue.remove(msg)
-                            logger.debug("Removed %s from queue", ext_id)
-                            break
-                    else:
-                        logger.warning("Got reception confirmation for unknown message: %s", ext_id)
+        self._retry_policy.reset(number)
+        if self._flush(number):
+            logger.debug("%s showed up on %s. Flushed its queued messages", number, addr)
 
-            return True
+    def _flush(self, number):
+        """
+        Schedules all queued messages for number right away.
+        Returns the number of messages scheduled.
+        """
+
+        messages = self._queue.for_recipient(number)
+        now = time.time()
+        for message in messages:
+            self._queue.schedule(message, now)
+        if messages:
+            self._wakeup.set()
+        return len(messages)
+
+    def _expire(self, message, event="expired"):
+        """
+        Cleans up after an undelivered message left the queue.
+        """
+
+        logger.info("Removing undelivered message from queue: %s", message.internal_ext_id)
+        self._scheduler.discard(message.internal_ext_id)
+        self._messages.inc(event)
+        if self._journal is not None:
+            self._journal.expired(message.internal_ext_id)
+        self._finish(message, False)
+
+        # Hand the role of the probe over to another message for this recipient,
+        # the others would stay parked otherwise.
+        if self._retry_policy.discard(message.to_ext, message.internal_ext_id):
+            remaining = self._queue.for_recipient(message.to_ext)
+            if remaining:
+                now = time.time()
+                self._apply(remaining[0], *self._retry_policy.decide(message.to_ext, remaining[0].internal_ext_id, now), now)
+
+    def _apply(self, message, action, when, now):
+        """
+        Carries out a decision of the RetryPolicy for a message.
+        """
+
+        if action == RetryPolicy.PARK:
+            logger.debug("Recipient of message %s is absent. Parking it", message.internal_ext_id)
+            self._hold(message)
+            self._queue.park(message)
+        elif action == RetryPolicy.WAIT:
+            self._hold(message)
+            self._queue.schedule(message, when)
+        else:
+            self._send(message, now)
+
+    def _hold(self, message):
+        # The message is not sent for now. An unanswered send of it must not
+        # keep its slot in the window of its BaseStation.
+        self._scheduler.discard(message.internal_ext_id)
+        message.compact()
+
+    def _send(self, message, now):
+        addr = self._roaming_monitor.get_addr(message.to_ext)
+        if addr is None:
+            logger.debug("Recipient of message %s is not located. Parking it", message.internal_ext_id)
+            self._hold(message)
+            self._queue.park(message)
+            return
+
+        self._scheduler.submit(message, addr)
+
+    def _transmit(self, message, addr):
+        """
+        Actually sends a message, once the SendScheduler lets it go.
+        Returns False if the message is not queued anymore.
+        """
 
-        return False
+        if self._queue.get(message.internal_ext_id) is not message:
+            return False
+
+        logger.debug("Sending message %s", message.internal_ext_id)
+        self._udp_server.send_dgram(message.get_message(), addr)
+        self._messages.inc("sent")
+        now = time.time()
+        message.last_send_try = now
+        # Sent again after the RTO unless a status frame arrives, see
+        # process_status().
+        self._queue.schedule(message, now + min(self._intervals[message.lane], self._scheduler.rto(addr)))
+        if self._journal is not None:
+            self._journal.attempt(message)
+        return True
 
     async def process_outbox(self):
 
@@ -243,19 +806,24 @@ class MessageSystem():
         Process the queue of outgoing messages.
         """
 
+        outbox_seconds = self._outbox_seconds.labels()
         while True:
-            # check if any message is to resend
-            for message in self._queue:
-                if (time.time() - message.last_send_try) > 60:
-                    logger.debug("Sending message %s", message.internal_ext_id)
-                    self._udp_server.send_dgram(message.get_message(), self._roaming_monitor.get_addr(message.to_ext))
-                    message.last_send_try = time.time()
-
-            # purge all messages older than
-            for message in self._queue:
-                if (time.time() - message.created) > 7*24*60*60:
-                    logger.info("Removing undelivered message from queue: %s", message.internal_ext_id)
-                    self._queue.remove(message)
-
-            await asyncio.sleep(1)
-            continue
+            started = time.perf_counter()
+            now = time.time()
+            due, expired = self._queue.pop_due(now)
+
+            for message in expired:
+                self._expire(message)
+
+            for message in due:
+                self._apply(message, *self._retry_policy.decide(message.to_ext, message.internal_ext_id, now), now)
+            outbox_seconds.observe(time.perf_counter() - started)
+
+            # Sleep until the next message is due or a new one is queued.
+            deadline = self._queue.next_deadline()
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,218 @@
+import logging
+import asyncio
+import bisect
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds, from 10 µs to 10 minutes.
+DEFAULT_BUCKETS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600,
+)
+
+
+def _format_labels(names, values, extra=""):
+    pairs = ['{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter():
+
+    """
+    A monotonically increasing value per combination of label values.
+    """
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self._labels = labels
+        # label values => value
+        self._values = {}
+
+    def inc(self, *values, amount=1):
+        self._values[values] = self._values.get(values, 0) + amount
+
+    def samples(self):
+        for values, value in self._values.items():
+            yield self.name + _format_labels(self._labels, values), value
+
+
+class _Buckets():
+
+    # The counts of a histogram for a single combination of label values.
+
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram():
+
+    """
+    Counts observations (e.g. durations in seconds) in buckets.
+
+    Hot paths should fetch the buckets for their label values once with
+    labels() and call observe() on them directly.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self._labels = labels
+        self._bounds = tuple(sorted(buckets))
+        # label values => _Buckets
+        self._buckets = {}
+
+    def labels(self, *values):
+        buckets = self._buckets.get(values)
+        if buckets is None:
+            buckets = self._buckets[values] = _Buckets(self._bounds)
+        return buckets
+
+    def observe(self, value, *values):
+        self.labels(*values).observe(value)
+
+    def samples(self):
+        for values, buckets in self._buckets.items():
+            cumulative = 0
+            for bound, count in zip(self._bounds + (float("inf"),), buckets.counts):
+                cumulative += count
+                le = 'le="{}"'.format(_format_value(bound))
+                yield self.name + "_bucket" + _format_labels(self._labels, values, le), cumulative
+            yield self.name + "_sum" + _format_labels(self._labels, values), buckets.sum
+            yield self.name + "_count" + _format_labels(self._labels, values), buckets.count
+
+
+class Callback():
+
+    """
+    A value that is only computed when the metrics are collected, e.g. the
+    length of a queue or an existing dictionary of counters.
+
+    func returns either a single number or a dictionary mapping label values
+    (a tuple, or a single value for a single label) to numbers.
+    """
+
+    def __init__(self, name, help, kind, func, labels=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self._func = func
+        self._labels = labels
+
+    def samples(self):
+        result = self._func()
+        if not isinstance(result, dict):
+            yield self.name, result
+            return
+        for values, value in result.items():
+            if not isinstance(values, tuple):
+                values = (values,)
+            yield self.name + _format_labels(self._labels, values), value
+
+
+class Registry():
+
+    """
+    This class collects all metrics of the server and renders them in the
+    Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        """
+        Adds a Counter, Histogram or Callback. Components create their metrics
+        on their own and always record them, so the hot paths do not need to
+        check whether they are exported.
+        """
+
+        if metric.name in self._metrics:
+            raise ValueError("Metric {} is already registered".format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def gauge(self, name, help, func, labels=()):
+        return self.register(Callback(name, help, "gauge", func, labels))
+
+    def counter(self, name, help, func, labels=()):
+        return self.register(Callback(name, help, "counter", func, labels))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            try:
+                for sample, value in metric.samples():
+                    lines.append("{} {}".format(sample, _format_value(value)))
+            except Exception as exp:
+                logger.warning("Failed to collect metric {}: {}".format(metric.name, exp))
+        lines.append("")
+        return "\n".join(lines)
+
+
+class MetricsServer():
+
+    """
+    This class serves the metrics of a Registry over HTTP, on the event loop
+    of the server. Every request is answered with all metrics.
+    """
+
+    def __init__(self, registry):
+        self._registry = registry
+        self._server = None
+
+    async def start(self, host="127.0.0.1", port=9130):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info("Serving metrics on {}".format(self._server.sockets[0].getsockname()))
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            # Skip the request line and headers. There is only one resource.
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 5)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            body = self._registry.render().encode("UTF-8")
+            writer.write(
+                b"HTTP/1.0 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                + "Content-Length: {}\r\n\r\n".format(len(body)).encode("ASCII")
+                + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as exp:
+            logger.debug("Metrics request failed: {}".format(exp))
+        finally:
+            writer.close()
@@ -0,0 +1,184 @@
+import logging
+import heapq
+import math
+logger = logging.getLogger(__name__)
+
+class Outbox():
+
+    """
+    This class stores the messages waiting for delivery.
+
+    Messages are indexed by their internal id, so reception confirmations
+    can be matched in constant time. Every message has exactly one deadline:
+    The earlier of its next send try and its expiry. All deadlines are kept in
+    a min-heap, so we only need to look at messages that are actually due.
+
+    Rescheduling a message does not remove its old heap entry. Stale entries
+    are recognized by comparing them to the current deadline of the message
+    and are skipped when they reach the top of the heap.
+
+    Messages are also indexed by recipient. Messages whose recipient can not
+    be located right now are parked: They are not sent until they are
+    scheduled again, but still expire.
+    """
+
+    def __init__(self, max_age=7*24*60*60):
+        """
+        Creates a new, empty Outbox.
+
+        Messages older than max_age seconds are expired.
+        """
+
+        self._max_age = max_age
+
+        self._messages = {}
+        self._deadlines = {}
+        self._heap = []
+        # recipient => {internal_ext_id: message}
+        self._recipients = {}
+        # lane => number of messages
+        self._lanes = {}
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __contains__(self, internal_ext_id):
+        return internal_ext_id in self._messages
+
+    def __iter__(self):
+        return iter(self._messages.values())
+
+    def oldest(self):
+        """
+        Returns the message queued first or None if the outbox is empty.
+        """
+
+        # Dictionaries keep the order messages were added in.
+        return next(iter(self._messages.values()), None)
+
+    def get(self, internal_ext_id):
+        return self._messages.get(internal_ext_id)
+
+    def for_recipient(self, recipient):
+        """
+        Returns all queued messages for recipient.
+        """
+
+        return list(self._recipients.get(recipient, {}).values())
+
+    def lanes(self):
+        """
+        Returns the number of queued messages per lane.
+        """
+
+        return dict(self._lanes)
+
+    def _unindex(self, message):
+        self._lanes[message.lane] -= 1
+        messages = self._recipients.get(message.to_ext)
+        if messages is not None:
+            messages.pop(message.internal_ext_id, None)
+            if not messages:
+                del self._recipients[message.to_ext]
+
+    def add(self, message, next_try):
+        """
+        Adds a message to the outbox. The first send try is due at next_try.
+        """
+
+        self._messages[message.internal_ext_id] = message
+        self._recipients.setdefault(message.to_ext, {})[message.internal_ext_id] = message
+        self._lanes[message.lane] = self._lanes.get(message.lane, 0) + 1
+        self.schedule(message, next_try)
+
+    def remove(self, internal_ext_id):
+        """
+        Removes a message from the outbox.
+
+        Returns the removed message or None if the message was not queued.
+        Its heap entry is left behind and will be skipped later on.
+        """
+
+        self._deadlines.pop(internal_ext_id, None)
+        message = self._messages.pop(internal_ext_id, None)
+        if message is not None:
+            self._unindex(message)
+        self._compact()
+        return message
+
+    def schedule(self, message, next_try):
+        """
+        (Re-)Schedules the next send try of a queued message.
+        """
+
+        deadline = min(next_try, message.created + self._max_age)
+        self._deadlines[message.internal_ext_id] = deadline
+        heapq.heappush(self._heap, (deadline, message.internal_ext_id))
+        self._compact()
+
+    def _compact(self):
+        # Rebuilds the heap once most of it consists of stale entries, left
+        # behind by removed and rescheduled messages.
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            # In place, pop_due() holds on to the heap while parking.
+            self._heap[:] = [(d, i) for i, d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def park(self, message):
+        """
+        Stops sending a queued message until it is scheduled again.
+        The message still expires.
+        """
+
+        self.schedule(message, math.inf)
+
+    def _discard_stale(self):
+        heap = self._heap
+        while heap and self._deadlines.get(heap[0][1]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def next_deadline(self):
+        """
+        Returns the point in time the next message is due or None if the
+        outbox is empty.
+        """
+
+        self._discard_stale()
+        if self._heap:
+            return self._heap[0][0]
+        return None
+
+    def pop_due(self, now):
+        """
+        Collects all messages that are due at the point in time now.
+
+        Returns a tuple (due, expired):
+        * due: Messages that need to be sent. These are kept in the outbox
+          and only expire until schedule() is called for them, e.g. while
+          they wait for the SendScheduler.
+        * expired: Messages that have been removed from the outbox, because
+          they are older than max_age.
+        """
+
+        due = []
+        expired = []
+
+        heap = self._heap
+        while True:
+            self._discard_stale()
+            if not heap or heap[0][0] > now:
+                break
+
+            _, internal_ext_id = heapq.heappop(heap)
+            del self._deadlines[internal_ext_id]
+            message = self._messages[internal_ext_id]
+
+            if now - message.created >= self._max_age:
+                del self._messages[internal_ext_id]
+                self._unindex(message)
+                expired.append(message)
+            else:
+                self.park(message)
+                due.append(message)
+
+        return due, expired
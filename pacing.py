@@ -0,0 +1,256 @@
+import logging
+import asyncio
+import time
+from collections import deque
+from metrics import Histogram
+logger = logging.getLogger(__name__)
+
+class Destination():
+
+    """
+    This class holds the send state of a single BaseStation.
+
+    The round-trip time estimation follows RFC 6298.
+    """
+
+    def __init__(self, addr, lanes, rate, burst, initial_rto):
+        self.addr = addr
+        self.name = "{}:{}".format(*addr)
+        # Messages waiting for a free slot in the window or for a token,
+        # one queue per lane in the order of the lanes.
+        self.queues = {lane: deque() for lane in lanes}
+        # internal id => (time sent, retransmission?)
+        self.in_flight = {}
+
+        self.tokens = burst
+        self.refilled = time.monotonic()
+        self._rate = rate
+        self._burst = burst
+
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+
+        # Pending call to SendScheduler._pump() while waiting for a token.
+        self.timer = None
+
+        self.counters = {
+            "sent": 0,
+            "acknowledged": 0,
+            "timeout": 0,
+        }
+
+    def queued(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def refill(self, now):
+        self.tokens = min(self._burst, self.tokens + (now - self.refilled) * self._rate)
+        self.refilled = now
+
+    def sample(self, rtt, min_rto, max_rto):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max_rto, max(min_rto, self.srtt + 4 * self.rttvar))
+
+
+class SendScheduler():
+
+    """
+    This class paces the messages sent to every BaseStation.
+
+    Every BaseStation has a window: At most window messages may be sent to
+    it without having been answered. Additionally sending is paced with a
+    token bucket of rate messages per second and a burst of burst messages.
+    Messages that do not fit are queued per BaseStation.
+
+    Every message belongs to one of the lanes (see messagesystem.Message),
+    which are given from highest to lowest priority. Queued messages of a
+    lane are sent before those of the following lanes. reserved slots of the
+    window can not be used by the last lane, so there is always room for
+    more urgent messages.
+
+    The time from sending a message to its status frame is measured per
+    BaseStation, and used to derive the retransmission timeout (RTO) for
+    messages that are not answered at all.
+    """
+
+    def __init__(self, window=32, rate=100, burst=20, initial_rto=5, min_rto=1, max_rto=60,
+                 lanes=("urgent", "normal"), reserved=8):
+        if reserved >= window:
+            raise ValueError("At least one slot of the window must not be reserved")
+
+        self._window = window
+        self._lanes = lanes
+        self._reserved = reserved
+        self._rate = rate
+        self._burst = burst
+        self._initial_rto = initial_rto
+        self._min_rto = min_rto
+        self._max_rto = max_rto
+
+        self._transmit = None
+        self._destinations = {}
+        # internal id => Destination the message is in flight to
+        self._in_flight = {}
+
+        self._rtt_seconds = Histogram("snom_rtt_seconds", "Time from sending a message to its status frame", ("destination",))
+
+    def attach_metrics(self, registry):
+        registry.register(self._rtt_seconds)
+        for name, help in (("sent", "Messages sent"),
+                           ("acknowledged", "Messages answered with a status frame"),
+                           ("timeout", "Messages not answered within the RTO")):
+            registry.counter("snom_pacing_{}_total".format(name), help + " per base station",
+                             lambda name=name: {d.name: d.counters[name] for d in self._destinations.values()},
+                             ("destination",))
+        registry.gauge("snom_pacing_in_flight", "Unanswered messages per base station",
+                       lambda: {d.name: len(d.in_flight) for d in self._destinations.values()}, ("destination",))
+        registry.gauge("snom_pacing_queued", "Messages waiting for the window or a token per base station and lane",
+                       lambda: {(d.name, lane): len(queue) for d in self._destinations.values()
+                                for lane, queue in d.queues.items()},
+                       ("destination", "lane"))
+        registry.gauge("snom_pacing_rto_seconds", "Retransmission timeout per base station",
+                       lambda: {d.name: d.rto for d in self._destinations.values()}, ("destination",))
+
+    def attach(self, transmit):
+        """
+        Sets the callable actually sending a message. It is called with
+        (message, addr) and returns False if the message does not need to be
+        sent anymore.
+        """
+
+        self._transmit = transmit
+
+    def close(self):
+        """
+        Stops sending. Queued messages are dropped, they are still in the
+        outbox.
+        """
+
+        for destination in self._destinations.values():
+            if destination.timer is not None:
+                destination.timer.cancel()
+                destination.timer = None
+            for queue in destination.queues.values():
+                queue.clear()
+        self._transmit = None
+
+    def destinations(self):
+        return self._destinations.values()
+
+    def _destination(self, addr):
+        destination = self._destinations.get(addr)
+        if destination is None:
+            destination = self._destinations[addr] = Destination(addr, self._lanes, self._rate, self._burst, self._initial_rto)
+        return destination
+
+    def rto(self, addr):
+        """
+        Returns the current retransmission timeout for addr.
+        """
+
+        return self._destination(addr).rto
+
+    def submit(self, message, addr):
+        """
+        Queues a message for sending to addr.
+
+        If the message is still in flight, its old send is given up. If its
+        RTO has passed, this counts as timeout and the RTO is backed off.
+        """
+
+        now = time.monotonic()
+        previous = self._in_flight.get(message.internal_ext_id)
+        retransmission = self._forget(message.internal_ext_id, now)
+
+        destination = self._destination(addr)
+        destination.queues[message.lane].append((message, retransmission))
+        self._pump(destination)
+        # The recipient moved. Its slot at the old BaseStation is free now.
+        if previous is not None and previous is not destination:
+            self._pump(previous)
+
+    def acknowledged(self, internal_ext_id):
+        """
+        Records the status frame for a message.
+        """
+
+        destination = self._in_flight.pop(internal_ext_id, None)
+        if destination is None:
+            return
+
+        now = time.monotonic()
+        sent, retransmission = destination.in_flight.pop(internal_ext_id)
+        destination.counters["acknowledged"] += 1
+        self._rtt_seconds.labels(destination.name).observe(now - sent)
+        # Karn's algorithm: We can not tell which send is answered.
+        if not retransmission:
+            destination.sample(now - sent, self._min_rto, self._max_rto)
+        self._pump(destination)
+
+    def discard(self, internal_ext_id):
+        """
+        Forgets a message that left the outbox.
+        """
+
+        destination = self._in_flight.get(internal_ext_id)
+        self._forget(internal_ext_id, time.monotonic())
+        if destination is not None:
+            self._pump(destination)
+
+    def _forget(self, internal_ext_id, now):
+        # Returns True if the message was in flight.
+        destination = self._in_flight.pop(internal_ext_id, None)
+        if destination is None:
+            return False
+
+        sent, _ = destination.in_flight.pop(internal_ext_id)
+        if now - sent >= destination.rto:
+            destination.counters["timeout"] += 1
+            destination.rto = min(self._max_rto, destination.rto * 2)
+        return True
+
+    def _pump(self, destination):
+        if destination.timer is not None or self._transmit is None:
+            return
+
+        now = time.monotonic()
+        while True:
+            queue = self._next_queue(destination)
+            if queue is None:
+                return
+
+            destination.refill(now)
+            if destination.tokens < 1:
+                delay = (1 - destination.tokens) / self._rate
+                destination.timer = asyncio.get_event_loop().call_later(delay, self._wake, destination)
+                return
+
+            message, retransmission = queue.popleft()
+            if message.internal_ext_id in self._in_flight or not self._transmit(message, destination.addr):
+                continue
+
+            destination.tokens -= 1
+            destination.counters["sent"] += 1
+            destination.in_flight[message.internal_ext_id] = (now, retransmission)
+            self._in_flight[message.internal_ext_id] = destination
+
+    def _next_queue(self, destination):
+        # Returns the queue of the lane to send from next, or None if no
+        # message may be sent right now.
+        in_flight = len(destination.in_flight)
+        if in_flight >= self._window:
+            return None
+        last = self._lanes[-1]
+        for lane, queue in destination.queues.items():
+            if queue and (lane != last or in_flight < self._window - self._reserved):
+                return queue
+        return None
+
+    def _wake(self, destination):
+        destination.timer = None
+        self._pump(destination)
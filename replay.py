@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+"""
+Replays captured traffic through the drivers of the messaging server.
+
+Capture files are written by "snom_messaging.py --capture PATH". The
+datagrams received in a capture are fed to a UdpServer with all drivers
+attached: At their original pacing, N times faster (--speed N) or as fast
+as possible (--speed 0). Datagrams sent by the server are counted, but not
+sent anywhere, so real BaseStations are never contacted.
+
+Status frames in a capture refer to the internal ids of the original run.
+They do not match the messages queued during the replay and are reported as
+unknown.
+
+Rotated capture files have to be given oldest first, e.g.
+"./replay.py capture.2 capture.1 capture".
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+import snom_messaging
+from capture import Capture, read_capture
+from metrics import Registry
+
+# Yield to the event loop after this many datagrams when replaying as fast
+# as possible, so the outbox is processed meanwhile.
+_BATCH = 1000
+
+
+class ReplayTransport(asyncio.DatagramTransport):
+
+    """
+    Counts the datagrams sent by the server instead of sending them.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.datagrams = 0
+        self.bytes = 0
+        self._closing = False
+
+    def sendto(self, data, addr=None):
+        self.datagrams += 1
+        self.bytes += len(data)
+
+    def get_extra_info(self, name, default=None):
+        return default
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        self._closing = True
+
+
+async def replay(paths, speed, protocol):
+    """
+    Feeds the received datagrams of the capture files at paths to protocol.
+    Returns a tuple of the number of datagrams replayed and the number of
+    datagrams sent in the original run.
+    """
+
+    loop = asyncio.get_event_loop()
+    replayed = captured_out = 0
+    first = began = None
+    for path in paths:
+        for timestamp, direction, data, addr in read_capture(path):
+            if direction != Capture.IN:
+                captured_out += 1
+                continue
+
+            if first is None:
+                first, began = timestamp, loop.time()
+            elif speed:
+                delay = (timestamp - first) / speed - (loop.time() - began)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            protocol.datagram_received(data, addr)
+            replayed += 1
+            if not speed and replayed % _BATCH == 0:
+                await asyncio.sleep(0)
+    return replayed, captured_out
+
+
+async def _main(args):
+    transport = ReplayTransport()
+    protocol = snom_messaging.UdpServer()
+    protocol.connection_made(transport)
+    registry = Registry()
+    message_system = snom_messaging.attach_drivers(protocol, registry=registry)
+
+    began = time.perf_counter()
+    replayed, captured_out = await replay(args.captures, args.speed, protocol)
+    duration = time.perf_counter() - began
+    # Give the outbox the chance to send what is due.
+    await asyncio.sleep(args.drain)
+    protocol.flush()
+
+    print("Duration:            {:10.2f} s".format(duration))
+    print("Datagrams replayed:  {:10} ({:.0f}/s)".format(replayed, replayed / duration if duration else 0))
+    print("Datagrams sent:      {:10} ({} in the capture)".format(transport.datagrams, captured_out))
+    print("Outbox:              {:10} messages".format(len(message_system._queue)))
+    if args.metrics:
+        print(registry.render())
+
+    message_system.close()
+    transport.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("captures", metavar="CAPTURE", nargs="+", help="capture files, oldest first")
+    parser.add_argument("--speed", type=float, default=1,
+                        help="replay N times faster than captured, 0 for as fast as possible (default: %(default)s)")
+    parser.add_argument("--drain", type=float, default=1, help="seconds to run the server after the replay")
+    parser.add_argument("--metrics", action="store_true", help="print the metrics of the server")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    asyncio.run(_main(args))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+import logging
+import random
+logger = logging.getLogger(__name__)
+
+class RetryPolicy():
+
+    """
+    This class decides when queued messages are sent to their recipients.
+
+    As long as a recipient answers, every message is sent on its own and
+    resent every interval seconds until its delivery is confirmed.
+
+    Once a recipient is reported absent (status 11), only a single message
+    for this recipient is sent: The probe. All other messages for the
+    recipient are parked. The probe is resent with an exponential backoff
+    (with jitter) for every further absent answer. Once a message is
+    delivered to the recipient or the recipient shows up on a BaseStation,
+    the policy for this recipient is reset and all its messages are sent
+    again.
+
+    All decisions are counted in counters.
+    """
+
+    SEND = "send"
+    PROBE = "probe"
+    WAIT = "wait"
+    PARK = "park"
+
+    def __init__(self, interval=60, backoff=60, factor=2, max_backoff=3600, jitter=0.1):
+        """
+        Creates a new RetryPolicy.
+
+        Messages without an answer are resent after interval seconds.
+        After the n-th absent answer in a row, the next probe is sent after
+        backoff * factor**(n-1) seconds, but at most max_backoff seconds.
+        These times are randomly varied by +/- jitter (a fraction).
+        """
+
+        self.interval = interval
+        self._backoff = backoff
+        self._factor = factor
+        self._max_backoff = max_backoff
+        self._jitter = jitter
+
+        # recipient => [absent answers in a row, time of next probe, internal id of the probe]
+        self._absent = {}
+
+        self.counters = {
+            RetryPolicy.SEND: 0,
+            RetryPolicy.PROBE: 0,
+            RetryPolicy.WAIT: 0,
+            RetryPolicy.PARK: 0,
+            "absent": 0,
+            "backoff": 0,
+            "reset": 0,
+        }
+
+    def is_absent(self, recipient):
+        return recipient in self._absent
+
+    def backoff(self, failures):
+        """
+        Returns the seconds to wait before probing a recipient after failures
+        absent answers in a row.
+        """
+
+        delay = min(self._max_backoff, self._backoff * self._factor ** (failures - 1))
+        return delay * random.uniform(1 - self._jitter, 1 + self._jitter)
+
+    def decide(self, recipient, internal_ext_id, now):
+        """
+        Decides what to do with a message that is due.
+
+        Returns a tuple (action, when):
+        * (SEND, None): Send the message.
+        * (PROBE, None): Send the message as probe for an absent recipient.
+        * (WAIT, when): The message is the probe, but it is not due before when.
+        * (PARK, None): Another message is the probe. Park this one.
+        """
+
+        state = self._absent.get(recipient)
+        if state is None:
+            action, when = RetryPolicy.SEND, None
+        elif state[2] is not None and state[2] != internal_ext_id:
+            action, when = RetryPolicy.PARK, None
+        else:
+            state[2] = internal_ext_id
+            if now < state[1]:
+                action, when = RetryPolicy.WAIT, state[1]
+            else:
+                action, when = RetryPolicy.PROBE, None
+
+        self.counters[action] += 1
+        return action, when
+
+    def absent(self, recipient, internal_ext_id, now):
+        """
+        Records an absent answer for a message and decides what to do with it.
+        See decide() for the return value.
+
+        Absent answers for messages sent before the recipient was due to be
+        probed again (e.g. for several messages sent at once) do not increase
+        the backoff.
+        """
+
+        self.counters["absent"] += 1
+        state = self._absent.get(recipient)
+        if state is None:
+            state = self._absent[recipient] = [0, now, None]
+        if now >= state[1]:
+            state[0] += 1
+            state[1] = now + self.backoff(state[0])
+            self.counters["backoff"] += 1
+            logger.debug("%s is absent (%s times in a row). Next probe in %.0f s", recipient, state[0], state[1] - now)
+        return self.decide(recipient, internal_ext_id, now)
+
+    def discard(self, recipient, internal_ext_id):
+        """
+        Forgets a message that left the queue.
+        Returns True if it was the probe for its recipient.
+        """
+
+        state = self._absent.get(recipient)
+        if state is not None and state[2] == internal_ext_id:
+            state[2] = None
+            return True
+        return False
+
+    def reset(self, recipient):
+        """
+        Marks a recipient as reachable again.
+        Returns True if the recipient was considered absent.
+        """
+
+        if self._absent.pop(recipient, None) is not None:
+            self.counters["reset"] += 1
+            return True
+        return False
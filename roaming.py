@@ -1,67 +1,248 @@
 import logging
 import asyncio
-import xml.etree.ElementTree as ET
+import json
+import os
 import random
 import time
 logger = logging.getLogger(__name__)
 
 class RoamingMonitor():
 
-    def __init__(self, udp_server):
+    """
+    This class keeps track of the BaseStation every handset is logged in to.
+
+    Every BaseStation regularly lists its handsets in a systeminfo frame.
+    The list is compared to the handsets we know on this BaseStation, so
+    only handsets that arrived, moved or left are touched. Handsets that are
+    not listed anymore are forgotten.
+
+    Locations are only valid as long as their BaseStation keeps sending
+    systeminfo frames. The handsets of a BaseStation that has not been heard
+    of for ttl seconds are forgotten.
+
+    If a snapshot path is given, the locations are saved there regularly and
+    on close(), and loaded again on startup. So messages can be delivered
+    right after a restart, without waiting for the next systeminfo frames.
+
+    For handsets without a (valid) location, a hint may be asked instead,
+    see set_hint().
+    """
+
+    def __init__(self, udp_server, ttl=300, snapshot=None):
         self._udp_server = udp_server
-        self._udp_server.register_driver(self)
+        self._udp_server.register_driver(self, {
+            ("request", "systeminfo"): self.process_systeminfo,
+            ("request", "login"): self.process_login,
+            # ("request", "alarm"): not sure if this updates only contain connected phones...
+        }, observe=True)
 
+        self._ttl = ttl
+        # number => addr of its BaseStation
         self._locations = {}
+        # addr of a BaseStation => set of numbers located there
+        self._stations = {}
+        # addr of a BaseStation => time of its last frame
+        self._heard = {}
+        self._listeners = []
+        self._hint = None
+        self.counters = {
+            "hinted": 0,
+        }
+
+        self._snapshot = snapshot
+        if snapshot is not None:
+            self._load(snapshot)
+
+        self._sweep_handle = asyncio.get_event_loop().call_later(self._ttl / 4, self._sweep)
+
+    def add_listener(self, callback):
+        """
+        Registers a callback that is called with (number, addr) whenever a
+        handset shows up on a BaseStation: When it is seen for the first time,
+        moves to another BaseStation or logs in.
+        """
+
+        self._listeners.append(callback)
+
+    def set_hint(self, hint):
+        """
+        Sets a callable returning the address of a BaseStation a handset is
+        probably reachable at, or None. It is asked for handsets without a
+        location, e.g. telemetry.Telemetry.strongest().
+        """
+
+        self._hint = hint
+
+    def hinted(self, number, addr):
+        """
+        Tells the listeners that number is probably reachable at addr, if it
+        has no location. Messages for it are sent using the hint then.
+        """
+
+        location = self._locations.get(number)
+        if location is None or self._heard[location] + self._ttl < time.time():
+            self._located(number, addr)
+
+    def _located(self, number, addr):
+        for callback in self._listeners:
+            try:
+                callback(number, addr)
+            except Exception as exp:
+                logger.warning("Location listener %s failed with exception %s.", callback, exp)
+
+    def attach_metrics(self, registry):
+        registry.gauge("snom_located_handsets", "Handsets with a known BaseStation", lambda: len(self._locations))
+        registry.counter("snom_location_hints_total", "Addresses taken from the hint for handsets without a location",
+                         lambda: self.counters["hinted"])
 
     def close(self):
-        #TODO: Implement proper shutdown of this function.
-        pass
+        """
+        Stops expiring locations and saves the snapshot.
+        """
+
+        if self._sweep_handle is not None:
+            self._sweep_handle.cancel()
+            self._sweep_handle = None
+            if self._snapshot is not None:
+                self._save(self._snapshot)
+
+    def _save(self, path):
+        stations = [
+            {"host": addr[0], "port": addr[1], "heard": self._heard[addr], "numbers": sorted(numbers)}
+            for addr, numbers in self._stations.items() if numbers
+        ]
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump({"stations": stations}, f)
+            os.replace(tmp_path, path)
+        except OSError as exp:
+            logger.error("Failed to save locations to %s: %s", path, exp)
+            return
+        logger.debug("Saved %s locations to %s", len(self._locations), path)
+
+    def _load(self, path):
+        try:
+            with open(path) as f:
+                stations = json.load(f)["stations"]
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError) as exp:
+            logger.warning("Ignoring locations in %s: %s", path, exp)
+            return
+
+        # Locations age from the time their BaseStation was last heard of,
+        # not from the time they are loaded.
+        now = time.time()
+        for station in stations:
+            if station["heard"] + self._ttl < now:
+                continue
+            addr = (station["host"], station["port"])
+            self._heard[addr] = station["heard"]
+            for number in station["numbers"]:
+                self._move(number, addr)
+        logger.info("Loaded %s locations from %s", len(self._locations), path)
+
+    def __len__(self):
+        return len(self._locations)
 
     def get_addr(self, number):
-        if number in self._locations:
-            return self._locations[number]["addr"]
-        return None
-
-    def process(self, xml_message, addr):
-        if xml_message.tag == "request" and xml_message.attrib["type"] == "systeminfo":
-#                xml_message.tag == "request" and xml_message.attrib["type"] == "alarm": # not sure if this updates only contain connected phones...
-            logger.debug("Systeminfo update received")
-
-            senderdata = xml_message.find("senderdata")
-            for element in senderdata.findall("address"):
-                if element.text in self._locations:
-                    if not self._locations[element.text]["addr"] == addr:
-                        logger.info("Updated {}  to {}".format(element.text, addr))
-                        self._locations[element.text]["addr"] = addr
-                        self._locations[element.text]["time"] = time.time()
-                    else:
-                        logger.info("Already known: {} on {}".format(element.text, addr))
-                        self._locations[element.text]["time"] = time.time()
-                else:
-                    logger.info("Added {} on {}".format(element.text, addr))
-                    self._locations[element.text] = { "addr": addr, "time": time.time() }
-
-        if xml_message.tag == "request" and xml_message.attrib["type"] == "login":
-            logger.debug("Login event received")
-
-            status = xml_message.find("logindata").find("status")
-            address = xml_message.find("senderdata").find("address")
-
-            if status.text == "0":
-                if address.text in self._locations:
-                    logger.info("{} logged out".format(address.text))
-                    del self._locations[address.text]
-                else:
-                    logger.info("{} logged out but wasn't known".format(address.text))
-            elif status.text == "1":
-                if address.text in self._locations:
-                    logger.info("{} logged in on {} and was already known".format(address.text, addr))
-                    self._locations[address.text]["addr"] = addr
-                    self._locations[address.text]["time"] = time.time()
-                else:
-                    logger.info("{} logged in on {} (and wasn't known until know...)".format(address.text, addr))
-                    self._locations[address.text] = {"addr": addr, "time": time.time() }
-
-
-
-        return False
+        addr = self._locations.get(number)
+        if addr is not None and self._heard[addr] + self._ttl < time.time():
+            addr = None
+        if addr is None and self._hint is not None:
+            addr = self._hint(number)
+            if addr is not None:
+                self.counters["hinted"] += 1
+        return addr
+
+    def numbers(self):
+        """
+        Returns the numbers of all handsets located right now, grouped by
+        their BaseStation.
+        """
+
+        now = time.time()
+        return [
+            number
+            for addr, numbers in self._stations.items() if self._heard.get(addr, 0) + self._ttl >= now
+            for number in sorted(numbers)
+        ]
+
+    def _move(self, number, addr):
+        # Returns True if number was not located at addr before.
+        old = self._locations.get(number)
+        if old == addr:
+            return False
+        if old is not None:
+            self._stations[old].discard(number)
+        self._locations[number] = addr
+        self._stations.setdefault(addr, set()).add(number)
+        return True
+
+    def _forget(self, number):
+        addr = self._locations.pop(number, None)
+        if addr is not None:
+            self._stations[addr].discard(number)
+        return addr
+
+    def _sweep(self):
+        """
+        Forgets all handsets of BaseStations that have not been heard of for
+        ttl seconds.
+        """
+
+        now = time.time()
+        for addr, heard in list(self._heard.items()):
+            if heard + self._ttl < now:
+                numbers = self._stations.pop(addr, ())
+                for number in numbers:
+                    del self._locations[number]
+                del self._heard[addr]
+                logger.info("No frames from %s for %.0f s. Forgot its %s handsets", addr, now - heard, len(numbers))
+        if self._snapshot is not None:
+            self._save(self._snapshot)
+        self._sweep_handle = asyncio.get_event_loop().call_later(self._ttl / 4, self._sweep)
+
+    def process_systeminfo(self, frame, addr):
+        logger.debug("Systeminfo update received")
+        self._heard[addr] = time.time()
+
+        listed = set(frame.findall("senderdata/address"))
+        known = self._stations.get(addr)
+        if known is None:
+            known = self._stations[addr] = set()
+        if listed == known:
+            return
+
+        for address in known - listed:
+            logger.info("%s left %s", address, addr)
+            self._forget(address)
+
+        for address in listed - known:
+            old = self._locations.get(address)
+            if old is None:
+                logger.info("Added %s on %s", address, addr)
+            else:
+                logger.info("Updated %s  to %s", address, addr)
+            self._move(address, addr)
+            self._located(address, addr)
+
+    def process_login(self, frame, addr):
+        logger.debug("Login event received")
+        self._heard[addr] = time.time()
+
+        status = frame.findtext("logindata/status")
+        address = frame.findtext("senderdata/address")
+
+        if status == "0":
+            if self._forget(address) is not None:
+                logger.info("%s logged out", address)
+            else:
+                logger.info("%s logged out but wasn't known", address)
+        elif status == "1":
+            if self._move(address, addr):
+                logger.info("%s logged in on %s", address, addr)
+            else:
+                logger.info("%s logged in on %s and was already known", address, addr)
+            self._located(address, addr)
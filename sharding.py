@@ -0,0 +1,327 @@
+import logging
+import asyncio
+import multiprocessing
+import os
+import re
+import signal
+import socket
+import struct
+import zlib
+logger = logging.getLogger(__name__)
+
+# The front end only looks at what it needs for routing. Frames are parsed
+# by the workers.
+_root = re.compile(rb'<(request|response)\b[^>]*?\btype="([\w.-]+)"')
+_recipient = re.compile(rb"<persondata>\s*<address>([^<]*)</address>")
+_sender = re.compile(rb"<senderdata>\s*<address>([^<]*)</address>")
+_externalid = re.compile(rb"<externalid>\s*(\d+)\s*</externalid>")
+
+# Frames every worker needs to keep its view of the roaming table.
+_REPLICATED = frozenset((
+    (b"request", b"systeminfo"),
+    (b"request", b"login"),
+    (b"request", b"alarm"),
+))
+
+# IPv4 address and port of the origin of a frame handed to a worker.
+_origin = struct.Struct("!4sH")
+
+# Worker ends of the channels are read in batches of up to this many frames.
+_BATCH = 64
+
+
+def shard_of(number, shards):
+    """
+    Returns the index of the shard responsible for the extension number
+    (str or bytes).
+    """
+
+    if isinstance(number, str):
+        number = number.encode("UTF-8")
+    # Unlike hash(), this is the same in every process.
+    return zlib.crc32(number) % shards
+
+
+class ShardRouter(asyncio.DatagramProtocol):
+
+    """
+    This class is the front end of a sharded server. It owns the UDP socket
+    and hands every received frame to the worker responsible for it:
+
+    * Job requests (text messages) go to the shard of their recipient. So a
+      worker has all messages for its recipients in its outbox. They also go
+      to the shard of their sender, which handles the sender being
+      reachable (see MessageSystem.process_job()). Messages to one of the
+      groups go to all shards, each queues them for its own recipients.
+    * Job responses (status frames) go to the shard that sent the message.
+      Internal ids of a shard are congruent to its index, see MessageSystem.
+    * Systeminfo, login and alarm frames go to all workers. Every worker has
+      its own copy of the roaming table.
+    * Everything else goes to the first worker.
+
+    Workers get the frames over Unix datagram sockets (channels). A frame
+    that does not fit into the buffer of a channel is dropped: The
+    BaseStation retransmits unconfirmed text messages, unanswered messages
+    are sent again.
+    """
+
+    def __init__(self, channels, groups=()):
+        self._channels = channels
+        self._groups = groups
+        self._all = range(len(channels))
+        self.counters = {
+            "routed": [0] * len(channels),
+            "dropped": [0] * len(channels),
+        }
+
+    def datagram_received(self, data, addr):
+        try:
+            origin = _origin.pack(socket.inet_aton(addr[0]), addr[1])
+        except OSError:
+            logger.warning("Ignoring datagram from {}".format(addr))
+            return
+        for frame in data.split(b"\0"):
+            if not frame:
+                continue
+            for shard in self.route(frame):
+                try:
+                    self._channels[shard].send(origin + frame)
+                    self.counters["routed"][shard] += 1
+                except BlockingIOError:
+                    self.counters["dropped"][shard] += 1
+                except OSError as exp:
+                    self.counters["dropped"][shard] += 1
+                    logger.error("Failed to hand a frame to worker {}: {}".format(shard, exp))
+
+    def route(self, frame):
+        """
+        Returns the indexes of the workers a frame is handed to.
+        """
+
+        shards = len(self._channels)
+        match = _root.search(frame)
+        if match is None:
+            return (0,)
+        key = match.groups()
+        if key in _REPLICATED:
+            return self._all
+        if key == (b"request", b"job"):
+            recipient = _recipient.search(frame, match.end())
+            if recipient is not None:
+                if recipient.group(1).decode("UTF-8", "replace") in self._groups:
+                    return self._all
+                shard = shard_of(recipient.group(1), shards)
+                sender = _sender.search(frame, match.end())
+                if sender is not None and shard_of(sender.group(1), shards) != shard:
+                    return (shard, shard_of(sender.group(1), shards))
+                return (shard,)
+        elif key == (b"response", b"job"):
+            externalid = _externalid.search(frame, match.end())
+            if externalid is not None:
+                return (int(externalid.group(1)) % shards,)
+        return (0,)
+
+    def error_received(self, exc):
+        logger.debug("UDP Socket: Got exception: {}".format(exc))
+
+
+class SharedTransport(asyncio.DatagramTransport):
+
+    """
+    Sends datagrams over the UDP socket shared by all workers. Nothing is
+    read from it in the workers, that is up to the front end.
+    """
+
+    def __init__(self, sock):
+        super().__init__()
+        self._sock = sock
+        self._closing = False
+
+    def sendto(self, data, addr=None):
+        try:
+            self._sock.sendto(data, addr)
+        except BlockingIOError:
+            logger.warning("Socket buffer full. Dropping datagram to {}".format(addr))
+        except OSError as exp:
+            logger.debug("UDP Socket: Got exception: {}".format(exp))
+
+    def get_extra_info(self, name, default=None):
+        if name == "socket":
+            return self._sock
+        if name == "sockname":
+            return self._sock.getsockname()
+        return default
+
+    def is_closing(self):
+        return self._closing
+
+    def close(self):
+        self._closing = True
+
+
+class ShardedServer():
+
+    """
+    This class runs a server as a front end (see ShardRouter) and a number
+    of worker processes, so the work is spread over several cores.
+
+    Every worker runs its own event loop with a UdpServer and all drivers,
+    set up by the coroutine function setup. It is called in the worker with
+    (index, transport) and returns a tuple of the UdpServer and a callable
+    that shuts everything down. The transport sends over the shared UDP
+    socket, so datagrams leave from the same port they arrive at.
+
+    The workers are forked, before the front end starts its event loop.
+    """
+
+    def __init__(self, sock, workers, setup, buffer=4*1024*1024, groups=()):
+        """
+        Creates a new ShardedServer for the bound UDP socket sock.
+
+        The channels to the workers buffer up to buffer bytes each. Messages
+        to the groups (see groups.Groups) are handed to all workers.
+        """
+
+        if workers < 1:
+            raise ValueError("At least one worker is needed")
+        self._sock = sock
+        self._setup = setup
+        self._workers = workers
+        self._buffer = buffer
+        self._groups = groups
+        self._channels = []
+        self._processes = []
+        self._transport = None
+        self._watch_handle = None
+        self.router = None
+
+    def start(self):
+        """
+        Forks the workers.
+        """
+
+        ends = []
+        for _ in range(self._workers):
+            front, worker = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+            front.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self._buffer)
+            worker.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._buffer)
+            front.setblocking(False)
+            self._channels.append(front)
+            ends.append(worker)
+
+        context = multiprocessing.get_context("fork")
+        for index in range(self._workers):
+            process = context.Process(target=_work, name="snom-worker-{}".format(index),
+                                      args=(index, self._sock, ends, self._channels, self._setup))
+            process.start()
+            self._processes.append(process)
+        for worker in ends:
+            worker.close()
+        logger.info("Started {} workers".format(self._workers))
+
+    async def serve(self, stopped):
+        """
+        Starts routing frames to the workers. stopped is called if a worker
+        dies.
+        """
+
+        loop = asyncio.get_event_loop()
+        self.router = ShardRouter(self._channels, self._groups)
+        self._transport, _ = await loop.create_datagram_endpoint(lambda: self.router, sock=self._sock)
+        self._watch_handle = loop.call_later(1, self._watch, stopped)
+
+    def _watch(self, stopped):
+        for index, process in enumerate(self._processes):
+            if not process.is_alive():
+                logger.error("Worker {} exited with {}. Stopping".format(index, process.exitcode))
+                stopped()
+                return
+        self._watch_handle = asyncio.get_event_loop().call_later(1, self._watch, stopped)
+
+    def send_signal(self, signum):
+        """
+        Sends the signal signum to all workers.
+        """
+
+        for process in self._processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    def close(self, timeout=30):
+        """
+        Stops routing and waits up to timeout seconds for the workers to
+        shut down (writing their journals).
+        """
+
+        if self._watch_handle is not None:
+            self._watch_handle.cancel()
+            self._watch_handle = None
+        if self._transport is not None:
+            self._transport.close()
+            self._transport = None
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self._processes:
+            process.join(timeout)
+            if process.is_alive():
+                logger.error("Worker {} did not shut down. Killing it".format(process.name))
+                process.kill()
+        for channel in self._channels:
+            channel.close()
+
+
+def _work(index, sock, ends, channels, setup):
+    # The main function of a worker process.
+    for channel in channels:
+        channel.close()
+    channel = ends[index]
+    for i, end in enumerate(ends):
+        if i != index:
+            end.close()
+    channel.setblocking(False)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    protocol, close = loop.run_until_complete(setup(index, SharedTransport(sock)))
+
+    def receive():
+        for _ in range(_BATCH):
+            try:
+                data = channel.recv(65536)
+            except BlockingIOError:
+                return
+            host, port = _origin.unpack_from(data)
+            protocol.datagram_received(data[_origin.size:], (socket.inet_ntoa(host), port))
+
+    parent = os.getppid()
+
+    def watch():
+        # Do not outlive the front end, e.g. if it was killed.
+        if os.getppid() != parent:
+            logger.error("Front end is gone. Stopping worker {}".format(index))
+            loop.stop()
+        else:
+            loop.call_later(1, watch)
+
+    loop.add_reader(channel.fileno(), receive)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, loop.stop)
+    loop.call_later(1, watch)
+    logger.info("Worker {} started".format(index))
+    try:
+        loop.run_forever()
+    finally:
+        # Further signals (e.g. from the front end) must not interrupt
+        # writing the journal.
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(signum)
+            signal.signal(signum, signal.SIG_IGN)
+        loop.remove_reader(channel.fileno())
+        close()
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        loop.close()
+    logger.info("Worker {} stopped".format(index))
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+
+"""
+Load-testing simulator for the messaging server.
+
+This script simulates a multicell setup of M700 BaseStations with virtual
+handsets on localhost. Every virtual BaseStation has its own UDP socket and
+speaks the same protocol as the real ones:
+* Handsets log in and are listed in regular systeminfo frames
+* Handsets send alarm frames
+* Handsets send text messages (job requests) to each other
+* Text messages sent by the server are acknowledged with status 1
+  (delivered) or 11 (user absent, if the handset is switched off)
+* Handsets can be switched on and off (without logging out) during the run
+
+By default the server is started in the same process, so its memory usage can
+be measured as well. Use --target to load an already running server instead,
+or --workers to start snom_messaging.py in processes of its own (e.g. to
+compare the throughput with different numbers of workers).
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import signal
+import socket
+import sys
+import time
+import tracemalloc
+from frames import Frame
+from templates import Template, JOB_REQUEST
+from retry import RetryPolicy
+from pacing import SendScheduler
+from metrics import Registry
+from capture import Capture
+import snom_messaging
+
+logger = logging.getLogger(__name__)
+
+_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<request version="19.11.12.1403" type="{{type}}">
+<externalid>{{eid}}</externalid>
+<systemdata>
+<name>M700</name>
+<datetime>{{dt}}</datetime>
+<timestamp>{{ts}}</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+"""
+
+# The list of handsets is appended to SYSTEMINFO, followed by SYSTEMINFO_END.
+SYSTEMINFO = Template(_HEADER.replace("{{type}}", "systeminfo") + """<senderdata>
+""")
+SYSTEMINFO_END = b"""</senderdata>
+</request>
+\0"""
+
+LOGIN = Template(_HEADER.replace("{{type}}", "login") + """<logindata>
+<status>{{status}}</status>
+</logindata>
+<senderdata>
+<address>{{ext}}</address>
+<name>no{{ext}}</name>
+<location>{{location}}</location>
+</senderdata>
+</request>
+\0""")
+
+ALARM = Template(_HEADER.replace("{{type}}", "alarm") + """<alarmdata>
+<type>16</type>
+</alarmdata>
+<rssidata>
+<rfpi>{{rfpi}}</rfpi>
+<rssi>{{rssi}}</rssi>
+</rssidata>
+<senderdata>
+<address>{{ext}}</address>
+<name>no{{ext}}</name>
+<location>{{location}}</location>
+</senderdata>
+</request>
+\0""")
+
+STATUS = Template("""<?xml version="1.0" encoding="UTF-8"?>
+<response version="19.11.12.1403" type="job">
+<externalid>{{eid}}</externalid>
+<systemdata>
+<name>M700</name>
+<datetime>{{dt}}</datetime>
+<timestamp>{{ts}}</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+<jobdata>
+<status>{{status}}</status>
+</jobdata>
+</response>
+\0""")
+
+
+def _systemdata():
+    now = time.time()
+    return {
+        "eid": "{:010}".format(random.randrange(9999999999+1)),
+        "dt": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)),
+        "ts": "{:08x}".format(int(now)),
+    }
+
+
+def _percentile(values, p):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+class Statistics():
+
+    """
+    Collects the measurements of a simulation run.
+    """
+
+    def __init__(self):
+        self.sent = 0
+        self.confirmed = 0
+        self.delivered = 0
+        self.absent = 0
+        self.retries = 0
+        self.switched_on = 0
+        self.switched_off = 0
+        self.retransmitted = 0
+        self.datagrams_in = 0
+        self.datagrams_out = 0
+        self.latencies = []
+        self.urgent_latencies = []
+        self.confirm_latencies = []
+
+        # seq => time the job request has been sent
+        self.sent_at = {}
+        # externalid of a job request => time it has been sent
+        self.unconfirmed = {}
+        # internal id of the server => number of times it has been received
+        self.received = {}
+
+    def report(self, duration, sending, output=print):
+        """
+        Prints the results of a run that took duration seconds, of which
+        messages have been sent for sending seconds.
+        """
+
+        latencies = sorted(self.latencies)
+        urgent = sorted(self.urgent_latencies)
+        confirm = sorted(self.confirm_latencies)
+        output("Duration:            {:10.2f} s".format(duration))
+        output("Messages sent:       {:10} ({:.0f}/s)".format(self.sent, self.sent / sending))
+        output("Retransmitted:       {:10}".format(self.retransmitted))
+        output("Confirmed:           {:10} ({:.0f}/s)".format(self.confirmed, self.confirmed / duration))
+        output("Delivered:           {:10} ({:.0f}/s)".format(self.delivered, self.delivered / duration))
+        output("Answered absent:     {:10}".format(self.absent))
+        output("Retries:             {:10}".format(self.retries))
+        output("Handsets switched on:{:10}".format(self.switched_on))
+        output("Handsets switched off:{:9}".format(self.switched_off))
+        output("Datagrams in / out:  {:10} / {}".format(self.datagrams_in, self.datagrams_out))
+        for name, values in (("Confirmation", confirm), ("Delivery", latencies), ("Urgent deliv.", urgent)):
+            if not values and name == "Urgent deliv.":
+                continue
+            output("{:13} latency p50 {:8.2f} ms  p90 {:8.2f} ms  p99 {:8.2f} ms  max {:8.2f} ms".format(
+                name,
+                _percentile(values, 50) * 1e3,
+                _percentile(values, 90) * 1e3,
+                _percentile(values, 99) * 1e3,
+                (values[-1] if values else float("nan")) * 1e3,
+            ))
+
+
+class VirtualBaseStation(asyncio.DatagramProtocol):
+
+    """
+    A single simulated M700 with its own UDP socket.
+    """
+
+    def __init__(self, simulator, name):
+        self.name = name
+        self.rfpi = "{:010x}".format(random.randrange(16**10))
+        self.handsets = []
+        self._simulator = simulator
+        self._transport = None
+
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def send(self, dgram):
+        self._simulator.stats.datagrams_out += 1
+        self._transport.sendto(dgram, self._simulator.target)
+
+    def send_systeminfo(self):
+        # Handset numbers are generated by us, so they do not need escaping.
+        handsets = "".join("<address>{0}</address>\n<name>no{0}</name>\n".format(ext) for ext in self.handsets
+                           if self._simulator.is_online(ext))
+        self.send(SYSTEMINFO.render(**_systemdata()) + handsets.encode("UTF-8") + SYSTEMINFO_END)
+
+    def send_login(self, ext, status=1):
+        self.send(LOGIN.render(ext=ext, status=status, location=self.name, **_systemdata()))
+
+    def send_alarm(self, ext):
+        self.send(ALARM.render(ext=ext, location=self.name, rfpi=self.rfpi,
+                               rssi=random.randrange(100, 255), **_systemdata()))
+
+    def send_job(self, seq, from_ext, to_ext, retransmit_after=None, priority=0):
+        """
+        Sends a text message and returns its externalid.
+        The same frame is sent again after retransmit_after seconds, if given.
+        """
+
+        systemdata = _systemdata()
+        dgram = JOB_REQUEST.render(
+            priority=priority,
+            msg="sim {}".format(seq),
+            from_ext=from_ext,
+            from_name="no{}".format(from_ext),
+            from_loc=self.name,
+            to_ext=to_ext,
+            **systemdata
+        )
+        self.send(dgram)
+        if retransmit_after is not None:
+            self._simulator.stats.retransmitted += 1
+            asyncio.get_event_loop().call_later(retransmit_after, self.send, dgram)
+        return systemdata["eid"]
+
+    def datagram_received(self, data, addr):
+        stats = self._simulator.stats
+        stats.datagrams_in += 1
+        for message in data.split(b"\0"):
+            if not message:
+                continue
+            frame = Frame.parse(message)
+            if frame.tag == "request" and frame.type == "job":
+                self._simulator.job_received(self, frame)
+            elif frame.tag == "response" and frame.type == "job":
+                self._simulator.confirmation_received(frame)
+
+
+class Simulator():
+
+    """
+    Drives a number of VirtualBaseStations against a server.
+    """
+
+    def __init__(self, target, base_stations, handsets, absent, retransmit=0, urgent=0):
+        self._urgent = urgent
+        self.target = target
+        self._retransmit = retransmit
+        self.stats = Statistics()
+        self._base_stations = []
+        self._n_base_stations = base_stations
+        self._handsets = [str(100 + i) for i in range(handsets)]
+        self._offline = set(random.sample(self._handsets, int(handsets * absent)))
+        self._location = {}
+        self._seq = 0
+
+    def is_online(self, ext):
+        return ext not in self._offline
+
+    def switch_on(self):
+        """
+        Switches on a random handset that is switched off.
+        """
+
+        if not self._offline:
+            return
+        ext = random.choice(tuple(self._offline))
+        self._offline.discard(ext)
+        self.stats.switched_on += 1
+        self._location[ext].send_login(ext)
+
+    def switch_off(self):
+        """
+        Switches off a random handset without logging it out.
+        """
+
+        online = [ext for ext in self._handsets if self.is_online(ext)]
+        if len(online) > 1:
+            self._offline.add(random.choice(online))
+            self.stats.switched_off += 1
+
+    async def start(self):
+        loop = asyncio.get_event_loop()
+        for i in range(self._n_base_stations):
+            _, bs = await loop.create_datagram_endpoint(
+                lambda: VirtualBaseStation(self, "M700-{}".format(i)),
+                local_addr=("127.0.0.1", 0))
+            self._base_stations.append(bs)
+
+        for i, ext in enumerate(self._handsets):
+            bs = self._base_stations[i % len(self._base_stations)]
+            bs.handsets.append(ext)
+            self._location[ext] = bs
+            if self.is_online(ext):
+                bs.send_login(ext)
+        for bs in self._base_stations:
+            bs.send_systeminfo()
+
+    def send_message(self):
+        online = [ext for ext in self._handsets if self.is_online(ext)]
+        sender = random.choice(online)
+        recipient = random.choice(self._handsets)
+        bs = self._location[sender]
+        self._seq += 1
+        self.stats.sent += 1
+        now = time.perf_counter()
+        self.stats.sent_at[self._seq] = now
+        retransmit_after = 0.05 if random.random() < self._retransmit else None
+        priority = 1 if random.random() < self._urgent else 0
+        self.stats.unconfirmed[bs.send_job(self._seq, sender, recipient, retransmit_after, priority)] = now
+
+    def job_received(self, bs, frame):
+        now = time.perf_counter()
+        stats = self.stats
+        internal_id = frame.findtext("externalid")
+        count = stats.received.get(internal_id, 0)
+        stats.received[internal_id] = count + 1
+        if count:
+            stats.retries += 1
+
+        if self.is_online(frame.findtext("persondata/address")):
+            status = 1
+            stats.delivered += 1
+            seq = int(frame.findtext("jobdata/messages/messageuui").split()[1])
+            sent_at = stats.sent_at.pop(seq, None)
+            if sent_at is not None:
+                if frame.findtext("jobdata/priority") != "0":
+                    stats.urgent_latencies.append(now - sent_at)
+                else:
+                    stats.latencies.append(now - sent_at)
+        else:
+            status = 11
+            stats.absent += 1
+        systemdata = _systemdata()
+        systemdata["eid"] = internal_id
+        bs.send(STATUS.render(status=status, **systemdata))
+
+    def confirmation_received(self, frame):
+        stats = self.stats
+        stats.confirmed += 1
+        sent_at = stats.unconfirmed.pop(frame.findtext("externalid"), None)
+        if sent_at is not None:
+            stats.confirm_latencies.append(time.perf_counter() - sent_at)
+
+    async def run(self, duration, rate, keepalive, switch_on_rate=0, switch_off_rate=0):
+        """
+        Sends rate messages per second for duration seconds.
+        switch_on_rate and switch_off_rate handsets per second are switched
+        on and off meanwhile.
+        """
+
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        next_keepalive = start + keepalive
+        while True:
+            now = loop.time()
+            if now - start >= duration:
+                break
+            # Catch up with the schedule, even if we slept longer than asked for.
+            while self.stats.sent < (now - start) * rate:
+                self.send_message()
+            while self.stats.switched_on < (now - start) * switch_on_rate and self._offline:
+                self.switch_on()
+            while self.stats.switched_off < (now - start) * switch_off_rate:
+                self.switch_off()
+            if now >= next_keepalive:
+                next_keepalive += keepalive
+                for bs in self._base_stations:
+                    bs.send_systeminfo()
+                    if bs.handsets:
+                        bs.send_alarm(random.choice(bs.handsets))
+            await asyncio.sleep(0.01)
+
+
+def _rss_kib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+async def _spawn_server(args):
+    """
+    Starts snom_messaging.py with args.workers workers in processes of its
+    own. Returns the process and its address once it is listening.
+    """
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "snom_messaging.py")
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, script, "--workers", str(args.workers), "--port", str(port),
+        "--retry-interval", str(args.retry_interval), "--window", str(args.window),
+        "--send-rate", str(args.send_rate), "--log-level", args.log_level,
+        *(["--coalesce", "*"] if args.coalesce else []))
+
+    # The port is taken once the server is up.
+    deadline = time.monotonic() + 10
+    while True:
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            probe.bind(("0.0.0.0", port))
+        except OSError:
+            return process, ("127.0.0.1", port)
+        finally:
+            probe.close()
+        if process.returncode is not None or time.monotonic() > deadline:
+            process.kill()
+            raise RuntimeError("The server did not start")
+        await asyncio.sleep(0.05)
+
+
+async def _main(args):
+    server = None
+    process = None
+    if args.target:
+        host, _, port = args.target.rpartition(":")
+        target = (host, int(port))
+    elif args.workers:
+        process, target = await _spawn_server(args)
+    else:
+        policy = RetryPolicy(interval=args.retry_interval, backoff=args.retry_interval)
+        scheduler = SendScheduler(window=args.window, rate=args.send_rate, max_rto=args.retry_interval)
+        registry = Registry()
+        server = await snom_messaging.start_server(("127.0.0.1", 0), retry_policy=policy, scheduler=scheduler, registry=registry)
+        target = server[0].get_extra_info("sockname")
+        if args.coalesce:
+            server[1].set_coalescing("*")
+        if args.capture:
+            capture = Capture(args.capture)
+            server[1].set_capture(capture)
+
+    rss_before = _rss_kib()
+    if args.tracemalloc:
+        tracemalloc.start()
+
+    simulator = Simulator(target, args.base_stations, args.handsets, args.absent, args.retransmit, args.urgent)
+    await simulator.start()
+    began = time.perf_counter()
+    await simulator.run(args.duration, args.rate, args.keepalive, args.switch_on, args.switch_off)
+    # Give the server the chance to deliver the last messages.
+    await asyncio.sleep(args.drain)
+    duration = time.perf_counter() - began
+
+    simulator.stats.report(duration, args.duration)
+    if process is not None:
+        process.send_signal(signal.SIGTERM)
+        await process.wait()
+    if server is not None:
+        print("Outbox:              {:10} messages".format(len(server[2]._queue)))
+        print("Dedup cache:         {}".format(", ".join("{}={}".format(*c) for c in server[2]._dedup_cache.counters.items())))
+        print("Retry decisions:     {}".format(", ".join("{}={}".format(*c) for c in policy.counters.items())))
+        counters = server[1].counters
+        print("Server frames out:   {:10} in {} datagrams ({:.2f} frames per sendto)".format(
+            counters["frames"], counters["datagrams"], counters["frames"] / max(1, counters["datagrams"])))
+        for destination in scheduler.destinations():
+            srtt = "-" if destination.srtt is None else "{:.1f} ms".format(destination.srtt * 1000)
+            print("Pacing {}:{:5}: {}, in flight={}, queued={}, srtt={}, rto={:.2f} s".format(
+                destination.addr[0], destination.addr[1],
+                ", ".join("{}={}".format(*c) for c in destination.counters.items()),
+                len(destination.in_flight), destination.queued(), srtt, destination.rto))
+        if args.metrics:
+            print(registry.render())
+        print("Max RSS growth:      {:10} KiB".format(_rss_kib() - rss_before))
+        if args.tracemalloc:
+            current, peak = tracemalloc.get_traced_memory()
+            print("Traced memory:       {:10} KiB (peak {} KiB)".format(current // 1024, peak // 1024))
+        server[2].close()
+        server[0].close()
+        if args.capture:
+            capture.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--target", metavar="HOST:PORT", help="server to load, default: start one in-process")
+    parser.add_argument("--workers", type=int,
+                        help="start snom_messaging.py with this many workers in processes of its own")
+    parser.add_argument("--base-stations", type=int, default=4)
+    parser.add_argument("--handsets", type=int, default=1000)
+    parser.add_argument("--absent", type=float, default=0.1, help="fraction of handsets switched off")
+    parser.add_argument("--rate", type=float, default=200, help="messages per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to send messages")
+    parser.add_argument("--drain", type=float, default=2, help="seconds to wait for deliveries afterwards")
+    parser.add_argument("--retransmit", type=float, default=0, help="fraction of text messages sent twice")
+    parser.add_argument("--urgent", type=float, default=0, help="fraction of text messages with priority 1")
+    parser.add_argument("--switch-on", type=float, default=0, help="handsets switched on per second")
+    parser.add_argument("--switch-off", type=float, default=0, help="handsets switched off per second")
+    parser.add_argument("--keepalive", type=float, default=1, help="seconds between systeminfo frames")
+    parser.add_argument("--retry-interval", type=float, default=60, help="retry interval of the started server")
+    parser.add_argument("--window", type=int, default=32, help="send window of the started server")
+    parser.add_argument("--send-rate", type=float, default=100, help="messages per second and base station of the started server")
+    parser.add_argument("--coalesce", action="store_true", help="let the started server coalesce frames")
+    parser.add_argument("--metrics", action="store_true", help="print the metrics of the in-process server")
+    parser.add_argument("--capture", metavar="PATH", help="capture the traffic of the in-process server to PATH")
+    parser.add_argument("--tracemalloc", action="store_true", help="trace memory allocations (slow)")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.log_level)
+    asyncio.run(_main(args))
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,140 @@
 #!/usr/bin/env python3
 
+import argparse
 import logging
 import asyncio
-import xml.etree.ElementTree as ET
+import functools
+import inspect
 import random
+import signal
+import socket
+import time
+from frames import Frame
 from messagesystem import MessageSystem
 from consumer import ConsumerDriver
 from roaming import RoamingMonitor
+from journal import Journal
+from retry import RetryPolicy
+from pacing import SendScheduler
+from metrics import Counter, Histogram, Registry, MetricsServer
+from capture import Capture
+from dispatch import DriverQueue
+from handover import HandoverServer, take_over
+from injection import InjectionServer
+from groups import Groups
+from telemetry import Telemetry
+from sharding import ShardedServer
+from debuglog import FrameRing, JsonFormatter, Lines, Tracer, log_event
 
 logger = logging.getLogger(__name__)
 random.seed()
 
-def _prettyprint_mlstring(s, output):
-    l = s.split("\n")
-    j = 1
-    for i in l:
-        output("{:02} {}".format(j, i))
-        j += 1
+class UdpServer(asyncio.DatagramProtocol):
 
+    # Frames sent to a coalescing destination are packed into datagrams of at
+    # most this size. This fits into a single Ethernet frame.
+    max_datagram = 1472
 
-class UdpServer(asyncio.DatagramProtocol):
     def __init__(self):
         self._transport = None
         self._lastConnection = None
+
+        # Routing table: (root tag, type attribute) => (observers, consumer)
+        self._routes = {}
         self._drivers = []
+        # driver => dispatch.DriverQueue, for drivers that are not called
+        # from the receive path.
+        self._queues = {}
+
+        # Hosts frames are coalesced for. "*" stands for all hosts.
+        self._coalesce = set()
+        # addr => [frames, size in bytes] waiting for flush()
+        self._batches = {}
+        self._flush_handle = None
+
+        # capture.Capture of all datagrams, if enabled.
+        self._capture = None
+        # Everything datagrams are written to, see add_tap().
+        self._taps = ()
+
+        self.counters = {
+            "frames": 0,
+            "datagrams": 0,
+            "invalid": 0,
+        }
+
+        self._frames_received = Counter("snom_frames_received_total", "Frames received by root tag and type", ("tag", "type"))
+        self._parse_seconds = Histogram("snom_frame_parse_seconds", "Time spent parsing frames", ("tag", "type"))
+        self._driver_seconds = Histogram("snom_driver_seconds", "Time spent in driver handlers", ("driver", "tag", "type"))
+        self._send_seconds = Histogram("snom_send_seconds", "Time spent in send_dgram")
+        self._driver_errors = Counter("snom_driver_errors_total", "Exceptions raised by driver handlers", ("driver",))
+
+    def attach_metrics(self, registry):
+        registry.register(self._frames_received)
+        registry.register(self._parse_seconds)
+        registry.register(self._driver_seconds)
+        registry.register(self._send_seconds)
+        registry.register(self._driver_errors)
+        registry.gauge("snom_driver_queue_frames", "Frames waiting per queued driver",
+                       lambda: {type(d).__name__: len(q) for d, q in self._queues.items()}, ("driver",))
+        registry.gauge("snom_driver_queue_lag_seconds", "Time the oldest queued frame is waiting per queued driver",
+                       lambda: {type(d).__name__: q.lag() for d, q in self._queues.items()}, ("driver",))
+        for name, help in (("queued", "Frames queued"),
+                           ("handled", "Frames handled"),
+                           ("dropped", "Frames dropped because the queue was full")):
+            registry.counter("snom_driver_queue_{}_total".format(name), help + " per queued driver",
+                             lambda name=name: {type(d).__name__: q.counters[name] for d, q in self._queues.items()},
+                             ("driver",))
+        registry.counter("snom_frames_sent_total", "Frames sent", lambda: self.counters["frames"])
+        registry.counter("snom_datagrams_sent_total", "Datagrams sent", lambda: self.counters["datagrams"])
+        registry.counter("snom_frames_invalid_total", "Received datagrams without a frame", lambda: self.counters["invalid"])
 
     def connection_made(self, transport):
         self._transport = transport
         logger.debug("UDP Socket opened")
 
+    def set_capture(self, capture):
+        """
+        Writes all datagrams received and sent from now on to the
+        capture.Capture capture. None stops capturing.
+        """
+
+        if self._capture is not None:
+            self.remove_tap(self._capture)
+        self._capture = capture
+        if capture is not None:
+            self.add_tap(capture)
+
+    def add_tap(self, tap):
+        """
+        Writes all datagrams received and sent from now on to tap, e.g. a
+        capture.Capture, debuglog.FrameRing or debuglog.Tracer. Its method
+        write() is called with (time, Capture.IN or Capture.OUT, datagram,
+        addr). A tap that raises an exception is detached.
+        """
+
+        self._taps = self._taps + (tap,)
+
+    def remove_tap(self, tap):
+        self._taps = tuple(t for t in self._taps if t is not tap)
+        if tap is self._capture:
+            self._capture = None
+
+    def _write_taps(self, direction, data, addr):
+        # A tap that fails (e.g. a capture on a full disk) is detached. It
+        # must not keep frames from being handled or sent.
+        now = time.time()
+        for tap in self._taps:
+            try:
+                tap.write(now, direction, data, addr)
+            except Exception as exp:
+                logger.error("Writing to %s failed with exception %s. Detaching it", tap, exp)
+                self.remove_tap(tap)
+
     def datagram_received(self, data, addr):
-        logger.debug("incoming datagram from: {}".format(addr))
+        log_event(logger, logging.DEBUG, "received", addr=addr, size=len(data))
+        if self._taps:
+            self._write_taps(Capture.IN, data, addr)
         # Take a note of the last origin.
         # We assume this BaseStation will still be online when we are going to
         # send anything.
@@ -40,67 +144,523 @@ class UdpServer(asyncio.DatagramProtocol):
         # I haven't seen any datagram with more than one message inside.
         # But having them \0-terminated is either an off-by-one error or can
         # be a delimiter.
-        data = data.decode("UTF-8")
-        for message in data.split("\0"):
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for message in data.split(b"\0"):
             if not message:
                 # skip messages with len(0).
                 continue
 
-            _prettyprint_mlstring(message, logger.debug)
-            xml_message = ET.fromstring(message)
-            for driver in self._drivers:
-                # check if we find any driver for this message
-                try:
-                    if driver.process(xml_message, addr):
-                        break
-                except Exception as exp:
-                    logger.warning(
-                        "Message-Driver {} failed to process message with \
-                        exception {}.".format(driver, exp)
-                    )
+            if debug:
+                logger.debug("Frame from %s:\n%s", addr, Lines(message))
+            started = time.perf_counter()
+            try:
+                frame = Frame.parse(message)
+            except ValueError:
+                logger.warning("Received datagram that does not contain a frame from %s", addr)
+                self.counters["invalid"] += 1
+                continue
+
+            key = (frame.tag, frame.type)
+            self._parse_seconds.labels(*key).observe(time.perf_counter() - started)
+            self._frames_received.inc(*key)
+            observers, consumer = self._routes.get(key, ((), None))
+
+            for driver, handler in observers:
+                self._call_driver(driver, handler, frame, addr)
+
+            if consumer is not None:
+                self._call_driver(*consumer, frame, addr)
             else:
-                logger.warning("No driver is interested in this message. Dumping content.")
-                _prettyprint_mlstring(message, logger.warning)
+                self._unhandled_frame(key, message, addr)
+
+    def _call_driver(self, driver, handler, frame, addr):
+        queue = self._queues.get(driver)
+        if queue is not None:
+            queue.put(handler, frame, addr)
+            return
+
+        started = time.perf_counter()
+        try:
+            handler(frame, addr)
+        except Exception as exp:
+            logger.warning(
+                "Message-Driver {} failed to process message with \
+                exception {}.".format(driver, exp)
+            )
+            self._driver_errors.inc(type(driver).__name__)
+        self._driver_seconds.labels(type(driver).__name__, frame.tag, frame.type).observe(time.perf_counter() - started)
+
+    async def _await_driver(self, driver, handler, frame, addr):
+        # Called by the worker of a queued driver.
+        started = time.perf_counter()
+        try:
+            await handler(frame, addr)
+        except Exception as exp:
+            logger.warning(
+                "Message-Driver {} failed to process message with \
+                exception {}.".format(driver, exp)
+            )
+            self._driver_errors.inc(type(driver).__name__)
+        self._driver_seconds.labels(type(driver).__name__, frame.tag, frame.type).observe(time.perf_counter() - started)
+
+    def _unhandled_frame(self, key, message, addr):
+        logger.warning("No driver is interested in this %s/%s message. Dumping content.\n%s", *key, Lines(message))
 
     def error_received(self, exc):
-        logger.debug("UDP Socket: Got exception: {}".format(exc))
+        logger.debug("UDP Socket: Got exception: %s", exc)
+
+    def register_driver(self, driver, handlers, observe=False, queue_size=None, overflow=DriverQueue.DROP_OLDEST):
+        """
+        Attaches a driver to the routing table.
+
+        handlers maps the (root tag, type attribute) pairs of the frames the
+        driver is interested in to the callables handling them. These are
+        called with the frames.Frame and the origin address.
+        The fields available for every type of frame are listed in frames.FIELDS.
+
+        Every frame is delivered to all of its observers (observe=True) and
+        afterwards to its consumer. There can only be a single consumer per
+        frame. Frames without a consumer are dumped to the log.
+
+        Handlers are called right away, so they must not block. With a
+        queue_size, frames are queued for the driver instead and handled by
+        a worker task (see dispatch.DriverQueue with its overflow policies).
+        The handlers of such a driver need to be coroutine functions, so
+        they can wait for I/O without blocking the event loop.
+        """
 
-    def register_driver(self, driver):
-        logger.debug("Attached Driver {}".format(driver))
-        self._drivers.append(driver)
+        queued = queue_size is not None or driver in self._queues
+        coroutines = [inspect.iscoroutinefunction(handler) for handler in handlers.values()]
+        if not queued and any(coroutines):
+            raise ValueError("Coroutine handlers of {} need a queue_size".format(driver))
+        if queued and not all(coroutines):
+            raise ValueError("Handlers of {} need to be coroutine functions, as it has a queue".format(driver))
+
+        logger.debug("Attached Driver %s", driver)
+        if driver not in self._drivers:
+            self._drivers.append(driver)
+        if queue_size is not None and driver not in self._queues:
+            self._queues[driver] = DriverQueue(functools.partial(self._await_driver, driver), queue_size, overflow)
+        for key, handler in handlers.items():
+            observers, consumer = self._routes.get(key, ((), None))
+            if observe:
+                observers = observers + ((driver, handler),)
+            elif consumer is not None:
+                raise ValueError("{}/{} frames are already consumed by {}".format(key[0], key[1], consumer[0]))
+            else:
+                consumer = (driver, handler)
+            self._routes[key] = (observers, consumer)
+
+    def close_drivers(self):
+        """
+        Closes all drivers that have a close() method and sends everything
+        they sent meanwhile. The socket is left open.
+
+        Frames still queued for a driver are dropped.
+        """
+
+        for queue in self._queues.values():
+            queue.close()
+        for driver in self._drivers:
+            close = getattr(driver, "close", None)
+            if close is not None:
+                try:
+                    close()
+                except Exception as exp:
+                    logger.warning("Closing driver {} failed with exception {}.".format(driver, exp))
+        self.flush()
 
     def send_dgram(self, dgram, addr=None):
         """
-        Sends the String in dgram over the socket to the last known
-        origin.
+        Sends the datagram dgram over the socket to addr or the last known
+        origin. dgram may be either bytes or a String.
         """
 
         if not self._lastConnection and addr is None:
             logger.warning("Writing to UDP-Socket before anything was received. Will not send!")
         else:
+            started = time.perf_counter()
             if addr is None:
                 out_addr = self._lastConnection
             else:
                 out_addr = addr
-            logger.debug("Outgoing Datagram to {}".format(addr))
-            _prettyprint_mlstring(dgram, logger.debug)
-            self._transport.sendto(dgram.encode("UTF-8"), addr)
+            if isinstance(dgram, str):
+                dgram = dgram.encode("UTF-8")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Outgoing Datagram to %s:\n%s", out_addr, Lines(dgram))
+            self.counters["frames"] += 1
+
+            if self._coalesce and (out_addr[0] in self._coalesce or "*" in self._coalesce):
+                self._coalesce_frame(dgram, out_addr)
+            else:
+                self._sendto(dgram, out_addr)
+            self._send_seconds.labels().observe(time.perf_counter() - started)
+
+    def set_coalescing(self, host, enabled=True):
+        """
+        Enables or disables coalescing for host (an IP address, or "*" for
+        all hosts).
+
+        All frames sent to a coalescing host during an iteration of the event
+        loop are packed into as few datagrams as possible and sent at the end
+        of the iteration. The frames in a datagram are \0-terminated.
+        """
+
+        if enabled:
+            self._coalesce.add(host)
+        else:
+            self._coalesce.discard(host)
+
+    def _coalesce_frame(self, dgram, addr):
+        if not dgram.endswith(b"\0"):
+            dgram += b"\0"
+
+        batch = self._batches.get(addr)
+        if batch is None:
+            batch = self._batches[addr] = [[], 0]
+        elif batch[1] + len(dgram) > UdpServer.max_datagram:
+            self._send_batch(addr, batch[0])
+            batch[0], batch[1] = [], 0
+        batch[0].append(dgram)
+        batch[1] += len(dgram)
+
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_event_loop().call_soon(self.flush)
+
+    def _send_batch(self, addr, frames):
+        self._sendto(b"".join(frames), addr)
+
+    def _sendto(self, dgram, addr):
+        self.counters["datagrams"] += 1
+        if self._taps:
+            self._write_taps(Capture.OUT, dgram, addr)
+        self._transport.sendto(dgram, addr)
+
+    def flush(self):
+        """
+        Sends all coalesced frames right away.
+        """
+
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batches, self._batches = self._batches, {}
+        if self._transport is None or self._transport.is_closing():
+            return
+        for addr, batch in batches.items():
+            self._send_batch(addr, batch[0])
+
+
+async def start_server(local_addr, journal=None, retry_policy=None, scheduler=None, registry=None,
+                       max_messages=None, overflow=MessageSystem.REJECT, sock=None, locations=None,
+                       urgent_interval=None, groups=None, shard=None):
+    """
+    Binds the UdpServer to local_addr, or uses the already bound socket sock,
+    and attaches all drivers.
+    Their metrics are added to the metrics.Registry registry, if given.
+
+    Returns a tuple of the transport, the UdpServer and the MessageSystem.
+    """
+
+    loop = asyncio.get_event_loop()
+    if sock is not None:
+        transport, protocol = await loop.create_datagram_endpoint(UdpServer, sock=sock)
+    else:
+        transport, protocol = await loop.create_datagram_endpoint(
+            UdpServer,
+            local_addr=local_addr
+        )
+
+    return transport, protocol, attach_drivers(protocol, journal, retry_policy, scheduler, registry,
+                                               max_messages, overflow, locations, urgent_interval, groups, shard)
+
+
+def attach_drivers(protocol, journal=None, retry_policy=None, scheduler=None, registry=None,
+                   max_messages=None, overflow=MessageSystem.REJECT, locations=None, urgent_interval=None,
+                   groups=None, shard=None):
+    """
+    Attaches all drivers to the UdpServer protocol.
+    The RoamingMonitor keeps a snapshot of the locations in the file
+    locations, if given.
+    In a sharded server, shard is the (index, number of shards) of this
+    process, see sharding.ShardedServer.
+    Returns the MessageSystem.
+    """
+
+    roaming_monitor = RoamingMonitor(protocol, snapshot=locations)
+    message_system = MessageSystem(protocol, roaming_monitor, journal, retry_policy, scheduler=scheduler,
+                                   max_messages=max_messages, overflow=overflow, urgent_interval=urgent_interval,
+                                   groups=groups, shard=shard)
+    consumer_driver = ConsumerDriver(protocol)
+    telemetry = Telemetry(protocol)
+    roaming_monitor.set_hint(telemetry.strongest)
+    telemetry.add_listener(roaming_monitor.hinted)
+
+    if registry is not None:
+        protocol.attach_metrics(registry)
+        roaming_monitor.attach_metrics(registry)
+        telemetry.attach_metrics(registry)
+        message_system.attach_metrics(registry)
+
+    return message_system
+
+
+def _policies(args):
+    # The RetryPolicy and SendScheduler configured by the command line.
+    return (
+        RetryPolicy(interval=args.retry_interval, backoff=args.retry_interval, max_backoff=args.max_backoff),
+        SendScheduler(window=args.window, rate=args.send_rate, max_rto=args.retry_interval, reserved=args.reserved),
+    )
+
+
+def _attach_debugging(protocol, args, dump):
+    """
+    Attaches the tracer of the --trace extensions and the ring of the last
+    datagrams to protocol. The ring is dumped to the capture file dump (or
+    the log) on SIGUSR1.
+    """
+
+    if args.trace:
+        protocol.add_tap(Tracer(args.trace, args.trace_sample))
+    if args.frame_ring:
+        ring = FrameRing(args.frame_ring)
+        protocol.add_tap(ring)
+        asyncio.get_event_loop().add_signal_handler(signal.SIGUSR1, ring.dump, dump)
+
+
+async def _listen(start, name, retry_for=0):
+    """
+    Awaits start(), which starts a listening server. A failing bind is
+    retried for retry_for seconds, e.g. while the predecessor of a handover
+    closes its listeners. Afterwards the error is raised, unless retry_for is
+    given: The taken over UDP socket would be lost with us, so we log the
+    error and return False to run without the server.
+    """
+
+    deadline = time.monotonic() + retry_for
+    while True:
+        try:
+            await start()
+            return True
+        except OSError as exp:
+            if time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            elif retry_for:
+                logger.error("Failed to start the %s, running without it: %s", name, exp)
+                return False
+            else:
+                raise
+
+
+def _serve_sharded(args, groups):
+    """
+    Runs the server as a front end with args.workers worker processes, see
+    sharding.ShardedServer.
+
+    Every worker has its own journal, locations, capture and dump file: Their
+    paths get the index of the worker appended. SIGUSR1 is passed on to the
+    workers. The worker serves its metrics on
+    the metrics port + 1 + its index, the front end on the metrics port.
+    """
+
+    def path(base, index):
+        return None if base is None else "{}.{}".format(base, index)
+
+    async def setup(index, transport):
+        protocol = UdpServer()
+        protocol.connection_made(transport)
+        journal = Journal(path(args.journal, index)) if args.journal else None
+        registry = Registry() if args.metrics_port is not None else None
+        # The limit is shared by all workers.
+        max_messages = None if args.max_messages is None else max(1, args.max_messages // args.workers)
+        attach_drivers(protocol, journal, *_policies(args), registry, max_messages, args.overflow,
+                       path(args.locations, index), args.urgent_retry_interval, groups, (index, args.workers))
+        metrics_server = None
+        if registry is not None:
+            metrics_server = MetricsServer(registry)
+            await metrics_server.start(port=args.metrics_port + 1 + index)
+        for host in args.coalesce:
+            protocol.set_coalescing(host)
+        capture = None
+        if args.capture:
+            capture = Capture(path(args.capture, index), max_bytes=args.capture_size * 1024 * 1024)
+            protocol.set_capture(capture)
+        _attach_debugging(protocol, args, path(args.dump, index))
+
+        def close():
+            if metrics_server is not None:
+                metrics_server.close()
+            # Confirmations for messages written to the journal by now are sent on close.
+            protocol.close_drivers()
+            if capture is not None:
+                capture.close()
+
+        return protocol, close
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("0.0.0.0", args.port))
+    sock.setblocking(False)
+    server = ShardedServer(sock, args.workers, setup, groups=groups)
+    # The workers are forked before the event loop of the front end exists.
+    server.start()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(server.serve(loop.stop))
+    metrics_server = None
+    if args.metrics_port is not None:
+        registry = Registry()
+        registry.counter("snom_shard_frames_total", "Frames handed to workers",
+                         lambda: {str(i): n for i, n in enumerate(server.router.counters["routed"])}, ("worker",))
+        registry.counter("snom_shard_dropped_total", "Frames dropped because the channel to a worker was full",
+                         lambda: {str(i): n for i, n in enumerate(server.router.counters["dropped"])}, ("worker",))
+        metrics_server = MetricsServer(registry)
+        loop.run_until_complete(metrics_server.start(port=args.metrics_port))
+
+    # Stopping the workers takes a moment, they write their journals.
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    loop.add_signal_handler(signal.SIGUSR1, server.send_signal, signal.SIGUSR1)
+    logger.info("Snom Messaging started successfully with %s workers.", args.workers)
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+
+    if metrics_server is not None:
+        metrics_server.close()
+    server.close()
+    sock.close()
 
 
 def main():
-    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="SNOM messaging server")
+    parser.add_argument("--port", metavar="PORT", type=int, default=1300,
+                        help="receive frames from the base stations on UDP port PORT (default: %(default)s)")
+    parser.add_argument("--workers", metavar="N", type=int, default=1,
+                        help="spread the work over N processes, sharded by extension (default: %(default)s)")
+    parser.add_argument("--journal", metavar="PATH",
+                        help="keep the outbox in a journal at PATH, so it survives restarts")
+    parser.add_argument("--retry-interval", metavar="SECONDS", type=float, default=60,
+                        help="resend unanswered messages after at most SECONDS (default: %(default)s)")
+    parser.add_argument("--max-backoff", metavar="SECONDS", type=float, default=3600,
+                        help="probe absent handsets at least every SECONDS (default: %(default)s)")
+    parser.add_argument("--window", metavar="N", type=int, default=32,
+                        help="send at most N unanswered messages to a base station (default: %(default)s)")
+    parser.add_argument("--send-rate", metavar="N", type=float, default=100,
+                        help="send at most N messages per second to a base station (default: %(default)s)")
+    parser.add_argument("--urgent-retry-interval", metavar="SECONDS", type=float,
+                        help="resend unanswered messages with a priority above 0 after at most SECONDS "
+                             "(default: a quarter of --retry-interval)")
+    parser.add_argument("--reserved", metavar="N", type=int, default=8,
+                        help="keep N slots of the window free for messages with a priority above 0 (default: %(default)s)")
+    parser.add_argument("--coalesce", metavar="HOST", action="append", default=[],
+                        help="pack several frames to the base station at HOST into one datagram, "
+                             "may be given multiple times, * for all base stations")
+    parser.add_argument("--metrics-port", metavar="PORT", type=int,
+                        help="serve metrics in the Prometheus text format on localhost:PORT")
+    parser.add_argument("--max-messages", metavar="N", type=int,
+                        help="queue at most N messages (default: unlimited)")
+    parser.add_argument("--overflow", choices=(MessageSystem.REJECT, MessageSystem.DROP_OLDEST), default=MessageSystem.REJECT,
+                        help="what to do with new messages while the outbox is full (default: %(default)s)")
+    parser.add_argument("--capture", metavar="PATH",
+                        help="write all datagrams to the capture file PATH, see replay.py")
+    parser.add_argument("--capture-size", metavar="MB", type=int, default=64,
+                        help="rotate the capture file after MB megabytes (default: %(default)s)")
+    parser.add_argument("--locations", metavar="PATH",
+                        help="keep a snapshot of the handset locations at PATH, so they survive restarts")
+    parser.add_argument("--handover", metavar="PATH",
+                        help="hand the UDP socket over to a successor connecting to the Unix socket PATH")
+    parser.add_argument("--groups", metavar="PATH",
+                        help="read groups of handsets to send messages to from the JSON file PATH")
+    parser.add_argument("--inject-port", metavar="PORT", type=int,
+                        help="accept messages from local applications over HTTP on localhost:PORT")
+    parser.add_argument("--inject-socket", metavar="PATH",
+                        help="accept messages from local applications over HTTP on the Unix socket PATH")
+    parser.add_argument("--frame-ring", metavar="N", type=int, default=1000,
+                        help="keep the last N datagrams in memory and dump them on SIGUSR1, 0 to disable "
+                             "(default: %(default)s)")
+    parser.add_argument("--dump", metavar="PATH",
+                        help="dump the datagrams to the capture file PATH instead of the log, "
+                             "may contain strftime codes like %%Y%%m%%d-%%H%%M%%S")
+    parser.add_argument("--trace", metavar="EXT", action="append", default=[],
+                        help="log all frames to and from the extension EXT, may be given multiple times")
+    parser.add_argument("--trace-sample", metavar="N", type=int, default=1,
+                        help="log only every N-th frame of a traced extension (default: %(default)s)")
+    parser.add_argument("--log-level", default="INFO",
+                        help="log records of at least this level (default: %(default)s)")
+    parser.add_argument("--log-json", action="store_true",
+                        help="log every record as a line of JSON")
+    parser.add_argument("--take-over", action="store_true",
+                        help="take the UDP socket over from the server listening at the --handover PATH")
+    args = parser.parse_args()
+    if args.take_over and not args.handover:
+        parser.error("--take-over requires --handover")
+    if args.inject_port is not None and args.inject_socket:
+        parser.error("--inject-port and --inject-socket are mutually exclusive")
+    if args.workers > 1 and (args.handover or args.inject_port is not None or args.inject_socket):
+        parser.error("--handover and injection are not supported with --workers")
+    if args.frame_ring < 0 or args.trace_sample < 1:
+        parser.error("--frame-ring must not be negative and --trace-sample must be at least 1")
+
+    logging.basicConfig(level=args.log_level)
+    if args.log_json:
+        for handler in logging.getLogger().handlers:
+            handler.setFormatter(JsonFormatter())
     logger.debug("Begin Setup...")
 
+    try:
+        groups = Groups(args.groups)
+    except (OSError, ValueError) as exp:
+        parser.error("Can not read groups: {}".format(exp))
+
+    if args.workers > 1:
+        _serve_sharded(args, groups)
+        return
+
     loop = asyncio.get_event_loop()
-    sock = loop.create_datagram_endpoint(
-        UdpServer,
-        local_addr=("0.0.0.0", 1300)
-    )
-    transport, protocol = loop.run_until_complete(sock)
+    # The predecessor has to close its journal before we recover it.
+    sock = take_over(args.handover) if args.take_over else None
+    journal = Journal(args.journal) if args.journal else None
+    registry = Registry() if args.metrics_port is not None else None
+    transport, protocol, message_system = loop.run_until_complete(
+        start_server(("0.0.0.0", args.port), journal, *_policies(args), registry,
+                     args.max_messages, args.overflow, sock, args.locations, args.urgent_retry_interval, groups))
+    # After a takeover, the predecessor may still hold our ports for a moment.
+    retry_for = 10 if sock is not None else 0
+    metrics_server = None
+    if registry is not None:
+        metrics_server = MetricsServer(registry)
+        if not loop.run_until_complete(_listen(functools.partial(metrics_server.start, port=args.metrics_port),
+                                               "metrics server", retry_for)):
+            metrics_server = None
+    for host in args.coalesce:
+        protocol.set_coalescing(host)
+    capture = None
+    if args.capture:
+        capture = Capture(args.capture, max_bytes=args.capture_size * 1024 * 1024)
+        protocol.set_capture(capture)
+    _attach_debugging(protocol, args, args.dump)
 
-    roaming_monitor = RoamingMonitor(protocol)
-    message_system = MessageSystem(protocol, roaming_monitor)
-    consumer_driver = ConsumerDriver(protocol)
+    injection_server = None
+    if args.inject_port is not None or args.inject_socket:
+        injection_server = InjectionServer(message_system)
+        if args.inject_port is not None:
+            start = functools.partial(injection_server.start, port=args.inject_port)
+        else:
+            start = functools.partial(injection_server.start_unix, args.inject_socket)
+        if not loop.run_until_complete(_listen(start, "injection server", retry_for)):
+            injection_server = None
+
+    def drain():
+        # The successor binds our ports once it has the UDP socket.
+        for server in (handover_server, metrics_server, injection_server):
+            if server is not None:
+                server.close()
+        protocol.close_drivers()
+
+    handover_server = None
+    if args.handover:
+        handover_server = HandoverServer(args.handover, transport, drain, loop.stop)
+        loop.run_until_complete(handover_server.start())
 
     logger.info("Snom Messaging started successfully.")
     try:
@@ -108,8 +668,17 @@ def main():
     except KeyboardInterrupt:
         pass
 
+    if handover_server is not None:
+        handover_server.close()
+    if metrics_server is not None:
+        metrics_server.close()
+    if injection_server is not None:
+        injection_server.close()
+    # Confirmations for messages written to the journal by now are sent on close.
+    protocol.close_drivers()
     transport.close()
-    message_system.close()
+    if capture is not None:
+        capture.close()
 
 if __name__ == "__main__":
     main()
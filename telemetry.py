@@ -0,0 +1,195 @@
+import logging
+import array
+import collections
+import time
+from metrics import Counter
+logger = logging.getLogger(__name__)
+
+class RssiSeries():
+
+    """
+    This class stores the last samples of the RSSI of a handset as seen by a
+    single BaseStation (rfpi) in a ring buffer.
+
+    The samples live in two fixed-size arrays, so a series never grows. The
+    sum of the samples is updated with every sample, so the mean is
+    available in constant time.
+    """
+
+    __slots__ = ("_times", "_values", "_pos", "_count", "_sum", "last")
+
+    def __init__(self, size):
+        self._times = array.array("d", bytes(8 * size))
+        # The RSSI is reported as a single byte.
+        self._values = array.array("B", bytes(size))
+        self._pos = 0
+        self._count = 0
+        self._sum = 0
+        # Time of the latest sample
+        self.last = 0
+
+    def __len__(self):
+        return self._count
+
+    def add(self, timestamp, rssi):
+        pos = self._pos
+        if self._count == len(self._values):
+            self._sum -= self._values[pos]
+        else:
+            self._count += 1
+        self._times[pos] = timestamp
+        self._values[pos] = rssi
+        self._sum += rssi
+        self._pos = (pos + 1) % len(self._values)
+        self.last = timestamp
+
+    def mean(self):
+        return self._sum / self._count if self._count else 0
+
+    def samples(self):
+        """
+        Returns the samples as list of (time, rssi), oldest first.
+        """
+
+        size = len(self._values)
+        start = (self._pos - self._count) % size
+        return [(self._times[i % size], self._values[i % size]) for i in range(start, start + self._count)]
+
+
+class Telemetry():
+
+    """
+    This class collects the RSSI reported in alarm frames.
+
+    Handsets regularly send alarm frames (type 16 when connecting, others
+    for actual alarms). They contain the rfpi of the BaseStation the handset
+    is connected to and the RSSI it is received with. Samples are kept per
+    (handset, rfpi) in RssiSeries of samples entries each.
+
+    Memory is bounded: At most max_series series are kept. The least recently
+    updated ones are evicted first, as are series without a sample for
+    max_age seconds.
+
+    strongest() returns the BaseStation that received a handset best
+    recently, which RoamingMonitor uses as hint for handsets it has no
+    location for. Listeners are told about handsets that are heard of for
+    the first time (again), see add_listener().
+    """
+
+    def __init__(self, udp_server, samples=32, max_series=10000, max_age=300):
+        self._samples = samples
+        self._max_series = max_series
+        self._max_age = max_age
+
+        # (number, rfpi) => RssiSeries, least recently updated first
+        self._series = collections.OrderedDict()
+        # number => set of rfpis with a series
+        self._handsets = {}
+        # rfpi => [addr of the BaseStation reporting it, number of series]
+        self._stations = {}
+        self._listeners = []
+
+        self.counters = {
+            "samples": 0,
+            "invalid": 0,
+            "evicted": 0,
+        }
+        self._alarms = Counter("snom_alarms_total", "Alarm frames by alarm type", ("type",))
+
+        udp_server.register_driver(self, {
+            ("request", "alarm"): self.process_alarm,
+        }, observe=True, queue_size=1000)
+
+    def add_listener(self, callback):
+        """
+        Registers a callback that is called with (number, addr) whenever a
+        handset without any series gets a sample.
+        """
+
+        self._listeners.append(callback)
+
+    def attach_metrics(self, registry):
+        registry.register(self._alarms)
+        registry.gauge("snom_rssi_series", "RSSI series kept", lambda: len(self._series))
+        registry.counter("snom_rssi_samples_total", "RSSI samples by result",
+                         lambda: dict(self.counters), ("result",))
+
+    def __len__(self):
+        return len(self._series)
+
+    def series(self, number, rfpi):
+        return self._series.get((number, rfpi))
+
+    async def process_alarm(self, frame, addr):
+        number = frame.findtext("senderdata/address")
+        self._alarms.inc(frame.findtext("alarmdata/type"))
+        rfpi = frame.findtext("rssidata/rfpi")
+        try:
+            rssi = int(frame.findtext("rssidata/rssi"))
+        except (TypeError, ValueError):
+            rssi = -1
+        if not number or not rfpi or not 0 <= rssi <= 255:
+            self.counters["invalid"] += 1
+            return
+
+        self.add(number, rfpi, rssi, addr, time.time())
+
+    def add(self, number, rfpi, rssi, addr, timestamp):
+        """
+        Records a sample of the RSSI of number at the BaseStation rfpi, which
+        is reachable at addr.
+        """
+
+        key = (number, rfpi)
+        series = self._series.get(key)
+        if series is None:
+            if len(self._series) >= self._max_series:
+                self._evict()
+            series = self._series[key] = RssiSeries(self._samples)
+            rfpis = self._handsets.setdefault(number, set())
+            rfpis.add(rfpi)
+            self._stations.setdefault(rfpi, [addr, 0])[1] += 1
+        else:
+            self._series.move_to_end(key)
+            rfpis = None
+        self._stations[rfpi][0] = addr
+        series.add(timestamp, rssi)
+        self.counters["samples"] += 1
+
+        # Stale series are at the front.
+        while next(iter(self._series.values())).last + self._max_age < timestamp:
+            self._evict()
+
+        if rfpis is not None and len(rfpis) == 1:
+            for callback in self._listeners:
+                try:
+                    callback(number, addr)
+                except Exception as exp:
+                    logger.warning("Telemetry listener {} failed with exception {}.".format(callback, exp))
+
+    def _evict(self):
+        (number, rfpi), _ = self._series.popitem(last=False)
+        rfpis = self._handsets[number]
+        rfpis.discard(rfpi)
+        if not rfpis:
+            del self._handsets[number]
+        station = self._stations[rfpi]
+        station[1] -= 1
+        if not station[1]:
+            del self._stations[rfpi]
+        self.counters["evicted"] += 1
+
+    def strongest(self, number):
+        """
+        Returns the address of the BaseStation with the highest mean RSSI of
+        number during the last max_age seconds, or None.
+        """
+
+        best = None
+        best_rssi = -1
+        oldest = time.time() - self._max_age
+        for rfpi in self._handsets.get(number, ()):
+            series = self._series[(number, rfpi)]
+            if series.last >= oldest and series.mean() > best_rssi:
+                best, best_rssi = rfpi, series.mean()
+        return None if best is None else self._stations[best][0]
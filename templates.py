@@ -0,0 +1,155 @@
+import re
+from xml.sax.saxutils import escape
+
+def _escape(value):
+    if value.__class__ is not str:
+        value = "" if value is None else str(value)
+    if "&" in value or "<" in value or ">" in value:
+        return escape(value)
+    return value
+
+class Template():
+
+    """
+    This class implements a precompiled datagram template.
+
+    The template text is split into a head and a list of ({{field}}, literal)
+    slots once, so rendering is a single pass that fills in the XML-escaped
+    field values followed by one UTF-8 encode.
+
+    Fields that do not change for a given message can be bound in advance
+    using bind(). This returns a new Template with these values merged into
+    the literal chunks, so only the remaining (volatile) fields are
+    filled in on every render().
+    """
+
+    _field = re.compile(r"\{\{(\w+)\}\}")
+
+    def __init__(self, text):
+        """
+        Compiles the template text.
+        """
+
+        # parts alternates between literal text and field names:
+        # [literal, field, literal, field, ..., literal]
+        parts = Template._field.split(text)
+        self._head = parts[0]
+        self._slots = list(zip(parts[1::2], parts[2::2]))
+
+    @classmethod
+    def _from_slots(cls, head, slots):
+        template = cls.__new__(cls)
+        template._head = head
+        template._slots = slots
+        return template
+
+    @property
+    def fields(self):
+        """
+        Returns the names of all fields that still need a value.
+        """
+
+        return frozenset(name for name, _ in self._slots)
+
+    @property
+    def text(self):
+        """
+        Returns the template text with {{field}} placeholders.
+        """
+
+        return self._head + "".join("{{%s}}%s" % slot for slot in self._slots)
+
+    def bind(self, **values):
+        """
+        Returns a new Template with the given fields filled in.
+        """
+
+        head = self._head
+        slots = []
+        for name, literal in self._slots:
+            if name not in values:
+                slots.append((name, literal))
+            elif slots:
+                slots[-1] = (slots[-1][0], slots[-1][1] + _escape(values[name]) + literal)
+            else:
+                head = head + _escape(values[name]) + literal
+        return Template._from_slots(head, slots)
+
+    def render(self, **values):
+        """
+        Renders the template with all remaining fields to UTF-8 encoded bytes.
+        """
+
+        out = [self._head]
+        for name, literal in self._slots:
+            out.append(_escape(values[name]))
+            out.append(literal)
+        return "".join(out).encode("UTF-8")
+
+
+# The BaseStations seem to be somewhat picky on the format of the XML.
+# Thus we are using templates here to create the binary-xml we really want.
+
+JOB_RESPONSE = Template("""<?xml version="1.0" encoding="UTF-8"?>
+<response version="19.11.12.1403" type="job">
+<externalid>{{eid}}</externalid>
+<systemdata>
+<name>server</name>
+<datetime>{{dt}}</datetime>
+<timestamp>{{ts}}</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+<jobdata>
+<priority>0</priority>
+<messages>
+<message1></message1>
+<message2></message2>
+<messageuui></messageuui>
+</messages>
+<status>1</status>
+<statusinfo></statusinfo>
+</jobdata>
+<senderdata>
+<address>{{to_ext}}</address>
+<name>name</name>
+<location>server</location>
+</senderdata>
+<persondata>
+<address>{{from_ext}}</address>
+<name>{{from_name}}</name>
+<location>{{from_loc}}</location>
+</persondata>
+</response>
+\0""")
+
+JOB_REQUEST = Template("""<?xml version="1.0" encoding="UTF-8"?>
+<request version="19.11.12.1403" type="job">
+<externalid>{{eid}}</externalid>
+<systemdata>
+<name>server</name>
+<datetime>{{dt}}</datetime>
+<timestamp>{{ts}}</timestamp>
+<status>1</status>
+<statusinfo>System running</statusinfo>
+</systemdata>
+<jobdata>
+<priority>{{priority}}</priority>
+<messages>
+<message1></message1>
+<message2></message2>
+<messageuui>{{msg}}</messageuui>
+</messages>
+<status>0</status>
+<statusinfo></statusinfo>
+</jobdata>
+<senderdata>
+<address>{{from_ext}}</address>
+<name>{{from_name}}</name>
+<location>{{from_loc}}</location>
+</senderdata>
+<persondata>
+<address>{{to_ext}}</address>
+</persondata>
+</request>
+\0""")
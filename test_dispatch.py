@@ -0,0 +1,43 @@
+import asyncio
+import unittest
+import snom_messaging
+from dispatch import DriverQueue
+
+
+class DriverQueueTest(unittest.TestCase):
+
+    def test_worker_yields_between_frames(self):
+        order = []
+
+        async def call(handler, frame, addr):
+            order.append(frame)
+
+        async def other():
+            order.append("other")
+
+        async def run():
+            queue = DriverQueue(call)
+            for frame in (1, 2, 3):
+                queue.put(None, frame, None)
+            asyncio.get_running_loop().create_task(other())
+            while queue.counters["handled"] < 3:
+                await asyncio.sleep(0.01)
+            queue.close()
+
+        asyncio.run(run())
+        self.assertLess(order.index("other"), 3)
+
+
+class RegisterDriverTest(unittest.TestCase):
+
+    def test_queued_driver_needs_coroutine_handlers(self):
+        async def run():
+            server = snom_messaging.UdpServer()
+            with self.assertRaises(ValueError):
+                server.register_driver(object(), {("request", "alarm"): lambda frame, addr: None}, queue_size=10)
+
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import xml.etree.ElementTree as ET
+from benchmark import JOB_FRAME, SYSTEMINFO_FRAME, LOGIN_FRAME, ALARM_FRAME
+from frames import FIELDS, Frame
+
+_SAMPLES = {
+    "job": JOB_FRAME,
+    "systeminfo": SYSTEMINFO_FRAME,
+    "login": LOGIN_FRAME,
+    "alarm": ALARM_FRAME,
+}
+
+_TEXT = b"<messageuui>Lunch is ready &amp; waiting in the kitchen</messageuui>"
+
+
+class FrameTest(unittest.TestCase):
+
+    def assertParsedLikeElementTree(self, data):
+        data = data.rstrip(b"\0")
+        frame = Frame.parse(data)
+        root = ET.fromstring(data)
+        self.assertEqual((frame.tag, frame.attrib), (root.tag, root.attrib))
+        for path in FIELDS[(frame.tag, frame.type)]:
+            with self.subTest(path=path):
+                self.assertEqual(frame.findall(path), [e.text or "" for e in root.findall(path)])
+        return frame
+
+    def test_samples(self):
+        for name, data in _SAMPLES.items():
+            with self.subTest(frame=name):
+                self.assertParsedLikeElementTree(data)
+
+    def test_entities(self):
+        data = JOB_FRAME.replace(_TEXT, b"<messageuui>&lt;b&gt; &#228; &quot;x&quot; &amp;amp;</messageuui>")
+        frame = self.assertParsedLikeElementTree(data)
+        self.assertEqual(frame.findtext("jobdata/messages/messageuui"), '<b> \xe4 "x" &amp;')
+
+    def test_cdata(self):
+        data = JOB_FRAME.replace(_TEXT, b"<messageuui><![CDATA[x < y & z]]></messageuui>")
+        frame = self.assertParsedLikeElementTree(data)
+        self.assertEqual(frame.findtext("jobdata/messages/messageuui"), "x < y & z")
+
+    def test_whitespace_in_closing_tag(self):
+        data = JOB_FRAME.replace(b"<address>42</address>", b"<address>42</address >")
+        frame = self.assertParsedLikeElementTree(data)
+        self.assertEqual(frame.findtext("persondata/address"), "42")
+
+    def test_empty_leaf(self):
+        data = LOGIN_FRAME.replace(b"<status>1</status>", b"<status/>", 1)
+        self.assertParsedLikeElementTree(data)
+
+
+if __name__ == "__main__":
+    unittest.main()
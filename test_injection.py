@@ -0,0 +1,34 @@
+import json
+import unittest
+from injection import InjectionServer
+
+
+def _batch(**entry):
+    return json.dumps({"messages": [entry]}).encode()
+
+
+class ParseBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = InjectionServer(None)
+
+    def test_valid(self):
+        self.assertEqual(self.server.parse_batch(_batch(to=["42", "23"], text="Fire alarm\nä \U0001f525", priority=1)),
+                         [(["42", "23"], None, "Fire alarm\nä \U0001f525", 1)])
+
+    def test_invalid_text(self):
+        for text in ["Fire\0alarm", "Fire\x07alarm", "￾", "\ud800"]:
+            with self.subTest(text=text):
+                with self.assertRaises(ValueError):
+                    self.server.parse_batch(_batch(to="42", text=text))
+
+    def test_invalid_recipient(self):
+        # Digits of other scripts are no extensions.
+        for to in ["٤٢", "4²", "", "42a"]:
+            with self.subTest(to=to):
+                with self.assertRaises(ValueError):
+                    self.server.parse_batch(_batch(to=to, text="Fire alarm"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,116 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from unittest import mock
+from journal import Journal
+from messagesystem import Message
+
+
+def _message(internal_ext_id):
+    return Message(str(internal_ext_id), "Hello", "Alice", "101", "", "102", "", "", internal_ext_id=internal_ext_id)
+
+
+class _FailingFile():
+
+    # Writes half of the first chunk, then fails, like a disk running full.
+
+    def __init__(self, file):
+        self._file = file
+        self.failures = 1
+
+    def write(self, data):
+        if self.failures:
+            self.failures -= 1
+            self._file.write(data[:len(data) // 2])
+            raise OSError(28, "No space left on device")
+        return self._file.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "outbox.journal")
+
+    def _write(self, journal, messages, callback=None):
+        async def write():
+            for message in messages:
+                journal.enqueue(message, callback)
+            journal.close()
+        asyncio.run(write())
+
+    def test_torn_record_is_discarded(self):
+        journal = Journal(self.path, commit_delay=0)
+        journal.recover()
+        self._write(journal, [_message(1), _message(2)])
+        with open(self.path, "ab") as f:
+            f.write(Journal._enqueue_record(_message(3))[:-5])
+
+        journal = Journal(self.path, commit_delay=0)
+        self.assertEqual(sorted(m.internal_ext_id for m in journal.recover()), [1, 2])
+        # Records appended after recovery are not hidden behind the torn one.
+        self._write(journal, [_message(4)])
+        self.assertEqual(sorted(m.internal_ext_id for m in Journal(self.path).recover()), [1, 2, 4])
+
+    def test_corrupt_record_ends_recovery(self):
+        journal = Journal(self.path, commit_delay=0)
+        journal.recover()
+        self._write(journal, [_message(1), _message(2)])
+        with open(self.path, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            last = f.read(1)
+            f.seek(-1, os.SEEK_END)
+            f.write(bytes([last[0] ^ 0xff]))
+
+        self.assertEqual([m.internal_ext_id for m in Journal(self.path).recover()], [1])
+
+    def test_failed_write_is_retried(self):
+        committed = []
+
+        async def write():
+            journal = Journal(self.path, commit_delay=0)
+            journal.recover()
+            failing = journal._file = _FailingFile(journal._file)
+            journal.enqueue(_message(1), lambda: committed.append(1))
+            while not committed:
+                await asyncio.sleep(0.01)
+            self.assertEqual(failing.failures, 0)
+            journal.enqueue(_message(2))
+            journal.close()
+
+        with mock.patch.object(Journal, "_retry_delay", 0.01):
+            asyncio.run(write())
+        self.assertEqual(committed, [1])
+        # The half written record was cut off before the retry.
+        self.assertEqual([m.internal_ext_id for m in Journal(self.path).recover()], [1, 2])
+
+    def test_separator_in_field_is_dropped(self):
+        journal = Journal(self.path, commit_delay=0)
+        journal.recover()
+        message = Message("1", "Hello\0World", "Alice", "101", "", "102", "", "", internal_ext_id=1)
+        self._write(journal, [message, _message(2)])
+
+        recovered = Journal(self.path).recover()
+        self.assertEqual([(m.internal_ext_id, m.message, m.to_ext) for m in recovered],
+                         [(1, "HelloWorld", "102"), (2, "Hello", "102")])
+
+    def test_record_with_wrong_fields_is_skipped(self):
+        journal = Journal(self.path, commit_delay=0)
+        journal.recover()
+        self._write(journal, [_message(1)])
+        with open(self.path, "ab") as f:
+            f.write(Journal._record(Journal.ENQUEUE, Journal._enqueue.pack(2, 0, 0) + "\0".join("x" * 12).encode()))
+        journal = Journal(self.path, commit_delay=0)
+        journal.recover()
+        self._write(journal, [_message(3)])
+
+        self.assertEqual([m.internal_ext_id for m in Journal(self.path).recover()], [1, 3])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import asyncio
+import unittest
+import snom_messaging
+from frames import Frame
+from messagesystem import Message
+from outbox import Outbox
+from pacing import SendScheduler
+from retry import RetryPolicy
+from simulator import SYSTEMINFO, SYSTEMINFO_END, _systemdata
+from templates import JOB_REQUEST
+
+_BASE_STATION = ("10.0.0.1", 1300)
+
+
+class _Transport(asyncio.DatagramTransport):
+
+    def __init__(self):
+        super().__init__()
+        self.sent = []
+
+    def sendto(self, data, addr=None):
+        self.sent.append((data, addr))
+
+    def is_closing(self):
+        return False
+
+    def close(self):
+        pass
+
+    def recipients(self):
+        # The recipients of the messages sent so far, in order.
+        recipients = []
+        for data, _ in self.sent:
+            for frame in data.split(b"\0"):
+                if frame and Frame.parse(frame).tag == "request":
+                    recipients.append(Frame.parse(frame).findtext("persondata/address"))
+        return recipients
+
+
+def _systeminfo(extensions):
+    return (SYSTEMINFO.render(**_systemdata()) +
+            "".join("<address>{}</address>\n".format(e) for e in extensions).encode() + SYSTEMINFO_END)
+
+
+def _job(to_ext):
+    return JOB_REQUEST.render(priority=0, msg="Hello", from_ext="100", from_name="Alice", from_loc="",
+                              to_ext=to_ext, **_systemdata())
+
+
+class MessageSystemTest(unittest.TestCase):
+
+    def test_held_message_frees_its_slot(self):
+        async def run():
+            server = snom_messaging.UdpServer()
+            transport = _Transport()
+            server.connection_made(transport)
+            scheduler = SendScheduler(window=3, reserved=1, initial_rto=0.05, min_rto=0.05)
+            snom_messaging.attach_drivers(server, None, RetryPolicy(interval=60, backoff=60), scheduler)
+            try:
+                server.datagram_received(_systeminfo(["100", "101", "102", "103"]), _BASE_STATION)
+                server.datagram_received(_job("101"), _BASE_STATION)
+                server.datagram_received(_job("101"), _BASE_STATION)
+                await asyncio.sleep(0.01)
+                self.assertEqual(transport.recipients(), ["101", "101"])
+
+                # 101 leaves while both of its messages are unanswered. They are
+                # parked once they time out and must not block the window.
+                server.datagram_received(_systeminfo(["100", "102", "103"]), _BASE_STATION)
+                server.datagram_received(_job("102"), _BASE_STATION)
+                server.datagram_received(_job("103"), _BASE_STATION)
+                await asyncio.sleep(0.3)
+                self.assertEqual(transport.recipients()[2:4], ["102", "103"])
+            finally:
+                server.close_drivers()
+
+        asyncio.run(run())
+
+
+class OutboxTest(unittest.TestCase):
+
+    def test_rescheduling_keeps_heap_bounded(self):
+        outbox = Outbox()
+        message = Message("1", "Hello", "Alice", "100", "", "101", "", "", internal_ext_id=1)
+        outbox.add(message, 0)
+        for i in range(1000):
+            outbox.schedule(message, i)
+            outbox.park(message)
+        self.assertLessEqual(len(outbox._heap), 2 * len(outbox) + 65)
+        self.assertEqual(outbox.pop_due(1e9), ([], []))
+
+
+if __name__ == "__main__":
+    unittest.main()